@@ -0,0 +1,286 @@
+import os
+import re
+import json
+import zlib
+import asyncio
+from collections import namedtuple
+
+from model_client import ERROR_PREFIX
+from analysis_cache import content_key, file_digest
+
+# Most lines per chunk. Chunks normally end on a definition (see
+# iter_chunks); with none in reach they are cut here, keeping
+# ANALYSIS_CHUNK_OVERLAP lines for context.
+ANALYSIS_CHUNK_LINES = int(os.environ.get("ANALYSIS_CHUNK_LINES", "200"))
+ANALYSIS_CHUNK_OVERLAP = int(os.environ.get("ANALYSIS_CHUNK_OVERLAP", "20"))
+# Characters per chunk, for files with very long (e.g. minified) lines.
+ANALYSIS_CHUNK_CHARS = int(os.environ.get("ANALYSIS_CHUNK_CHARS", "16000"))
+# Chunks of one file analyzed at once.
+ANALYSIS_MAX_PARALLEL = int(os.environ.get("ANALYSIS_MAX_PARALLEL", "4"))
+ANALYSIS_CHUNK_TOKENS = int(os.environ.get("ANALYSIS_CHUNK_TOKENS", "512"))
+ANALYSIS_REPORT_TOKENS = int(os.environ.get("ANALYSIS_REPORT_TOKENS", "1024"))
+# Findings merged in one prompt; more than this are merged in rounds.
+ANALYSIS_REDUCE_CHARS = int(os.environ.get("ANALYSIS_REDUCE_CHARS", "12000"))
+
+# Bump when the prompts below change, so cached analyses made with the old
+# wording stop matching.
+ANALYSIS_PROMPT_VERSION = "2"
+
+# Definitions in the common languages: Python, JS/TS, Rust, Go, Java/C#,
+# and so on, at the top level or one indent in (methods).
+BOUNDARY = re.compile(
+    r"(?:    |\t)?(?:(?:async\s+)?def\s|class\s|(?:export\s+)?(?:default\s+)?(?:async\s+)?function\b|export\s"
+    r"|(?:pub(?:\([\w:]+\))?\s+)?(?:fn|struct|enum|impl|trait|mod)\s|func\s|type\s+\w"
+    r"|(?:public|private|protected|internal|static|abstract|final)\s|interface\s|module\s)"
+)
+DECORATOR = re.compile(r"(?:    |\t)?@\w")
+
+Chunk = namedtuple("Chunk", "index start end text")
+
+
+def analyze_prompt(path: str, content: str) -> str:
+    return f"Analyze this file and list issues, improvements and possible fixes. File path: {path}\n\n{content}"
+
+
+def chunk_prompt(path: str, chunk: Chunk) -> str:
+    # Line numbers are relative to the chunk, so the prompt (and the cached
+    # answer) stays the same when lines are added or removed above it.
+    return (
+        f"Analyze this part of the file {path}. List concrete issues, improvements and possible "
+        f"fixes in this part only, citing line numbers counted from 1 at the first line shown. "
+        f"If there are none, reply \"No issues.\"\n\n{chunk.text}"
+    )
+
+
+LINE_REFERENCE = re.compile(r"\b([Ll]ines?\s+)(\d+)(?:(\s*(?:-|–|to)\s*)(\d+))?")
+
+
+def shift_line_numbers(text: str, offset: int) -> str:
+    """Turn the chunk-relative "line N" / "lines N-M" references into file line numbers."""
+    def shift(m):
+        out = f"{m.group(1)}{int(m.group(2)) + offset}"
+        if m.group(4):
+            out += f"{m.group(3)}{int(m.group(4)) + offset}"
+        return out
+    return LINE_REFERENCE.sub(shift, text) if offset else text
+
+
+def merge_prompt(path: str, findings: list, final: bool) -> str:
+    joined = "\n\n".join(findings)
+    if final:
+        return (
+            f"Below are findings from analyzing the file {path} part by part. Merge them into one "
+            f"report: a short summary, then issues ordered by severity with line numbers, then "
+            f"improvements and possible fixes. Drop duplicates.\n\n{joined}"
+        )
+    return f"Merge these findings about the file {path} into one list, keeping line numbers and dropping duplicates.\n\n{joined}"
+
+
+# On average one definition in this many may end a chunk.
+CUT_EVERY = 4
+
+
+def is_cut_point(line: str) -> bool:
+    # Chosen by the definition's own text, not by its distance from the last
+    # cut, so lines added or removed in one chunk don't move every later cut.
+    return zlib.crc32(line.strip().encode("utf-8")) % CUT_EVERY == 0
+
+
+def iter_chunks(lines, max_lines: int = ANALYSIS_CHUNK_LINES, overlap: int = ANALYSIS_CHUNK_OVERLAP,
+                max_chars: int = ANALYSIS_CHUNK_CHARS):
+    """
+    Split an iterable of lines into Chunks without holding more than one
+    chunk in memory. Once a chunk has a quarter of `max_lines` it ends
+    before a definition picked by is_cut_point (or before any definition
+    once it has half), decorators included. Because of that, an edit
+    inside one function normally changes only its own chunk.
+    """
+    overlap = min(overlap, max_lines // 4)
+    buf, size, start, index = [], 0, 1, 0
+    for line in lines:
+        head = 0
+        if BOUNDARY.match(line):
+            # Decorators directly above belong with the definition.
+            head = len(buf)
+            while head and DECORATOR.match(buf[head - 1]):
+                head -= 1
+        if head and head >= max_lines // 4 and (is_cut_point(line) or head >= max_lines // 2):
+            yield Chunk(index, start, start + head - 1, "".join(buf[:head]))
+            index += 1
+            start += head
+            buf = buf[head:]
+            size = sum(len(l) for l in buf)
+        elif len(buf) >= max_lines or size >= max_chars:
+            yield Chunk(index, start, start + len(buf) - 1, "".join(buf))
+            index += 1
+            kept = buf[-overlap:] if overlap and len(buf) > overlap else []
+            start += len(buf) - len(kept)
+            buf = kept
+            size = sum(len(l) for l in buf)
+        buf.append(line)
+        size += len(line)
+    if buf:
+        yield Chunk(index, start, start + len(buf) - 1, "".join(buf))
+
+
+def read_chunks(path: str):
+    with open(path, "r", encoding="utf-8", errors="replace") as f:
+        yield from iter_chunks(f)
+
+
+class FileAnalyzer:
+    """
+    Map-reduce analysis of a file. Small files get the single-prompt
+    analysis as before. Larger ones are read and split lazily, each chunk is
+    analyzed on its own (at most `max_parallel` at a time, so only that many
+    chunks are in memory), and the findings are merged into one report.
+    """
+
+    def __init__(self, client, cache=None, max_parallel: int = ANALYSIS_MAX_PARALLEL):
+        self.client = client
+        self.cache = cache
+        self.max_parallel = max_parallel
+
+    async def _file_key(self, path: str):
+        if self.cache is None or not self.cache.enabled:
+            return None
+        digest = await asyncio.to_thread(file_digest, path)
+        settings = f"{ANALYSIS_CHUNK_LINES}:{ANALYSIS_CHUNK_OVERLAP}:{ANALYSIS_CHUNK_CHARS}"
+        return content_key(ANALYSIS_PROMPT_VERSION, settings, self.client.model_name, "file", path, digest)
+
+    def _cached_report(self, key):
+        value = self.cache.get("file", key) if key else None
+        return json.loads(value) if value else None
+
+    def _store_report(self, key, path: str, analysis: str, chunks: int):
+        if key and not analysis.startswith(ERROR_PREFIX):
+            self.cache.put("file", key, path, json.dumps({"analysis": analysis, "chunks": chunks}))
+
+    async def analyze(self, path: str) -> dict:
+        key = await self._file_key(path)
+        cached = self._cached_report(key)
+        if cached:
+            return dict(cached, cached=True)
+
+        chunks, first, rest = await self._open(path)
+        if rest is None:
+            analysis = await self.client.chat(analyze_prompt(path, first.text), max_tokens=ANALYSIS_REPORT_TOKENS)
+            count = 1
+        else:
+            findings = await self._map(path, chunks, [first, rest])
+            count = len(findings)
+            analysis = self._failure(findings)
+            if not analysis:
+                prompt = merge_prompt(path, await self._reduce(path, findings), final=True)
+                analysis = await self.client.chat(prompt, max_tokens=ANALYSIS_REPORT_TOKENS)
+        self._store_report(key, path, analysis, count)
+        return {"analysis": analysis, "chunks": count, "cached": False}
+
+    async def stream(self, path: str):
+        """Like analyze(), streaming the final report as it is generated."""
+        key = await self._file_key(path)
+        cached = self._cached_report(key)
+        if cached:
+            yield cached["analysis"]
+            return
+
+        chunks, first, rest = await self._open(path)
+        if rest is None:
+            prompt, count = analyze_prompt(path, first.text), 1
+        else:
+            findings = await self._map(path, chunks, [first, rest])
+            count = len(findings)
+            failed = self._failure(findings)
+            if failed:
+                yield failed
+                return
+            prompt = merge_prompt(path, await self._reduce(path, findings), final=True)
+        parts = []
+        async for delta in self.client.stream(prompt, max_tokens=ANALYSIS_REPORT_TOKENS):
+            parts.append(delta)
+            yield delta
+        self._store_report(key, path, "".join(parts), count)
+
+    async def _open(self, path: str):
+        # File reads happen on a worker thread, one chunk at a time.
+        chunks = read_chunks(path)
+        first = await asyncio.to_thread(next, chunks, None) or Chunk(0, 1, 0, "")
+        rest = await asyncio.to_thread(next, chunks, None)
+        return chunks, first, rest
+
+    async def _map(self, path: str, chunks, pending: list) -> list:
+        slots = asyncio.Semaphore(self.max_parallel)
+        tasks = []
+
+        async def run(chunk: Chunk):
+            try:
+                return chunk.start, chunk.end, await self._analyze_chunk(path, chunk)
+            finally:
+                slots.release()
+
+        try:
+            while True:
+                chunk = pending.pop(0) if pending else await asyncio.to_thread(next, chunks, None)
+                if chunk is None:
+                    break
+                await slots.acquire()
+                tasks.append(asyncio.ensure_future(run(chunk)))
+            return await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            raise
+        finally:
+            chunks.close()
+
+    async def _analyze_chunk(self, path: str, chunk: Chunk) -> str:
+        prompt = chunk_prompt(path, chunk)
+        key = None
+        if self.cache is not None and self.cache.enabled:
+            key = content_key(ANALYSIS_PROMPT_VERSION, self.client.model_name, "chunk", str(ANALYSIS_CHUNK_TOKENS), prompt)
+            cached = self.cache.get("chunk", key)
+            if cached is not None:
+                return cached
+        text = await self.client.chat(prompt, max_tokens=ANALYSIS_CHUNK_TOKENS)
+        if key and not text.startswith(ERROR_PREFIX):
+            self.cache.put("chunk", key, path, text)
+        return text
+
+    @staticmethod
+    def _failure(findings: list):
+        # Merging error messages into a "report" would only hide them.
+        errors = [text for _, _, text in findings if text.startswith(ERROR_PREFIX)]
+        if errors and len(errors) == len(findings):
+            return errors[0]
+        if errors:
+            return f"{ERROR_PREFIX}{len(errors)} of {len(findings)} parts failed to analyze.\n{errors[0]}"
+        return None
+
+    async def _reduce(self, path: str, findings: list) -> list:
+        """Merge findings in rounds until they fit one final prompt."""
+        texts = [
+            f"Lines {start}-{end}:\n{shift_line_numbers(text.strip(), start - 1)}"
+            for start, end, text in findings
+            if not text.strip().lower().startswith("no issues")
+        ] or ["No issues found in any part."]
+
+        while sum(len(t) for t in texts) > ANALYSIS_REDUCE_CHARS and len(texts) > 1:
+            batches, batch, size = [], [], 0
+            for text in texts:
+                if batch and size + len(text) > ANALYSIS_REDUCE_CHARS:
+                    batches.append(batch)
+                    batch, size = [], 0
+                batch.append(text)
+                size += len(text)
+            batches.append(batch)
+            if len(batches) == len(texts):
+                # Every finding is too big to pair up; merge them two at a time.
+                batches = [texts[i:i + 2] for i in range(0, len(texts), 2)]
+            slots = asyncio.Semaphore(self.max_parallel)
+
+            async def merge(batch):
+                async with slots:
+                    return await self.client.chat(merge_prompt(path, batch, final=False), max_tokens=ANALYSIS_CHUNK_TOKENS)
+
+            texts = await asyncio.gather(*(merge(batch) for batch in batches))
+        return texts
@@ -0,0 +1,136 @@
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+
+ANALYSIS_CACHE = os.environ.get("ANALYSIS_CACHE", "on").lower() not in ("0", "false", "no", "off")
+ANALYSIS_CACHE_DB = os.environ.get("ANALYSIS_CACHE_DB", "analysis_cache.db")
+ANALYSIS_CACHE_MAX_BYTES = int(os.environ.get("ANALYSIS_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+
+def content_key(*parts: str) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class AnalysisCache:
+    """
+    SQLite store of analysis results. Whole-file reports ("file") are keyed
+    by the file's content hash and chunk findings ("chunk") by the chunk
+    prompt, both together with the model and prompt version, so a result is
+    reused exactly as long as it would come out the same. When the file
+    grows past `max_bytes` the least recently used entries go first.
+    """
+
+    def __init__(self, path: str = ANALYSIS_CACHE_DB, max_bytes: int = ANALYSIS_CACHE_MAX_BYTES,
+                 enabled: bool = ANALYSIS_CACHE):
+        self.enabled = enabled
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = {"file": 0, "chunk": 0}
+        self.misses = {"file": 0, "chunk": 0}
+        self.stores = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = None
+        self.size = 0
+        if not enabled:
+            return
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS analyses (
+                key TEXT PRIMARY KEY,
+                kind TEXT NOT NULL,
+                path TEXT NOT NULL,
+                value TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_accessed ON analyses (accessed)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS analyses_path ON analyses (path)")
+        self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+
+    def get(self, kind: str, key: str):
+        if self._db is None:
+            return None
+        with self._lock:
+            row = self._db.execute("SELECT value FROM analyses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses[kind] += 1
+                return None
+            self._db.execute("UPDATE analyses SET accessed = ? WHERE key = ?", (time.time(), key))
+            self.hits[kind] += 1
+            return row[0]
+
+    def put(self, kind: str, key: str, path: str, value: str):
+        if self._db is None:
+            return
+        now = time.time()
+        size = len(value.encode("utf-8"))
+        with self._lock:
+            self._remove(key)
+            self._db.execute(
+                "INSERT INTO analyses (key, kind, path, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, kind, path, value, size, now, now),
+            )
+            self.size += size
+            self.stores += 1
+            while self.size > self.max_bytes:
+                row = self._db.execute("SELECT key FROM analyses ORDER BY accessed LIMIT 1").fetchone()
+                if row is None:
+                    break
+                self._remove(row[0])
+                self.evictions += 1
+
+    def _remove(self, key: str):
+        row = self._db.execute("SELECT size FROM analyses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM analyses WHERE key = ?", (key,))
+            self.size -= row[0]
+
+    def purge(self, path: str = None) -> int:
+        """Drop every entry, or only those for `path`. Returns how many went."""
+        if self._db is None:
+            return 0
+        with self._lock:
+            if path is None:
+                removed = self._db.execute("DELETE FROM analyses").rowcount
+            else:
+                removed = self._db.execute("DELETE FROM analyses WHERE path = ?", (path,)).rowcount
+            self.size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM analyses").fetchone()[0]
+            return removed
+
+    def stats(self) -> dict:
+        entries = {"file": 0, "chunk": 0}
+        if self._db is not None:
+            with self._lock:
+                for kind, count in self._db.execute("SELECT kind, COUNT(*) FROM analyses GROUP BY kind"):
+                    entries[kind] = count
+        lookups = sum(self.hits.values()) + sum(self.misses.values())
+        return {
+            "enabled": self.enabled,
+            "path": self.path if self.enabled else None,
+            "entries": entries,
+            "bytes": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(sum(self.hits.values()) / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+        }
@@ -1,17 +1,38 @@
 from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-from model_client import ModelClient
-from utils import apply_patch_to_file, run_shell_command
+from model_client import AsyncModelClient
+from metrics import REGISTRY, CONTENT_TYPE, SERIALIZE_SECONDS, MetricsMiddleware, gauge
+from analysis import FileAnalyzer
+from analysis_cache import AnalysisCache
+from batch import batch_events, ANALYSIS_BATCH_MAX_FILES, ANALYSIS_BATCH_WORKERS
+from utils import apply_patch_to_file, run_shell_command, stream_shell_command
 import os
+import json
+import time
 import uvicorn
 
-app = FastAPI(title="MyLocalAI Enhanced")
+OLLAMA_IN_FLIGHT = gauge("upstream_in_flight", "Generations running against the Ollama host.")
+OLLAMA_QUEUED = gauge("upstream_queued", "Generations waiting for the Ollama host's concurrency limit.")
+ANALYSIS_CACHE_SIZE = gauge("analysis_cache_size", "Analysis cache contents, by unit.", ("unit",))
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = super().render(content)
+        SERIALIZE_SECONDS.observe(time.perf_counter() - start, "json")
+        return body
+
+app = FastAPI(title="MyLocalAI Enhanced", default_response_class=TimedJSONResponse)
+app.add_middleware(MetricsMiddleware)
 
 # Choose backend: 'ollama' (recommended) or 'local' (transformers)
 MODEL_BACKEND = os.environ.get("MLAI_BACKEND", "ollama")
 MODEL_NAME = os.environ.get("MLAI_MODEL", "deepseek-coder-7b")
 
-client = ModelClient(backend=MODEL_BACKEND, model_name=MODEL_NAME)
+client = AsyncModelClient(backend=MODEL_BACKEND, model_name=MODEL_NAME)
+analysis_cache = AnalysisCache()
+analyzer = FileAnalyzer(client, cache=analysis_cache)
 
 class Prompt(BaseModel):
     text: str
@@ -21,37 +42,119 @@ class Prompt(BaseModel):
 class FileRequest(BaseModel):
     path: str
 
+class BatchRequest(BaseModel):
+    paths: list[str] = []  # files and/or directories
+    directory: str | None = None
+    include: list[str] = []  # globs, e.g. "*.py" or "src/**/*.js"
+    exclude: list[str] = []
+    max_files: int = ANALYSIS_BATCH_MAX_FILES
+    workers: int = ANALYSIS_BATCH_WORKERS
+
 class PatchRequest(BaseModel):
     patch: str  # unified diff
+    check: bool = False  # only report whether (and how) it would apply
+    root: str = "."  # paths in the patch are relative to this
 
 class CommandRequest(BaseModel):
     command: str
+    cwd: str | None = None
+
+class PurgeRequest(BaseModel):
+    path: str | None = None  # only this file's entries; all when omitted
+
+def ndjson_events(events):
+    """Stream dicts as newline-delimited JSON."""
+    async def body():
+        encoding = 0.0
+        try:
+            async for event in events:
+                start = time.perf_counter()
+                line = json.dumps(event) + "\n"
+                encoding += time.perf_counter() - start
+                yield line
+        finally:
+            SERIALIZE_SECONDS.observe(encoding, "ndjson")
+    return StreamingResponse(body(), media_type="application/x-ndjson")
+
+def ndjson_response(chunks):
+    """Stream text chunks as newline-delimited JSON: {"delta": ...} lines, then {"done": true}."""
+    async def events():
+        async for chunk in chunks:
+            yield {"delta": chunk}
+        yield {"done": True}
+    return ndjson_events(events())
+
+@app.on_event("shutdown")
+async def shutdown():
+    await client.aclose()
 
 @app.post("/chat")
-def chat(prompt: Prompt):
-    resp = client.chat(prompt.text, context=prompt.context, max_tokens=prompt.max_tokens)
+async def chat(prompt: Prompt):
+    resp = await client.chat(prompt.text, context=prompt.context, max_tokens=prompt.max_tokens)
     return {"response": resp}
 
+@app.post("/chat/stream")
+async def chat_stream(prompt: Prompt):
+    return ndjson_response(client.stream(prompt.text, context=prompt.context, max_tokens=prompt.max_tokens))
+
 @app.post("/analyze_file")
-def analyze_file(req: FileRequest):
+async def analyze_file(req: FileRequest):
     if not os.path.isfile(req.path):
         return {"error": "file not found", "path": req.path}
-    with open(req.path, "r", encoding="utf-8") as f:
-        content = f.read()
-    prompt = f"Analyze this file and list issues, improvements and possible fixes. File path: {req.path}\n\n{content}"
-    resp = client.chat(prompt, max_tokens=1024)
-    return {"analysis": resp}
+    return await analyzer.analyze(req.path)
+
+@app.post("/analyze_file/stream")
+async def analyze_file_stream(req: FileRequest):
+    if not os.path.isfile(req.path):
+        return {"error": "file not found", "path": req.path}
+    return ndjson_response(analyzer.stream(req.path))
+
+@app.post("/analyze_batch")
+async def analyze_batch(req: BatchRequest):
+    paths = req.paths + ([req.directory] if req.directory else [])
+    if not paths:
+        return {"error": "no paths or directory given"}
+    workers = max(1, min(req.workers, ANALYSIS_BATCH_WORKERS))
+    max_files = max(1, min(req.max_files, ANALYSIS_BATCH_MAX_FILES))
+    return ndjson_events(batch_events(analyzer, paths, req.include, req.exclude, max_files, workers))
+
+@app.get("/stats")
+async def stats():
+    return {"ollama": client.stats(), "analysis_cache": analysis_cache.stats()}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus text format. Gauges are read from the components' stats at scrape time."""
+    concurrency = client.limiter.stats()
+    OLLAMA_IN_FLIGHT.set(concurrency["active"])
+    OLLAMA_QUEUED.set(concurrency["waiting"])
+    cache = analysis_cache.stats()
+    ANALYSIS_CACHE_SIZE.set(sum(cache["entries"].values()), "entries")
+    ANALYSIS_CACHE_SIZE.set(cache["bytes"], "bytes")
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.get("/analysis_cache/stats")
+async def analysis_cache_stats():
+    return analysis_cache.stats()
+
+@app.post("/analysis_cache/purge")
+async def analysis_cache_purge(req: PurgeRequest):
+    return {"purged": analysis_cache.purge(req.path)}
 
 @app.post("/apply_patch")
 def apply_patch(req: PatchRequest):
-    result = apply_patch_to_file(req.patch)
+    result = apply_patch_to_file(req.patch, root=req.root, check=req.check)
     return {"result": result}
 
 @app.post("/run_command")
-def run_command(req: CommandRequest):
-    out = run_shell_command(req.command)
+async def run_command(req: CommandRequest):
+    out = await run_shell_command(req.command, cwd=req.cwd)
     return {"output": out}
 
+@app.post("/run_command/stream")
+async def run_command_stream(req: CommandRequest):
+    return ndjson_events(stream_shell_command(req.command, cwd=req.cwd))
+
 
 if __name__ == "__main__":
     # When running directly (e.g., on Replit), bind to all interfaces
@@ -0,0 +1,160 @@
+import os
+import time
+import asyncio
+from fnmatch import fnmatch
+
+from model_client import ERROR_PREFIX
+
+# Files analyzed at once in a batch; each file's chunks are also bounded by
+# ANALYSIS_MAX_PARALLEL, and the Ollama host by OLLAMA_MAX_CONCURRENCY.
+ANALYSIS_BATCH_WORKERS = int(os.environ.get("ANALYSIS_BATCH_WORKERS", "4"))
+ANALYSIS_BATCH_MAX_FILES = int(os.environ.get("ANALYSIS_BATCH_MAX_FILES", "500"))
+ANALYSIS_BATCH_MAX_FILE_BYTES = int(os.environ.get("ANALYSIS_BATCH_MAX_FILE_BYTES", str(2 * 1024 * 1024)))
+
+# Directories never worth reviewing, whatever .gitignore says.
+SKIP_DIRS = {
+    ".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv", "venv", "env",
+    ".mypy_cache", ".pytest_cache", ".ruff_cache", ".tox", ".idea", ".vscode", "dist", "build",
+}
+
+
+def load_gitignore(root: str) -> list:
+    """Patterns from root/.gitignore. Negations and nested .gitignore files aren't supported."""
+    try:
+        with open(os.path.join(root, ".gitignore"), "r", encoding="utf-8", errors="replace") as f:
+            lines = [line.strip() for line in f]
+    except OSError:
+        return []
+    return [line for line in lines if line and not line.startswith(("#", "!"))]
+
+
+def matches(rel: str, patterns: list) -> bool:
+    name = rel.rsplit("/", 1)[-1]
+    for pattern in patterns:
+        pattern = pattern.rstrip("/")
+        if pattern.startswith("/"):
+            candidates = [pattern[1:]]
+        else:
+            candidates = [pattern] if "/" in pattern else [pattern, "*/" + pattern]
+        for candidate in candidates:
+            # fnmatch's * already crosses "/", so **/ only needs to allow zero directories.
+            if fnmatch(rel, candidate) or fnmatch(rel, candidate.replace("**/", "")):
+                return True
+        if fnmatch(name, pattern):
+            return True
+    return False
+
+
+def is_binary(path: str) -> bool:
+    with open(path, "rb") as f:
+        return b"\0" in f.read(8192)
+
+
+def check_file(path: str):
+    """Why `path` can't be analyzed, or None if it can."""
+    try:
+        if not os.path.isfile(path):
+            return "not a file"
+        if os.path.getsize(path) > ANALYSIS_BATCH_MAX_FILE_BYTES:
+            return "too large"
+        if is_binary(path):
+            return "binary"
+    except OSError as e:
+        return str(e)
+    return None
+
+
+def walk(root: str, include: list, exclude: list):
+    ignored = load_gitignore(root) + exclude
+    for dirpath, dirnames, filenames in os.walk(root):
+        rel_dir = os.path.relpath(dirpath, root).replace(os.sep, "/")
+        rel_dir = "" if rel_dir == "." else rel_dir + "/"
+        dirnames[:] = sorted(
+            d for d in dirnames
+            if d not in SKIP_DIRS and not matches(rel_dir + d, ignored)
+        )
+        for name in sorted(filenames):
+            rel = rel_dir + name
+            if matches(rel, ignored) or (include and not matches(rel, include)):
+                continue
+            yield os.path.join(dirpath, name)
+
+
+def collect_files(paths: list, include: list, exclude: list, max_files: int = ANALYSIS_BATCH_MAX_FILES):
+    """
+    Expand `paths` (files or directories) into the files to analyze.
+    Directories are walked, skipping SKIP_DIRS, the root's .gitignore and
+    `exclude`, and keeping only `include` matches when given. The walk stops
+    at the first file past `max_files`. Returns (files, skipped, truncated)
+    where skipped is a list of (path, reason).
+    """
+    files, skipped, seen = [], [], set()
+    for path in paths:
+        candidates = walk(path, include, exclude) if os.path.isdir(path) else [path]
+        for candidate in candidates:
+            real = os.path.realpath(candidate)
+            if real in seen:
+                continue
+            seen.add(real)
+            reason = check_file(candidate)
+            if reason:
+                skipped.append((candidate, reason))
+            elif len(files) >= max_files:
+                return files, skipped, True
+            else:
+                files.append(candidate)
+    return files, skipped, False
+
+
+async def analyze_batch(analyzer, files: list, workers: int = ANALYSIS_BATCH_WORKERS):
+    """Analyze `files` with a pool of `workers`, yielding each result as it finishes."""
+    pending = asyncio.Queue()
+    for path in files:
+        pending.put_nowait(path)
+    finished = asyncio.Queue()
+
+    async def worker():
+        while not pending.empty():
+            path = pending.get_nowait()
+            try:
+                result = await analyzer.analyze(path)
+            except Exception as e:
+                result = {"analysis": f"{ERROR_PREFIX}{e}", "chunks": 0, "cached": False}
+            await finished.put(dict(result, path=path))
+
+    tasks = [asyncio.ensure_future(worker()) for _ in range(min(workers, len(files)))]
+    try:
+        for _ in files:
+            yield await finished.get()
+    finally:
+        # The client went away (or we're done): stop analyzing.
+        for task in tasks:
+            task.cancel()
+
+
+async def batch_events(analyzer, paths: list, include: list, exclude: list, max_files: int, workers: int):
+    """NDJSON events for a batch: skipped files, start, one per analyzed file, summary."""
+    started = time.monotonic()
+    files, skipped, truncated = await asyncio.to_thread(collect_files, paths, include, exclude, max_files)
+    for path, reason in skipped:
+        yield {"event": "skipped", "path": path, "reason": reason}
+    yield {"event": "start", "files": len(files), "skipped": len(skipped), "truncated": truncated}
+
+    done = failed = cached = 0
+    async for result in analyze_batch(analyzer, files, workers):
+        done += 1
+        if result["analysis"].startswith(ERROR_PREFIX):
+            failed += 1
+        elif result.get("cached"):
+            cached += 1
+        yield dict(result, event="file", done=done, total=len(files))
+
+    yield {
+        "event": "summary",
+        "analyzed": done - failed,
+        "failed": failed,
+        "cached": cached,
+        "skipped": len(skipped),
+        "truncated": truncated,
+        "elapsed_s": round(time.monotonic() - started, 2),
+    }
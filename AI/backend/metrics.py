@@ -0,0 +1,157 @@
+import math
+import time
+from bisect import bisect_left
+
+# Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Generation latencies, from a cached answer to a long local completion.
+LATENCY_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Encoding a response body or an NDJSON stream.
+SERIALIZE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def lines(self):
+        for labels, value in self._values.items():
+            yield f"{self.name}{_labels(self.labels, labels)} {_number(value)}"
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def dec(self, *labels, amount: float = 1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Counter):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *labels):
+        # labels -> [per-bucket counts (last is +Inf), sum]
+        series = self._values.setdefault(labels, [[0] * (len(self.buckets) + 1), 0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def lines(self):
+        for labels, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                le = 'le="' + _number(float(bound)) + '"'
+                yield f"{self.name}_bucket{_labels(self.labels, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_labels(self.labels, labels)} {_number(total)}"
+            yield f"{self.name}_count{_labels(self.labels, labels)} {cumulative}"
+
+
+class Registry:
+    """
+    This server's metrics. Updating one is a dict operation on the event
+    loop; all formatting happens when /metrics is scraped.
+    """
+
+    def __init__(self):
+        self._metrics = {}
+
+    def add(self, metric):
+        return self._metrics.setdefault(metric.name, metric)
+
+    def render(self) -> str:
+        out = []
+        for metric in self._metrics.values():
+            out.append(f"# HELP {metric.name} {metric.help}")
+            out.append(f"# TYPE {metric.name} {metric.kind}")
+            out.extend(metric.lines())
+        return "\n".join(out) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, help: str, labels: tuple = ()) -> Counter:
+    return REGISTRY.add(Counter(name, help, labels))
+
+
+def gauge(name: str, help: str, labels: tuple = ()) -> Gauge:
+    return REGISTRY.add(Gauge(name, help, labels))
+
+
+def histogram(name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+    return REGISTRY.add(Histogram(name, help, labels, buckets))
+
+
+HTTP_REQUESTS = counter("http_requests_total", "HTTP requests served.", ("method", "route", "status"))
+HTTP_DURATION = histogram(
+    "http_request_duration_seconds", "Time from request to the last byte of the response.", ("method", "route")
+)
+HTTP_IN_PROGRESS = gauge("http_requests_in_progress", "HTTP requests being served.")
+SERIALIZE_SECONDS = histogram(
+    "response_serialize_seconds", "Time spent encoding a response body, per response.", ("format",), SERIALIZE_BUCKETS
+)
+
+
+class MetricsMiddleware:
+    """ASGI middleware counting requests and timing them to the end of the body, streams included."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status = 500
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_PROGRESS.inc()
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            # The route's path template, so path parameters don't make new series.
+            route = getattr(scope.get("route"), "path", None) or "unmatched"
+            HTTP_REQUESTS.inc(scope["method"], route, str(status))
+            HTTP_DURATION.observe(time.perf_counter() - start, scope["method"], route)
@@ -1,82 +1,421 @@
 import os
 import requests
 import json
+import time
+import asyncio
+import threading
 from typing import Optional
+from requests.adapters import HTTPAdapter
+
+import httpx
+
+from metrics import counter, histogram
 
 # Remote Ollama base URL and optional API key
 OLLAMA_API = os.environ.get("OLLAMA_API", "http://127.0.0.1:11434")
 OLLAMA_API_KEY = os.environ.get("OLLAMA_API_KEY", "")
+OLLAMA_TIMEOUT = float(os.environ.get("OLLAMA_TIMEOUT", "120"))
+OLLAMA_CONNECT_TIMEOUT = float(os.environ.get("OLLAMA_CONNECT_TIMEOUT", "5"))
+OLLAMA_POOL_SIZE = int(os.environ.get("OLLAMA_POOL_SIZE", "16"))
+# Generations allowed to run at once against one Ollama host; the rest wait.
+OLLAMA_MAX_CONCURRENCY = int(os.environ.get("OLLAMA_MAX_CONCURRENCY", "2"))
+
+# Endpoints probed in order until one answers. Ollama's native API first,
+# then the OpenAI-style routes some proxies expose instead.
+ENDPOINTS = [
+    '/api/chat',
+    '/api/generate',
+    '/v1/chat/completions',
+    '/v1/completions',
+    '/v1/complete',
+    '/v1/responses',
+]
+
+# Endpoints that stream newline-delimited JSON when asked to.
+STREAMING_ENDPOINTS = ('/api/chat', '/api/generate')
+
+# Replies starting with this are failures reported as text, not model output.
+ERROR_PREFIX = "Error calling Ollama API: "
+
+# Status codes meaning "this server doesn't speak that endpoint", as
+# opposed to the server being down or the request itself being bad.
+UNSUPPORTED_STATUS = {404, 405, 501}
+
+UPSTREAM_SECONDS = histogram("upstream_request_seconds", "Time per Ollama generation, to the last token.", ("model", "outcome"))
+UPSTREAM_TTFT = histogram("upstream_time_to_first_token_seconds", "Time from starting a generation to its first token.", ("model",))
+QUEUE_WAIT = histogram("upstream_queue_wait_seconds", "Time spent waiting for the Ollama host's concurrency limit.")
+LLM_TOKENS = counter(
+    "llm_tokens_total", "Tokens per model, as reported by the server or estimated when it doesn't say.", ("model", "kind")
+)
+AI_ERRORS = counter("ai_errors_total", "Generations that failed, by exception class.", ("error_class",))
+
+
+def build_payload(endpoint: str, model: str, prompt: str, max_tokens: int, stream: bool = False) -> dict:
+    if endpoint == '/api/chat':
+        return {"model": model, "messages": [{"role": "user", "content": prompt}],
+                "stream": stream, "options": {"num_predict": max_tokens}}
+    if endpoint == '/api/generate':
+        return {"model": model, "prompt": prompt, "stream": stream, "options": {"num_predict": max_tokens}}
+    if endpoint == '/v1/chat/completions':
+        return {"model": model, "messages": [{"role": "user", "content": prompt}], "max_tokens": max_tokens}
+    if endpoint == '/v1/responses':
+        return {"model": model, "input": prompt, "max_output_tokens": max_tokens}
+    return {"model": model, "prompt": prompt, "max_tokens": max_tokens}
+
+
+def _choice_text(data):
+    choice = data['choices'][0]
+    # choice may contain 'text' or 'message'
+    if 'message' in choice:
+        message = choice['message']
+        return message.get('content') if isinstance(message, dict) else message
+    return choice.get('text')
+
+
+def _output_text(data):
+    out = data['output']
+    if isinstance(out, list):
+        texts = []
+        for item in out:
+            if isinstance(item, dict):
+                for part in item.get('content') or []:
+                    if isinstance(part, dict) and isinstance(part.get('text'), str):
+                        texts.append(part['text'])
+            else:
+                texts.append(str(item))
+        return '\n'.join(texts)
+    return str(out)
+
+
+# Ways of pulling the generated text out of a response body. The first one
+# that works for a server is remembered and used from then on.
+EXTRACTORS = {
+    'ollama_chat': lambda data: data['message']['content'],
+    'ollama_generate': lambda data: data['response'],
+    'completion': lambda data: data['completion'],
+    'choices': _choice_text,
+    'output': _output_text,
+}
+
+
+def detect_shape(data) -> Optional[str]:
+    if not isinstance(data, dict):
+        return None
+    for name, extract in EXTRACTORS.items():
+        try:
+            if isinstance(extract(data), str):
+                return name
+        except (KeyError, IndexError, TypeError, AttributeError):
+            continue
+    return None
+
+
+def stream_delta(data: dict) -> str:
+    """Text carried by one line of an Ollama NDJSON stream."""
+    if data.get('error'):
+        raise RuntimeError(data['error'])
+    message = data.get('message')
+    if isinstance(message, dict):
+        return message.get('content') or ''
+    return data.get('response') or ''
+
+
+def usage_counts(data: dict):
+    """(prompt, completion) token counts a response body reports, or None."""
+    if 'eval_count' in data:
+        return data.get('prompt_eval_count') or 0, data['eval_count']
+    usage = data.get('usage')
+    if isinstance(usage, dict):
+        prompt = usage.get('prompt_tokens', usage.get('input_tokens'))
+        completion = usage.get('completion_tokens', usage.get('output_tokens'))
+        if prompt is not None or completion is not None:
+            return prompt or 0, completion or 0
+    return None
+
+
+def with_context(prompt: str, context: Optional[str]) -> str:
+    if context:
+        return f"Context:\n{context}\n\n{prompt}"
+    return prompt
+
+
+class EndpointUnsupported(Exception):
+    pass
+
+
+# base URL -> (endpoint, shape), shared by every client in the process.
+_discovered = {}
+_discovery_lock = threading.Lock()
 
 
 class ModelClient:
     def __init__(self, backend='ollama', model_name='deepseek-coder-7b'):
         self.backend = backend
         self.model_name = model_name
+        self.base = OLLAMA_API.rstrip('/')
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=OLLAMA_POOL_SIZE)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if OLLAMA_API_KEY:
+            self.session.headers['Authorization'] = f"Bearer {OLLAMA_API_KEY}"
 
     def chat(self, prompt: str, context: Optional[str] = None, max_tokens: int = 512) -> str:
         if self.backend == 'ollama':
-            return self._ollama_chat(prompt, max_tokens)
+            return self._ollama_chat(with_context(prompt, context), max_tokens)
         else:
             return "Local transformers mode not implemented in this starter. Install Ollama or set MLAI_BACKEND=ollama."
 
+    def _post(self, endpoint: str, prompt: str, max_tokens: int):
+        r = self.session.post(
+            f"{self.base}{endpoint}",
+            json=build_payload(endpoint, self.model_name, prompt, max_tokens),
+            timeout=(OLLAMA_CONNECT_TIMEOUT, OLLAMA_TIMEOUT),
+        )
+        if r.status_code in UNSUPPORTED_STATUS:
+            raise EndpointUnsupported(f"{endpoint} -> HTTP {r.status_code}")
+        r.raise_for_status()
+        return r
+
+    def _extract(self, r, shape: Optional[str]) -> str:
+        try:
+            data = r.json()
+        except ValueError:
+            # Fallback: return raw text body
+            return r.text
+        if shape:
+            try:
+                return EXTRACTORS[shape](data)
+            except (KeyError, IndexError, TypeError, AttributeError):
+                pass
+        return r.text or json.dumps(data)
+
+    def _discover(self, prompt: str, max_tokens: int) -> str:
+        """
+        Find the first endpoint this server answers on, using the real
+        request as the probe, and remember it (and its response shape) for
+        the base URL. Only "not supported" answers move on to the next
+        endpoint; a connection error or timeout means the server itself is
+        the problem, so probing stops there.
+        """
+        skipped = []
+        for ep in ENDPOINTS:
+            try:
+                r = self._post(ep, prompt, max_tokens)
+            except EndpointUnsupported as e:
+                skipped.append(str(e))
+                continue
+            try:
+                shape = detect_shape(r.json())
+            except ValueError:
+                shape = None
+            with _discovery_lock:
+                _discovered[self.base] = (ep, shape)
+            return self._extract(r, shape)
+        raise EndpointUnsupported("no supported endpoint (" + "; ".join(skipped) + ")")
+
     def _ollama_chat(self, prompt: str, max_tokens: int):
         """
         Call a remote Ollama HTTP API. The environment variable `OLLAMA_API`
         can point to a remote Ollama server (e.g. a Replit proxy). If
         `OLLAMA_API_KEY` is set, it will be sent as a Bearer token.
-        This function tries common Ollama endpoints and attempts to
-        extract a usable string from the response.
+        Requests reuse pooled keep-alive connections, and the endpoint is
+        discovered once per base URL; it is re-probed only when the
+        remembered one stops working.
         """
-        base = OLLAMA_API.rstrip('/')
-        endpoints = [
-            '/v1/complete',
-            '/v1/completions',
-            '/v1/responses',
-        ]
-
-        headers = {}
-        if OLLAMA_API_KEY:
-            headers['Authorization'] = f"Bearer {OLLAMA_API_KEY}"
+        known = _discovered.get(self.base)
+        try:
+            if known:
+                endpoint, shape = known
+                try:
+                    return self._extract(self._post(endpoint, prompt, max_tokens), shape)
+                except (EndpointUnsupported, requests.HTTPError):
+                    with _discovery_lock:
+                        _discovered.pop(self.base, None)
+            return self._discover(prompt, max_tokens)
+        except Exception as e:
+            return f"{ERROR_PREFIX}{e}\nTried URL base: {self.base} (endpoints: {ENDPOINTS})"
+
+    def discovery(self) -> dict:
+        endpoint, shape = _discovered.get(self.base, (None, None))
+        return {"base": self.base, "endpoint": endpoint, "shape": shape}
+
+
+class HostLimiter:
+    """Per-host cap on concurrent generations, so one GPU box isn't oversubscribed."""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.served = 0
+
+    async def __aenter__(self):
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    async def __aexit__(self, *exc):
+        self.active -= 1
+        self.served += 1
+        self.semaphore.release()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "active": self.active, "waiting": self.waiting, "served": self.served}
+
+
+_host_limiters = {}
+
+
+def host_limiter(base: str) -> HostLimiter:
+    limiter = _host_limiters.get(base)
+    if limiter is None:
+        limiter = _host_limiters[base] = HostLimiter(OLLAMA_MAX_CONCURRENCY)
+    return limiter
 
-        payload = {
-            "model": self.model_name,
-            "prompt": prompt,
-            "max_tokens": max_tokens,
-        }
 
-        last_err = None
-        for ep in endpoints:
-            url = f"{base}{ep}"
+class AsyncModelClient:
+    """
+    asyncio counterpart of ModelClient for the FastAPI app. It shares the
+    endpoint discovery cache, streams tokens from Ollama's NDJSON endpoints
+    and runs at most OLLAMA_MAX_CONCURRENCY generations per Ollama host.
+    """
+
+    def __init__(self, backend='ollama', model_name='deepseek-coder-7b'):
+        self.backend = backend
+        self.model_name = model_name
+        self.base = OLLAMA_API.rstrip('/')
+        headers = {'Authorization': f"Bearer {OLLAMA_API_KEY}"} if OLLAMA_API_KEY else None
+        self.http = httpx.AsyncClient(
+            headers=headers,
+            timeout=httpx.Timeout(OLLAMA_TIMEOUT, connect=OLLAMA_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=OLLAMA_POOL_SIZE, max_keepalive_connections=OLLAMA_POOL_SIZE),
+        )
+        self.limiter = host_limiter(self.base)
+
+    async def aclose(self):
+        await self.http.aclose()
+
+    async def chat(self, prompt: str, context: Optional[str] = None, max_tokens: int = 512) -> str:
+        parts = []
+        async for delta in self.stream(prompt, context=context, max_tokens=max_tokens):
+            parts.append(delta)
+        return ''.join(parts)
+
+    async def stream(self, prompt: str, context: Optional[str] = None, max_tokens: int = 512):
+        """
+        Yield the completion as it is generated. Servers that only answer on
+        a non-streaming endpoint yield the whole text as one chunk. Errors
+        are yielded as an "Error calling Ollama API: ..." chunk, matching
+        ModelClient.chat.
+        """
+        if self.backend != 'ollama':
+            yield "Local transformers mode not implemented in this starter. Install Ollama or set MLAI_BACKEND=ollama."
+            return
+        prompt = with_context(prompt, context)
+        queued = time.perf_counter()
+        started = None
+        usage = {}
+        chars = 0
+        first = True
+        try:
+            async with self.limiter:
+                started = time.perf_counter()
+                QUEUE_WAIT.observe(started - queued)
+                async for delta in self._generate(prompt, max_tokens, usage):
+                    if first:
+                        UPSTREAM_TTFT.observe(time.perf_counter() - started, self.model_name)
+                        first = False
+                    chars += len(delta)
+                    yield delta
+        except Exception as e:
+            AI_ERRORS.inc(type(e).__name__)
+            if started is not None:
+                UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.model_name, "error")
+            yield f"{ERROR_PREFIX}{e}\nTried URL base: {self.base} (endpoints: {ENDPOINTS})"
+            return
+        UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.model_name, "ok")
+        # Roughly 4 characters a token when the server doesn't report counts.
+        LLM_TOKENS.inc(self.model_name, "prompt", amount=usage.get('prompt', len(prompt) // 4))
+        LLM_TOKENS.inc(self.model_name, "completion", amount=usage.get('completion', chars // 4))
+
+    async def _generate(self, prompt: str, max_tokens: int, usage: dict):
+        known = _discovered.get(self.base)
+        if known:
+            endpoint, shape = known
+            try:
+                async for delta in self._call(endpoint, shape, prompt, max_tokens, usage):
+                    yield delta
+                return
+            except (EndpointUnsupported, httpx.HTTPStatusError):
+                with _discovery_lock:
+                    _discovered.pop(self.base, None)
+
+        skipped = []
+        for ep in ENDPOINTS:
             try:
-                r = requests.post(url, json=payload, headers=headers or None, timeout=60)
+                async for delta in self._call(ep, None, prompt, max_tokens, usage):
+                    yield delta
+                return
+            except EndpointUnsupported as e:
+                skipped.append(str(e))
+        raise EndpointUnsupported("no supported endpoint (" + "; ".join(skipped) + ")")
+
+    async def _call(self, endpoint: str, shape: Optional[str], prompt: str, max_tokens: int, usage: dict):
+        """Yield the text of one request to `endpoint`, filling `usage` with the token counts it reports."""
+        url = f"{self.base}{endpoint}"
+        if endpoint in STREAMING_ENDPOINTS:
+            payload = build_payload(endpoint, self.model_name, prompt, max_tokens, stream=True)
+            async with self.http.stream('POST', url, json=payload) as r:
+                if r.status_code in UNSUPPORTED_STATUS:
+                    raise EndpointUnsupported(f"{endpoint} -> HTTP {r.status_code}")
                 r.raise_for_status()
-                data = r.json()
-
-                # Try common fields returned by Ollama-like APIs
-                if isinstance(data, dict):
-                    if 'completion' in data and isinstance(data['completion'], str):
-                        return data['completion']
-                    if 'output' in data:
-                        out = data['output']
-                        if isinstance(out, list):
-                            return '\n'.join(map(str, out))
-                        return str(out)
-                    if 'choices' in data and len(data['choices']) > 0:
-                        choice = data['choices'][0]
-                        # choice may contain 'text' or 'message'
-                        if isinstance(choice, dict):
-                            if 'message' in choice:
-                                return choice['message']
-                            if 'text' in choice:
-                                return choice['text']
-                # Fallback: return raw text body
-                text = r.text
-                if text:
-                    return text
-                return json.dumps(data)
-            except Exception as e:
-                last_err = e
-                continue
+                self._remember(endpoint, 'ollama_chat' if endpoint == '/api/chat' else 'ollama_generate')
+                async for line in r.aiter_lines():
+                    if not line.strip():
+                        continue
+                    data = json.loads(line)
+                    delta = stream_delta(data)
+                    if delta:
+                        yield delta
+                    if data.get('done'):
+                        self._record_usage(usage, data)
+                        break
+            return
+
+        r = await self.http.post(url, json=build_payload(endpoint, self.model_name, prompt, max_tokens))
+        if r.status_code in UNSUPPORTED_STATUS:
+            raise EndpointUnsupported(f"{endpoint} -> HTTP {r.status_code}")
+        r.raise_for_status()
+        try:
+            data = r.json()
+        except ValueError:
+            self._remember(endpoint, None)
+            yield r.text
+            return
+        if shape is None:
+            shape = detect_shape(data)
+            self._remember(endpoint, shape)
+        self._record_usage(usage, data)
+        try:
+            yield EXTRACTORS[shape](data) if shape else (r.text or json.dumps(data))
+        except (KeyError, IndexError, TypeError, AttributeError):
+            yield r.text or json.dumps(data)
+
+    @staticmethod
+    def _record_usage(usage: dict, data):
+        counts = usage_counts(data) if isinstance(data, dict) else None
+        if counts:
+            usage['prompt'], usage['completion'] = counts
 
-        return f"Error calling Ollama API: {last_err}\nTried URL base: {base} (endpoints: {endpoints})"
+    def _remember(self, endpoint: str, shape: Optional[str]):
+        with _discovery_lock:
+            _discovered[self.base] = (endpoint, shape)
 
+    def stats(self) -> dict:
+        endpoint, shape = _discovered.get(self.base, (None, None))
+        return {"base": self.base, "endpoint": endpoint, "shape": shape, "concurrency": self.limiter.stats()}
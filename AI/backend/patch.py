@@ -0,0 +1,316 @@
+import os
+import re
+import tempfile
+
+# Context lines a hunk may lose at each end and still apply, as in `patch -F`.
+PATCH_MAX_FUZZ = int(os.environ.get("PATCH_MAX_FUZZ", "2"))
+
+HUNK_HEADER = re.compile(r"@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+
+
+class PatchError(Exception):
+    pass
+
+
+class Hunk:
+    def __init__(self, old_start: int):
+        self.old_start = old_start
+        self.lines = []  # (op, text) with op in " -+", text without line ending
+        self.old_no_eol = False
+        self.new_no_eol = False
+
+    def old(self, trim_head: int = 0, trim_tail: int = 0) -> list:
+        return [text for op, text in self.lines[trim_head:len(self.lines) - trim_tail] if op != "+"]
+
+    def new(self, trim_head: int = 0, trim_tail: int = 0) -> list:
+        return [text for op, text in self.lines[trim_head:len(self.lines) - trim_tail] if op != "-"]
+
+    def context_run(self, from_end: bool) -> int:
+        ops = [op for op, _ in self.lines]
+        if from_end:
+            ops.reverse()
+        run = 0
+        for op in ops:
+            if op != " ":
+                break
+            run += 1
+        return run
+
+
+class FilePatch:
+    def __init__(self, old_path, new_path):
+        self.old_path = old_path
+        self.new_path = new_path
+        self.hunks = []
+
+    @property
+    def path(self):
+        return self.new_path if self.new_path is not None else self.old_path
+
+
+def _split_lines(text: str) -> list:
+    # Only "\n" ends a line (with an optional "\r" before it); str.splitlines()
+    # also splits on form feeds, "\u2028" and the like, which are content here.
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return [line[:-1] if line.endswith("\r") else line for line in lines]
+
+
+def _header_path(line: str):
+    path = line[4:].split("\t", 1)[0].strip()
+    if path == "/dev/null":
+        return None
+    if path.startswith('"') and path.endswith('"'):
+        path = path[1:-1]
+    return path
+
+
+def _strip_prefix(patches: list):
+    # git-style a/ and b/ prefixes, when every header has them.
+    paths = [p for fp in patches for p in (fp.old_path, fp.new_path) if p is not None]
+    if paths and all(p.startswith(("a/", "b/")) for p in paths):
+        for fp in patches:
+            fp.old_path = fp.old_path[2:] if fp.old_path else None
+            fp.new_path = fp.new_path[2:] if fp.new_path else None
+
+
+def _is_file_header(lines: list, i: int) -> bool:
+    return lines[i].startswith("--- ") and i + 1 < len(lines) and lines[i + 1].startswith("+++ ")
+
+
+def _continues_hunk(lines: list, i: int) -> bool:
+    """Whether hunk lines follow the blank lines starting at `i`."""
+    while i < len(lines) and lines[i] == "":
+        i += 1
+    return i < len(lines) and lines[i][:1] in (" ", "-", "+", "\\") and not _is_file_header(lines, i)
+
+
+def parse_patch(text: str) -> list:
+    """
+    Parse a unified diff into FilePatches. Hunk line counts are only
+    partly trusted (hand- and model-written diffs often get them wrong).
+    While a hunk's counts say more lines are due, every line is part of
+    it: a removed "-- x" followed by an added "++ y" is content, not a
+    file header, and an empty line is blank context whose leading space
+    got stripped. Past its counts, a hunk still runs until the next hunk
+    or file header.
+    """
+    lines = _split_lines(text)
+    patches = []
+    current = None
+    hunk = None
+    old_left = new_left = 0  # lines the current hunk's header says are still due
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if hunk is not None and (old_left > 0 or new_left > 0):
+            op = line[:1] or " "
+            if op in (" ", "-", "+"):
+                hunk.lines.append((op, line[1:]))
+                old_left -= op != "+"
+                new_left -= op != "-"
+                i += 1
+                continue
+        if _is_file_header(lines, i):
+            current = FilePatch(_header_path(line), _header_path(lines[i + 1]))
+            patches.append(current)
+            hunk = None
+            i += 2
+            continue
+        m = HUNK_HEADER.match(line)
+        if m:
+            if current is None:
+                raise PatchError(f"hunk before any file header at line {i + 1}")
+            hunk = Hunk(int(m.group(1)))
+            current.hunks.append(hunk)
+            old_left = int(m.group(2) or 1)
+            new_left = int(m.group(4) or 1)
+        elif hunk is not None and line.startswith("\\"):
+            # "\ No newline at end of file" applies to the line before it.
+            if hunk.lines and hunk.lines[-1][0] != "+":
+                hunk.old_no_eol = True
+            if hunk.lines and hunk.lines[-1][0] != "-":
+                hunk.new_no_eol = True
+        elif hunk is not None and line[:1] in (" ", "-", "+"):
+            hunk.lines.append((line[0], line[1:]))
+        elif hunk is not None and line == "" and _continues_hunk(lines, i):
+            hunk.lines.append((" ", ""))
+        else:
+            # diff --git, index, mode lines and commentary between files.
+            hunk = None
+        i += 1
+
+    if not patches:
+        raise PatchError("no file headers (--- / +++) found in patch")
+    for fp in patches:
+        if not fp.hunks and not (fp.old_path and fp.new_path is None):
+            raise PatchError(f"no hunks for {fp.path}")
+    _strip_prefix(patches)
+    return patches
+
+
+def _find(lines: list, needle: list, expected: int, lowest: int, loose: bool):
+    """Index nearest to `expected` (and not before `lowest`) where `needle` matches `lines`."""
+    if not needle:
+        return min(max(expected, lowest), len(lines))
+    if loose:
+        needle = [n.rstrip() for n in needle]
+    n = len(needle)
+    last = len(lines) - n
+    for distance in range(0, max(expected - lowest, last - expected) + 1):
+        for pos in (expected - distance, expected + distance) if distance else (expected,):
+            if lowest <= pos <= last:
+                window = lines[pos:pos + n]
+                if loose:
+                    window = [w.rstrip() for w in window]
+                if window == needle:
+                    return pos
+    return None
+
+
+def apply_hunks(text: str, hunks: list, path: str, max_fuzz: int = PATCH_MAX_FUZZ):
+    """
+    Apply hunks to `text`, returning (new_text, report). Each hunk is
+    looked for at its stated line plus the drift of the hunks before it,
+    then progressively further away; failing that, with trailing whitespace
+    ignored; then with up to `max_fuzz` context lines dropped at each end.
+    """
+    newline = "\r\n" if "\r\n" in text else "\n"
+    lines = _split_lines(text)
+    # New files (empty text) end with a newline unless the patch says otherwise.
+    had_eol = text.endswith(("\n", "\r")) or not text
+    drift = 0
+    lowest = 0
+    report = []
+    for number, hunk in enumerate(hunks, 1):
+        stated = max(hunk.old_start - 1, 0)
+        expected = stated + drift
+        found = None
+        for fuzz in range(0, max_fuzz + 1):
+            head = min(fuzz, hunk.context_run(False))
+            tail = min(fuzz, hunk.context_run(True))
+            if fuzz and not (head or tail):
+                break
+            old = hunk.old(head, tail)
+            for loose in (False, True):
+                pos = _find(lines, old, expected + head, lowest, loose)
+                if pos is not None:
+                    found = (pos, head, tail, fuzz, loose)
+                    break
+            if found:
+                break
+        if found is None:
+            raise PatchError(f"{path}: hunk {number} (line {hunk.old_start}) does not apply")
+        pos, head, tail, fuzz, loose = found
+        old, new = hunk.old(head, tail), hunk.new(head, tail)
+        lines[pos:pos + len(old)] = new
+        at_end = pos + len(new) >= len(lines)
+        if at_end and hunk.new_no_eol and not tail:
+            had_eol = False
+        elif at_end and hunk.old_no_eol and not tail:
+            had_eol = True
+        offset = pos - head - stated
+        drift = offset
+        lowest = pos + len(new)
+        report.append({"hunk": number, "offset": offset, "fuzz": fuzz, "whitespace": loose})
+
+    new_text = newline.join(lines)
+    if lines and had_eol:
+        new_text += newline
+    return new_text, report
+
+
+def _resolve(root: str, path: str) -> str:
+    if os.path.isabs(path):
+        raise PatchError(f"absolute path not allowed: {path}")
+    target = os.path.realpath(os.path.join(root, path))
+    try:
+        inside = os.path.commonpath([target, root]) == root
+    except ValueError:
+        inside = False
+    if not inside:
+        raise PatchError(f"path escapes the patch root: {path}")
+    return target
+
+
+def _read(target: str) -> str:
+    with open(target, "rb") as f:
+        data = f.read()
+    try:
+        return data.decode("utf-8")
+    except UnicodeDecodeError:
+        raise PatchError(f"{target} is not UTF-8 text")
+
+
+def _write_atomic(target: str, text: str):
+    directory = os.path.dirname(target)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".patch-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(text.encode("utf-8"))
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(target):
+            os.chmod(tmp, os.stat(target).st_mode & 0o7777)
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def apply_patch(patch_text: str, root: str = ".", check: bool = False) -> dict:
+    """
+    Apply a (possibly multi-file) unified diff under `root`. Every file is
+    patched in memory first; nothing is written unless all of them apply,
+    and if a write fails part way the files already written are restored.
+    With `check`, only report what would happen.
+    """
+    root = os.path.realpath(root)
+    patches = parse_patch(patch_text)
+
+    planned = []  # (target, original text or None, new text or None, report)
+    for fp in patches:
+        target = _resolve(root, fp.path)
+        original = None
+        if fp.old_path is not None:
+            if not os.path.isfile(target):
+                raise PatchError(f"{fp.path}: file not found")
+            original = _read(target)
+        elif os.path.exists(target):
+            raise PatchError(f"{fp.path}: file to create already exists")
+
+        if fp.new_path is None:
+            status, new_text, hunks = "deleted", None, []
+            if fp.hunks:
+                # Deleting: the hunks must still match what's on disk.
+                remaining, hunks = apply_hunks(original, fp.hunks, fp.path)
+                if remaining.strip():
+                    raise PatchError(f"{fp.path}: file has content the deletion doesn't remove")
+        else:
+            new_text, hunks = apply_hunks(original or "", fp.hunks, fp.path)
+            status = "created" if original is None else "modified"
+        planned.append((target, original, new_text, {"path": fp.path, "status": status, "hunks": hunks}))
+
+    files = [report for _, _, _, report in planned]
+    if check:
+        return {"ok": True, "method": "native", "check": True, "files": files}
+
+    done = []
+    try:
+        for target, original, new_text, _ in planned:
+            if new_text is None:
+                os.remove(target)
+            else:
+                _write_atomic(target, new_text)
+            done.append((target, original))
+    except OSError as e:
+        for target, original in reversed(done):
+            if original is None:
+                os.remove(target)
+            else:
+                _write_atomic(target, original)
+        raise PatchError(f"write failed, changes rolled back: {e}")
+    return {"ok": True, "method": "native", "check": False, "files": files}
@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The local backend's modules import each other as top-level modules, as
+# they do when uvicorn runs them from AI/backend.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,50 @@
+import asyncio
+
+import batch
+from batch import batch_events, collect_files
+
+
+class EchoAnalyzer:
+    async def analyze(self, path):
+        return {"analysis": "ok", "chunks": 1, "cached": False}
+
+
+def make_tree(root, count):
+    for i in range(count):
+        (root / f"f{i:03}.py").write_text("print(1)\n")
+
+
+def test_collect_files_stops_walking_at_max_files(tmp_path, monkeypatch):
+    make_tree(tmp_path, 50)
+    checked = []
+    check_file = batch.check_file
+    monkeypatch.setattr(batch, "check_file", lambda path: checked.append(path) or check_file(path))
+
+    files, skipped, truncated = collect_files([str(tmp_path)], [], [], max_files=5)
+
+    assert len(files) == 5 and skipped == [] and truncated
+    # One look past the limit to know there was more, and no further.
+    assert len(checked) == 6
+
+
+def test_collect_files_not_truncated_at_exact_limit(tmp_path):
+    make_tree(tmp_path, 5)
+    (tmp_path / "blob.bin").write_bytes(b"\0\1\2")
+
+    files, skipped, truncated = collect_files([str(tmp_path)], [], [], max_files=5)
+
+    assert len(files) == 5 and not truncated
+    assert skipped == [(str(tmp_path / "blob.bin"), "binary")]
+
+
+def test_batch_events_report_truncation_once(tmp_path):
+    make_tree(tmp_path, 20)
+
+    async def run():
+        return [event async for event in batch_events(EchoAnalyzer(), [str(tmp_path)], [], [], 3, 2)]
+
+    events = asyncio.run(run())
+
+    assert [e["event"] for e in events] == ["start", "file", "file", "file", "summary"]
+    assert events[0] == {"event": "start", "files": 3, "skipped": 0, "truncated": True}
+    assert events[-1]["analyzed"] == 3 and events[-1]["truncated"]
@@ -0,0 +1,178 @@
+import os
+
+import pytest
+
+from patch import PatchError, apply_hunks, apply_patch, parse_patch
+
+ORIGINAL = "".join(f"line {n}\n" for n in range(1, 21))
+
+
+def write(root, name, text):
+    path = os.path.join(root, name)
+    with open(path, "w", newline="") as f:
+        f.write(text)
+    return path
+
+
+def read(root, name):
+    with open(os.path.join(root, name), newline="") as f:
+        return f.read()
+
+
+def test_parse_git_diff_strips_prefixes():
+    patches = parse_patch(
+        "diff --git a/app.py b/app.py\n"
+        "index 1111111..2222222 100644\n"
+        "--- a/app.py\n"
+        "+++ b/app.py\n"
+        "@@ -1,2 +1,2 @@\n"
+        " keep\n"
+        "-old\n"
+        "+new\n"
+    )
+    assert [fp.path for fp in patches] == ["app.py"]
+    assert patches[0].hunks[0].lines == [(" ", "keep"), ("-", "old"), ("+", "new")]
+
+
+def test_header_like_lines_inside_a_hunk_are_content():
+    # A removed "-- x" line followed by an added "++ y" line reads like a
+    # file header; the hunk's counts say they belong to it.
+    patches = parse_patch(
+        "--- a/query.sql\n"
+        "+++ b/query.sql\n"
+        "@@ -1,3 +1,3 @@\n"
+        " SELECT 1;\n"
+        "--- old comment\n"
+        "+++ new comment\n"
+        " SELECT 2;\n"
+        "--- a/other.txt\n"
+        "+++ b/other.txt\n"
+        "@@ -1 +1 @@\n"
+        "-a\n"
+        "+b\n"
+    )
+    assert [fp.path for fp in patches] == ["query.sql", "other.txt"]
+    assert patches[0].hunks[0].lines == [
+        (" ", "SELECT 1;"), ("-", "-- old comment"), ("+", "++ new comment"), (" ", "SELECT 2;"),
+    ]
+    assert patches[1].hunks[0].lines == [("-", "a"), ("+", "b")]
+
+
+def test_blank_line_inside_counted_hunk_is_context():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1,3 +1,3 @@\n a\n\n-b\n+c\n")
+    assert patches[0].hunks[0].lines == [(" ", "a"), (" ", ""), ("-", "b"), ("+", "c")]
+
+
+def test_undercounted_hunk_keeps_its_extra_lines():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1,1 +1,1 @@\n a\n-b\n+c\n")
+    assert patches[0].hunks[0].lines == [(" ", "a"), ("-", "b"), ("+", "c")]
+
+
+def test_no_file_headers_is_an_error():
+    with pytest.raises(PatchError, match="no file headers"):
+        parse_patch("just some text\n")
+
+
+def test_hunk_without_file_header_is_an_error():
+    with pytest.raises(PatchError, match="hunk before any file header"):
+        parse_patch("@@ -1 +1 @@\n-a\n+b\n")
+
+
+def test_apply_hunk_at_an_offset():
+    text = "extra\n" * 3 + ORIGINAL
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -4,3 +4,3 @@\n line 4\n-line 5\n+LINE 5\n line 6\n")
+    new_text, report = apply_hunks(text, patches[0].hunks, "f")
+    assert "LINE 5\n" in new_text and "line 5\n" not in new_text
+    assert report == [{"hunk": 1, "offset": 3, "fuzz": 0, "whitespace": False}]
+
+
+def test_apply_with_fuzz_when_context_changed():
+    patches = parse_patch(
+        "--- a/f\n+++ b/f\n@@ -9,5 +9,5 @@\n changed 9\n line 10\n-line 11\n+LINE 11\n line 12\n line 13\n"
+    )
+    new_text, report = apply_hunks(ORIGINAL, patches[0].hunks, "f")
+    assert "LINE 11\n" in new_text
+    assert report[0]["fuzz"] == 1
+
+
+def test_apply_ignoring_trailing_whitespace():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a  \n-b\n+c\n")
+    new_text, report = apply_hunks("a\nb\n", patches[0].hunks, "f")
+    assert new_text.splitlines()[1:] == ["c"]
+    assert report[0]["whitespace"]
+
+
+def test_hunk_that_does_not_apply():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1,3 +1,3 @@\n x\n-y\n+z\n w\n")
+    with pytest.raises(PatchError, match="does not apply"):
+        apply_hunks(ORIGINAL, patches[0].hunks, "f")
+
+
+def test_no_newline_at_end_of_file():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1 +1 @@\n-a\n+b\n\\ No newline at end of file\n")
+    new_text, _ = apply_hunks("a\n", patches[0].hunks, "f")
+    assert new_text == "b"
+
+
+def test_crlf_line_endings_are_kept():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1,2 +1,2 @@\n a\n-b\n+c\n")
+    new_text, _ = apply_hunks("a\r\nb\r\n", patches[0].hunks, "f")
+    assert new_text == "a\r\nc\r\n"
+
+
+def test_apply_patch_creates_modifies_and_deletes(tmp_path):
+    root = str(tmp_path)
+    write(root, "keep.txt", "one\ntwo\n")
+    write(root, "gone.txt", "bye\n")
+    result = apply_patch(
+        "--- a/keep.txt\n+++ b/keep.txt\n@@ -1,2 +1,2 @@\n one\n-two\n+2\n"
+        "--- /dev/null\n+++ b/new/file.txt\n@@ -0,0 +1,2 @@\n+hello\n+world\n"
+        "--- a/gone.txt\n+++ /dev/null\n@@ -1 +0,0 @@\n-bye\n",
+        root=root,
+    )
+    assert [(f["path"], f["status"]) for f in result["files"]] == [
+        ("keep.txt", "modified"), ("new/file.txt", "created"), ("gone.txt", "deleted"),
+    ]
+    assert read(root, "keep.txt") == "one\n2\n"
+    assert read(root, "new/file.txt") == "hello\nworld\n"
+    assert not os.path.exists(os.path.join(root, "gone.txt"))
+
+
+def test_check_mode_writes_nothing(tmp_path):
+    root = str(tmp_path)
+    write(root, "f.txt", "a\n")
+    result = apply_patch("--- a/f.txt\n+++ b/f.txt\n@@ -1 +1 @@\n-a\n+b\n", root=root, check=True)
+    assert result["check"] and result["files"][0]["status"] == "modified"
+    assert read(root, "f.txt") == "a\n"
+
+
+def test_nothing_is_written_unless_every_file_applies(tmp_path):
+    root = str(tmp_path)
+    write(root, "a.txt", "a\n")
+    write(root, "b.txt", "b\n")
+    with pytest.raises(PatchError, match="does not apply"):
+        apply_patch(
+            "--- a/a.txt\n+++ b/a.txt\n@@ -1 +1 @@\n-a\n+A\n"
+            "--- a/b.txt\n+++ b/b.txt\n@@ -1 +1 @@\n-x\n+X\n",
+            root=root,
+        )
+    assert read(root, "a.txt") == "a\n"
+
+
+def test_paths_outside_the_root_are_refused(tmp_path):
+    with pytest.raises(PatchError, match="escapes the patch root"):
+        apply_patch("--- /dev/null\n+++ b/../evil.txt\n@@ -0,0 +1 @@\n+x\n", root=str(tmp_path))
+
+
+@pytest.mark.parametrize("separator", ["\x0c", "\u2028", "\x85", "\x1c", "\x0b"])
+def test_only_newlines_end_lines(separator):
+    text = f"a\n{separator}b = 1\nc\nd\n"
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -3,2 +3,2 @@\n c\n-d\n+D\n")
+    new_text, report = apply_hunks(text, patches[0].hunks, "f")
+    assert new_text == f"a\n{separator}b = 1\nc\nD\n"
+    assert report[0]["offset"] == 0
+
+
+def test_separator_characters_in_patch_lines_are_content():
+    patches = parse_patch("--- a/f\n+++ b/f\n@@ -1 +1 @@\n-x\u2028y\n+x\x0cy\n")
+    assert patches[0].hunks[0].lines == [("-", "x\u2028y"), ("+", "x\x0cy")]
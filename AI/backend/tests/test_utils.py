@@ -0,0 +1,120 @@
+import asyncio
+import os
+import time
+
+import pytest
+
+import utils
+from utils import run_shell_command, stream_shell_command
+
+pytestmark = pytest.mark.skipif(os.name == "nt", reason="POSIX shell commands")
+
+
+def collect(cmd: str, timeout: float = 10):
+    async def run():
+        return [event async for event in stream_shell_command(cmd, timeout=timeout)]
+
+    return asyncio.run(run())
+
+
+def alive(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # A zombie has exited; it only waits to be reaped.
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+    except OSError:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        return True
+
+
+def wait_gone(pid: int, timeout: float = 5) -> bool:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if not alive(pid):
+            return True
+        time.sleep(0.05)
+    return False
+
+
+def test_output_is_streamed_by_stream():
+    events = collect("echo out; echo err 1>&2; exit 3")
+    assert events[0]["event"] == "start"
+    output = {}
+    for event in events[1:-1]:
+        assert event["event"] == "output"
+        output[event["stream"]] = output.get(event["stream"], "") + event["data"]
+    assert output == {"stdout": "out\n", "stderr": "err\n"}
+    assert events[-1]["event"] == "exit"
+    assert events[-1]["returncode"] == 3 and not events[-1]["timed_out"]
+
+
+def test_output_arrives_before_the_command_ends():
+    async def run():
+        stream = stream_shell_command("echo first; sleep 1; echo second", timeout=10)
+        assert (await stream.__anext__())["event"] == "start"
+        started = time.monotonic()
+        event = await stream.__anext__()
+        first_after = time.monotonic() - started
+        rest = [e async for e in stream]
+        return event, first_after, rest
+
+    event, first_after, rest = asyncio.run(run())
+    assert event["data"] == "first\n"
+    assert first_after < 0.8
+    assert rest[-1]["returncode"] == 0
+
+
+def test_timeout_stops_the_command():
+    events = collect("sleep 30", timeout=0.3)
+    assert events[-1]["timed_out"]
+    assert events[-1]["elapsed_s"] < 5
+
+
+def test_timeout_applies_after_the_output_is_closed():
+    events = collect("exec >/dev/null 2>&1; sleep 30", timeout=0.3)
+    assert events[-1]["timed_out"]
+    assert events[-1]["elapsed_s"] < 5
+
+
+def test_timeout_kills_the_whole_process_group():
+    events = collect("sleep 30 & echo $!; wait", timeout=0.5)
+    child = int("".join(e["data"] for e in events if e["event"] == "output").strip())
+    assert events[-1]["timed_out"]
+    assert wait_gone(child)
+
+
+def test_consumer_going_away_kills_the_process_group():
+    async def run():
+        stream = stream_shell_command("sleep 30 & echo $!; wait", timeout=10)
+        await stream.__anext__()
+        event = await stream.__anext__()
+        await stream.aclose()
+        return int(event["data"].strip())
+
+    assert wait_gone(asyncio.run(run()))
+
+
+def test_too_many_commands_is_an_error(monkeypatch):
+    async def run():
+        monkeypatch.setattr(utils, "_command_slots", asyncio.Semaphore(1))
+        first = stream_shell_command("sleep 30", timeout=10)
+        await first.__anext__()
+        events = [e async for e in stream_shell_command("echo hi")]
+        await first.aclose()
+        return events
+
+    events = asyncio.run(run())
+    assert len(events) == 1 and events[0]["event"] == "error"
+
+
+def test_run_shell_command_keeps_the_tail_of_long_output(monkeypatch):
+    monkeypatch.setattr(utils, "COMMAND_OUTPUT_LIMIT", 1000)
+    result = asyncio.run(run_shell_command("for i in $(seq 1 2000); do echo line$i; done"))
+    assert result["returncode"] == 0 and result["truncated"]
+    assert len(result["stdout"]) <= 1000
+    assert result["stdout"].endswith("line2000\n")
@@ -1,42 +1,161 @@
 import subprocess
-import tempfile
 import os
-import difflib
-from typing import Tuple
+import time
+import codecs
+import signal
+import asyncio
+from collections import deque
 
-def apply_patch_to_file(patch_text: str) -> dict:
-    # Expects a unified diff patch. This will try to apply patch safely using python
-    # For simplicity, write patch to temp file and use 'git apply' if available.
-    try:
-        import git
-    except Exception:
-        git = None
+from patch import apply_patch
+
+COMMAND_TIMEOUT = float(os.environ.get("COMMAND_TIMEOUT", "120"))
+COMMAND_MAX_CONCURRENT = int(os.environ.get("COMMAND_MAX_CONCURRENT", "2"))
+# Output kept for the non-streaming /run_command reply, per stream (the tail is kept).
+COMMAND_OUTPUT_LIMIT = int(os.environ.get("COMMAND_OUTPUT_LIMIT", str(1024 * 1024)))
+# Seconds between asking a process group to stop and killing it.
+COMMAND_KILL_GRACE = float(os.environ.get("COMMAND_KILL_GRACE", "3"))
+
+# Output chunks buffered between the process and a slow client. When it is
+# full the reads stop and the process blocks on its pipe instead of the
+# server holding its output.
+OUTPUT_QUEUE_CHUNKS = 64
+READ_SIZE = 4096
+
+_command_slots = asyncio.Semaphore(COMMAND_MAX_CONCURRENT)
 
-    # attempt git apply
+def apply_patch_to_file(patch_text: str, root: str = ".", check: bool = False) -> dict:
+    # Expects a unified diff patch, applied in-process (see patch.py); no git needed.
     try:
-        tmp_patch = tempfile.NamedTemporaryFile(delete=False, suffix=".patch")
-        tmp_patch.write(patch_text.encode('utf-8'))
-        tmp_patch.flush()
-        tmp_patch.close()
-        if git:
-            repo = git.Repo('.', search_parent_directories=True)
-            cmd = ['git', 'apply', tmp_patch.name]
-            proc = subprocess.run(cmd, capture_output=True, text=True)
-            os.unlink(tmp_patch.name)
-            if proc.returncode == 0:
-                return {"ok": True, "method": "git apply"}
-            else:
-                return {"ok": False, "error": proc.stderr}
-        else:
-            # fallback: attempt naive patch apply (not robust)
-            os.unlink(tmp_patch.name)
-            return {"ok": False, "error": "gitpython not installed; install gitpython or use git in PATH"}
+        return apply_patch(patch_text, root=root, check=check)
     except Exception as e:
         return {"ok": False, "error": str(e)}
 
-def run_shell_command(cmd: str) -> dict:
+
+async def _stop(proc):
+    """Stop the command and everything it started: terminate, then kill after a grace period."""
+    if proc.returncode is not None:
+        return
     try:
-        proc = subprocess.run(cmd, shell=True, capture_output=True, text=True, timeout=120)
-        return {"returncode": proc.returncode, "stdout": proc.stdout, "stderr": proc.stderr}
-    except Exception as e:
-        return {"error": str(e)}
+        if os.name == "nt":
+            # taskkill /T takes the whole process tree down with the shell.
+            killer = await asyncio.create_subprocess_exec(
+                "taskkill", "/F", "/T", "/PID", str(proc.pid),
+                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+            await killer.wait()
+        else:
+            os.killpg(proc.pid, signal.SIGTERM)
+            try:
+                await asyncio.wait_for(proc.wait(), COMMAND_KILL_GRACE)
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    await proc.wait()
+
+
+async def stream_shell_command(cmd: str, cwd: str = None, timeout: float = COMMAND_TIMEOUT):
+    """
+    Run `cmd` in a shell and yield events as it runs: {"event": "start"},
+    {"event": "output", "stream", "data"} for each piece of stdout/stderr,
+    then {"event": "exit", "returncode", "timed_out", "elapsed_s"}. The
+    command gets its own process group, which is stopped on timeout or
+    when the consumer goes away (e.g. the client disconnects). At most
+    COMMAND_MAX_CONCURRENT commands run at once; beyond that the only
+    event is {"event": "error"}.
+    """
+    if _command_slots.locked():
+        yield {"event": "error", "error": f"too many commands running (limit {COMMAND_MAX_CONCURRENT})"}
+        return
+    async with _command_slots:
+        started = time.monotonic()
+        try:
+            proc = await asyncio.create_subprocess_shell(
+                cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                start_new_session=os.name != "nt",
+                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP if os.name == "nt" else 0,
+            )
+        except Exception as e:
+            yield {"event": "error", "error": str(e)}
+            return
+
+        output = asyncio.Queue(maxsize=OUTPUT_QUEUE_CHUNKS)
+
+        async def pump(stream, name):
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while True:
+                data = await stream.read(READ_SIZE)
+                text = decoder.decode(data, final=not data)
+                if text:
+                    await output.put((name, text))
+                if not data:
+                    break
+            await output.put((name, None))
+
+        readers = [asyncio.ensure_future(pump(proc.stdout, "stdout")), asyncio.ensure_future(pump(proc.stderr, "stderr"))]
+        timed_out = False
+        try:
+            yield {"event": "start", "pid": proc.pid}
+            deadline = started + timeout
+            open_streams = len(readers)
+            while open_streams:
+                try:
+                    name, text = await asyncio.wait_for(output.get(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    timed_out = True
+                    break
+                if text is None:
+                    open_streams -= 1
+                else:
+                    yield {"event": "output", "stream": name, "data": text}
+            if not timed_out:
+                # Closed pipes don't mean it has exited: the command may have
+                # redirected or closed its output and kept running.
+                try:
+                    await asyncio.wait_for(proc.wait(), max(0.0, deadline - time.monotonic()))
+                except asyncio.TimeoutError:
+                    timed_out = True
+            if timed_out:
+                await _stop(proc)
+            returncode = await proc.wait()
+            yield {
+                "event": "exit",
+                "returncode": returncode,
+                "timed_out": timed_out,
+                "elapsed_s": round(time.monotonic() - started, 2),
+            }
+        finally:
+            for reader in readers:
+                reader.cancel()
+            await _stop(proc)
+
+
+async def run_shell_command(cmd: str, cwd: str = None) -> dict:
+    """Run `cmd` to completion. Only the last COMMAND_OUTPUT_LIMIT characters of each stream are kept."""
+    kept = {"stdout": deque(), "stderr": deque()}
+    sizes = {"stdout": 0, "stderr": 0}
+    truncated = False
+    result = {}
+    async for event in stream_shell_command(cmd, cwd=cwd):
+        if event["event"] == "error":
+            return {"error": event["error"]}
+        if event["event"] == "output":
+            name, text = event["stream"], event["data"]
+            kept[name].append(text)
+            sizes[name] += len(text)
+            while sizes[name] > COMMAND_OUTPUT_LIMIT and len(kept[name]) > 1:
+                sizes[name] -= len(kept[name].popleft())
+                truncated = True
+        elif event["event"] == "exit":
+            result = event
+    stdout, stderr = "".join(kept["stdout"]), "".join(kept["stderr"])
+    if len(stdout) > COMMAND_OUTPUT_LIMIT or len(stderr) > COMMAND_OUTPUT_LIMIT:
+        stdout, stderr = stdout[-COMMAND_OUTPUT_LIMIT:], stderr[-COMMAND_OUTPUT_LIMIT:]
+        truncated = True
+    return {
+        "returncode": result.get("returncode"),
+        "stdout": stdout,
+        "stderr": stderr,
+        "timed_out": result.get("timed_out", False),
+        "truncated": truncated,
+    }
@@ -46,20 +46,56 @@ function activate(context) {
         }
     });
 
+    let output = vscode.window.createOutputChannel('My Local AI');
+
     let runCommand = vscode.commands.registerCommand('myLocalAI.runCommand', async function () {
         const cmd = await vscode.window.showInputBox({prompt: 'Shell command to run (cwd: workspace root):'});
         if (!cmd) return;
-        try {
-            const r = await axios.post(`${API_BASE}/run_command`, {command: cmd});
-            const out = JSON.stringify(r.data, null, 2);
-            const docWin = await vscode.workspace.openTextDocument({content: out, language: 'json'});
-            vscode.window.showTextDocument(docWin, {preview:false});
-        } catch (err) {
-            vscode.window.showErrorMessage('Error running command: ' + err.message);
-        }
+        const folders = vscode.workspace.workspaceFolders;
+        const cwd = folders && folders.length ? folders[0].uri.fsPath : undefined;
+        output.clear();
+        output.show(true);
+        output.appendLine('$ ' + cmd);
+        // Output streams in as NDJSON events; cancelling closes the request,
+        // which makes the server kill the command.
+        await vscode.window.withProgress({
+            location: vscode.ProgressLocation.Notification,
+            title: 'Running: ' + cmd,
+            cancellable: true
+        }, async (progress, token) => {
+            const controller = new AbortController();
+            token.onCancellationRequested(() => controller.abort());
+            try {
+                const r = await axios.post(`${API_BASE}/run_command/stream`, {command: cmd, cwd: cwd},
+                    {responseType: 'stream', signal: controller.signal});
+                let pending = '';
+                for await (const chunk of r.data) {
+                    pending += chunk.toString('utf8');
+                    const lines = pending.split('\n');
+                    pending = lines.pop();
+                    for (const line of lines) {
+                        if (!line.trim()) continue;
+                        const event = JSON.parse(line);
+                        if (event.event === 'output') {
+                            output.append(event.data);
+                        } else if (event.event === 'exit') {
+                            output.appendLine(`\n[exit ${event.returncode}${event.timed_out ? ', timed out' : ''}, ${event.elapsed_s}s]`);
+                        } else if (event.event === 'error') {
+                            vscode.window.showErrorMessage('Error running command: ' + event.error);
+                        }
+                    }
+                }
+            } catch (err) {
+                if (token.isCancellationRequested) {
+                    output.appendLine('\n[cancelled]');
+                } else {
+                    vscode.window.showErrorMessage('Error running command: ' + err.message);
+                }
+            }
+        });
     });
 
-    context.subscriptions.push(chat, analyze, applyPatch, runCommand);
+    context.subscriptions.push(chat, analyze, applyPatch, runCommand, output);
 }
 exports.activate = activate;
 function deactivate() {}
@@ -1,12 +1,27 @@
 import os
 import json
-from groq import Groq
+import time
+from groq import AsyncGroq
+
+from upstream import UpstreamGate, UpstreamBusy, RateLimited
+from history import make_history_store, estimate_tokens
+from cache import ResponseCache, normalize_prompt
+from singleflight import SingleFlight, flight_key
+from router import ModelRouter, AUTO_MODEL
+from compaction import Compactor, HISTORY_COMPACT_MODEL, HISTORY_SUMMARY_MAX_TOKENS
+from metrics import counter, histogram
 
 GROQ_API_KEY = os.environ.get("GROQ_API_KEY")
+GROQ_TIMEOUT = float(os.environ.get("GROQ_TIMEOUT", "120"))
+# Another Groq-compatible host, such as the mock in bench/mock_upstream.py.
+GROQ_BASE_URL = os.environ.get("GROQ_BASE_URL") or None
+# Completion tokens a request is charged against the user's rate limit up
+# front; the charge is settled with the reply's real size once it is done.
+GROQ_EXPECTED_COMPLETION_TOKENS = int(os.environ.get("GROQ_EXPECTED_COMPLETION_TOKENS", "1024"))
 
 client = None
 if GROQ_API_KEY:
-    client = Groq(api_key=GROQ_API_KEY)
+    client = AsyncGroq(api_key=GROQ_API_KEY, base_url=GROQ_BASE_URL, timeout=GROQ_TIMEOUT)
 
 SYSTEM_PROMPT = """You are TradePackage AI - a powerful, intelligent coding assistant and research expert powered by LLaMA and Mistral open-source models.
 
@@ -21,78 +36,392 @@ Your capabilities:
 
 You are smart, helpful, and always provide high-quality, working code. Format your responses with markdown for better readability. When providing code, always include complete, runnable examples."""
 
+SUMMARY_PROMPT = """Summarize the conversation below between a user and a coding assistant, for the assistant to continue it later without the original messages.
+
+Keep what later turns may depend on: the user's goals and preferences, decisions made, names of files, functions, APIs and libraries, important code details, errors and how they were fixed, and open questions. Fold in any earlier summary. Be concise and factual; write plain prose or short bullet points, without greetings or commentary."""
+
+# Context window per model, in tokens; history gets whatever the system
+# prompt, the new prompt and the completion leave free.
+MODEL_CONTEXT_TOKENS = {
+    "llama-3.3-70b-versatile": 131072,
+    "llama-3.1-8b-instant": 131072,
+    "mixtral-8x7b-32768": 32768,
+    "gemma2-9b-it": 8192,
+}
+
+# Relative price of a token on each model (Groq's per-token pricing, the
+# 70B model as 1). Requests are scheduled and rate-limited by this cost.
+MODEL_COST_WEIGHTS = {
+    "llama-3.3-70b-versatile": 1.0,
+    "llama-3.1-8b-instant": 0.1,
+    "mixtral-8x7b-32768": 0.3,
+    "gemma2-9b-it": 0.25,
+}
+
+UPSTREAM_SECONDS = histogram(
+    "upstream_request_seconds", "Time per upstream completion attempt, to the last token.", ("model", "outcome")
+)
+UPSTREAM_TTFT = histogram(
+    "upstream_time_to_first_token_seconds", "Time from starting a streamed completion to its first token.", ("model",)
+)
+QUEUE_WAIT = histogram("upstream_queue_wait_seconds", "Time spent waiting for an upstream slot.", ("lane",))
+LLM_TOKENS = counter(
+    "llm_tokens_total", "Tokens per model, as reported by Groq or estimated when it doesn't say.", ("model", "kind")
+)
+UPSTREAM_ERRORS = counter("upstream_errors_total", "Failed upstream attempts.", ("model", "error_class"))
+AI_ERRORS = counter("ai_errors_total", "Errors returned to callers.", ("error_class",))
+
+MISSING_KEY_ERROR = "Error: Groq API key is not configured. Please add your GROQ_API_KEY in the Secrets tab. Get a free key at https://console.groq.com"
+
+class NotConfigured(Exception):
+    pass
+
 class AIClient:
     def __init__(self):
-        self.conversation_history = {}
+        self.history = make_history_store()
         self.current_model = "llama-3.3-70b-versatile"
+        self.user_models = {}
+        self.gate = UpstreamGate()
+        self.cache = ResponseCache()
+        self.flights = SingleFlight()
+        self.router = ModelRouter(MODEL_CONTEXT_TOKENS)
+        self.compactor = Compactor(self.history, self._summarize)
     
     def get_available_models(self):
         return {
             "llama-3.3-70b-versatile": "LLaMA 3.3 70B (Best Quality)",
             "llama-3.1-8b-instant": "LLaMA 3.1 8B (Fast)",
             "mixtral-8x7b-32768": "Mixtral 8x7B (Balanced)",
-            "gemma2-9b-it": "Gemma 2 9B (Efficient)"
+            "gemma2-9b-it": "Gemma 2 9B (Efficient)",
+            AUTO_MODEL: "Auto (fastest healthy model)"
         }
     
-    def set_model(self, model_id: str):
+    def set_model(self, model_id: str, user_id: str = None):
+        """
+        Select `model_id` for `user_id`, or as the default for everyone
+        without a choice of their own when no user is given.
+        """
         available = self.get_available_models()
         if model_id in available:
-            self.current_model = model_id
+            if user_id:
+                self.user_models[user_id] = model_id
+            else:
+                self.current_model = model_id
             return True
         return False
     
-    def get_history(self, user_id: str) -> list:
-        if user_id not in self.conversation_history:
-            self.conversation_history[user_id] = []
-        return self.conversation_history[user_id]
+    def get_model(self, user_id: str = None) -> str:
+        return self.user_models.get(user_id, self.current_model)
+    
+    def resolve_model(self, user_id: str, model: str = None) -> str:
+        # A model named in the request wins over the user's choice, which
+        # wins over the process default.
+        if not model:
+            return self.get_model(user_id)
+        if model not in self.get_available_models():
+            raise ValueError(f"Unknown model: {model}")
+        return model
+    
+    def get_history(self, user_id: str, token_budget: int = None) -> list:
+        return self.history.get(user_id, token_budget)
     
     def add_to_history(self, user_id: str, role: str, content: str):
-        history = self.get_history(user_id)
-        history.append({"role": role, "content": content})
-        if len(history) > 20:
-            history.pop(0)
-            history.pop(0)
+        self.history.append(user_id, role, content)
+        if role == "assistant":
+            self.compactor.maybe_compact(user_id)
     
     def clear_history(self, user_id: str):
-        self.conversation_history[user_id] = []
+        self.history.clear(user_id)
+    
+    def history_budget(self, model: str, prompt: str, max_tokens: int) -> int:
+        if model == AUTO_MODEL:
+            window = max(MODEL_CONTEXT_TOKENS.values())
+        else:
+            window = MODEL_CONTEXT_TOKENS.get(model, 8192)
+        free = window - max_tokens - estimate_tokens(SYSTEM_PROMPT) - estimate_tokens(prompt)
+        return max(0, min(self.history.token_budget, free))
     
-    async def chat(self, prompt: str, user_id: str = "default", context: str = None, max_tokens: int = 4096) -> str:
+    def _get_client(self):
         global client
         if not client:
             api_key = os.environ.get("GROQ_API_KEY")
-            if api_key:
-                client = Groq(api_key=api_key)
-            else:
-                return "Error: Groq API key is not configured. Please add your GROQ_API_KEY in the Secrets tab. Get a free key at https://console.groq.com"
+            if not api_key:
+                raise NotConfigured(MISSING_KEY_ERROR)
+            client = AsyncGroq(api_key=api_key, base_url=GROQ_BASE_URL, timeout=GROQ_TIMEOUT)
+        return client
+    
+    def _build_messages(self, prompt: str, user_id: str, model: str, context: str = None, max_tokens: int = 4096) -> list:
+        if context:
+            prompt = f"Context: {context}\n\nQuestion: {prompt}"
+        messages = [{"role": "system", "content": SYSTEM_PROMPT}]
+        messages.extend(self.get_history(user_id, self.history_budget(model, prompt, max_tokens)))
+        messages.append({"role": "user", "content": prompt})
+        return messages
+    
+    def _error_text(self, e: Exception) -> str:
+        AI_ERRORS.inc(type(e).__name__)
+        if isinstance(e, NotConfigured):
+            return str(e)
+        if isinstance(e, RateLimited):
+            return f"Error: You're sending requests faster than your share allows ({e}). Please slow down."
+        if isinstance(e, UpstreamBusy):
+            return f"Error: The AI service is busy right now ({e}). Please try again shortly."
+        return f"Error: {str(e)}"
+    
+    def _needed_tokens(self, messages: list, max_tokens: int) -> int:
+        return sum(estimate_tokens(m["content"]) for m in messages) + max_tokens
+    
+    def request_cost(self, model: str, needed_tokens: int) -> float:
+        """Cost in 70B-model kilotokens; `auto` routes to the fast models, so it is priced like them."""
+        if model == AUTO_MODEL:
+            weight = min(MODEL_COST_WEIGHTS.values())
+        else:
+            weight = MODEL_COST_WEIGHTS.get(model, 1.0)
+        return needed_tokens / 1000 * weight
+    
+    def _admit(self, model: str, messages: list, max_tokens: int, user_id: str) -> tuple:
+        """
+        (cost, charged): the slot is scheduled by the worst case, `max_tokens`
+        of completion, but the user's rate limit is only charged for a typical
+        one until _settle() knows the reply.
+        """
+        prompt = self._needed_tokens(messages, 0)
+        cost = self.request_cost(model, prompt + max_tokens)
+        estimate = self.request_cost(model, prompt + min(max_tokens, GROQ_EXPECTED_COMPLETION_TOKENS))
+        charged = self.gate.admit(user_id, cost, estimate)
+        return cost, charged
+    
+    def _settle(self, model: str, messages: list, reply: str, user_id: str, charged: float):
+        if charged:
+            actual = self.request_cost(model, self._needed_tokens(messages, 0) + estimate_tokens(reply))
+            self.gate.settle(user_id, charged, actual)
+    
+    def _count_tokens(self, model: str, usage, messages: list, completion_chars: int):
+        if usage is not None:
+            prompt, completion = usage.prompt_tokens, usage.completion_tokens
+        else:
+            prompt = self._needed_tokens(messages, 0)
+            completion = completion_chars // 4
+        LLM_TOKENS.inc(model, "prompt", amount=prompt)
+        LLM_TOKENS.inc(model, "completion", amount=completion)
+    
+    def _record_failure(self, model: str, e: Exception, elapsed: float):
+        self.router.record_failure(model, e)
+        UPSTREAM_ERRORS.inc(model, type(e).__name__)
+        UPSTREAM_SECONDS.observe(elapsed, model, "error")
+    
+    async def _upstream(self, groq, model: str, messages: list, max_tokens: int, user_id: str, cost: float) -> str:
+        """
+        Run the completion on `model`, falling back along the router's
+        candidates when a model fails or is rate-limited.
+        """
+        last_error = None
+        candidates = self.router.candidates(model, self._needed_tokens(messages, max_tokens))
+        for candidate in candidates:
+            async with self.gate.slot(user_id, cost) as waited:
+                QUEUE_WAIT.observe(waited, self.gate.lane(cost))
+                self.router.started(candidate, candidates[0])
+                started = time.monotonic()
+                try:
+                    response = await groq.chat.completions.create(
+                        model=candidate,
+                        messages=messages,
+                        max_tokens=max_tokens
+                    )
+                except Exception as e:
+                    self._record_failure(candidate, e, time.monotonic() - started)
+                    last_error = e
+                    continue
+                except BaseException:
+                    self.router.abandoned(candidate)
+                    raise
+            elapsed = time.monotonic() - started
+            self.router.record_success(candidate, elapsed)
+            UPSTREAM_SECONDS.observe(elapsed, candidate, "ok")
+            text = response.choices[0].message.content
+            self._count_tokens(candidate, getattr(response, "usage", None), messages, len(text or ""))
+            return text
+        raise last_error
+    
+    async def _upstream_stream(self, groq, model: str, messages: list, max_tokens: int, user_id: str, cost: float):
+        # Falling back is only possible until the first delta has been sent.
+        last_error = None
+        candidates = self.router.candidates(model, self._needed_tokens(messages, max_tokens))
+        for candidate in candidates:
+            sent = 0
+            usage = None
+            async with self.gate.slot(user_id, cost) as waited:
+                QUEUE_WAIT.observe(waited, self.gate.lane(cost))
+                self.router.started(candidate, candidates[0])
+                started = time.monotonic()
+                try:
+                    stream = await groq.chat.completions.create(
+                        model=candidate,
+                        messages=messages,
+                        max_tokens=max_tokens,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        # Groq reports usage on the last chunk, under x_groq.
+                        usage = getattr(getattr(chunk, "x_groq", None), "usage", None) or usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            if not sent:
+                                UPSTREAM_TTFT.observe(time.monotonic() - started, candidate)
+                            sent += len(delta)
+                            yield delta
+                except Exception as e:
+                    self._record_failure(candidate, e, time.monotonic() - started)
+                    if sent:
+                        raise
+                    last_error = e
+                    continue
+                except BaseException:
+                    # Cancelled, or closed by a subscriber going away.
+                    self.router.abandoned(candidate)
+                    raise
+            elapsed = time.monotonic() - started
+            self.router.record_success(candidate, elapsed)
+            UPSTREAM_SECONDS.observe(elapsed, candidate, "ok")
+            self._count_tokens(candidate, usage, messages, sent)
+            return
+        raise last_error
+    
+    async def _complete(self, prompt: str, user_id: str, context: str = None, max_tokens: int = 4096, model: str = None) -> str:
+        groq = self._get_client()
+        model = self.resolve_model(user_id, model)
+        messages = self._build_messages(prompt, user_id, model, context, max_tokens)
+        cost, charged = self._admit(model, messages, max_tokens, user_id)
+        self.add_to_history(user_id, "user", prompt)
         
+        # Identical in-flight requests (same model, prompt, context and
+        # history) share one upstream call; each caller records its own
+        # history and is charged its own share of the upstream.
+        key = flight_key(model, messages, max_tokens)
+        reply = await self.flights.do(key, lambda: self._upstream(groq, model, messages, max_tokens, user_id, cost),
+                                      lambda: self.gate.share(user_id, cost))
+        self._settle(model, messages, reply, user_id, charged)
+        self.add_to_history(user_id, "assistant", reply)
+        return reply
+    
+    async def _stream(self, prompt: str, user_id: str, context: str = None, max_tokens: int = 4096, model: str = None):
+        groq = self._get_client()
+        model = self.resolve_model(user_id, model)
+        messages = self._build_messages(prompt, user_id, model, context, max_tokens)
+        cost, charged = self._admit(model, messages, max_tokens, user_id)
+        self.add_to_history(user_id, "user", prompt)
+        
+        parts = []
+        key = flight_key(model, messages, max_tokens)
+        source = lambda: self._upstream_stream(groq, model, messages, max_tokens, user_id, cost)
+        async for delta in self.flights.stream(key, source, lambda: self.gate.share(user_id, cost)):
+            parts.append(delta)
+            yield delta
+        
+        reply = "".join(parts)
+        self._settle(model, messages, reply, user_id, charged)
+        self.add_to_history(user_id, "assistant", reply)
+    
+    async def _summarize(self, user_id: str, messages: list) -> str:
+        """Summary of `messages` by the cheap model, for the history compactor."""
+        groq = self._get_client()
+        transcript = "\n\n".join(
+            f"{'Earlier summary' if m['role'] == 'system' else m['role'].capitalize()}: {m['content']}" for m in messages
+        )
+        request = [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ]
+        cost = self.request_cost(HISTORY_COMPACT_MODEL, self._needed_tokens(request, HISTORY_SUMMARY_MAX_TOKENS))
+        return await self._upstream(groq, HISTORY_COMPACT_MODEL, request, HISTORY_SUMMARY_MAX_TOKENS, user_id, cost)
+    
+    async def _guard_stream(self, source):
+        # Turn a failure into a final "Error: ..." chunk, the same text the
+        # non-streaming call would have returned. UpstreamBusy before the
+        # first delta is raised instead, so callers can answer with a 429.
+        started = False
         try:
-            messages = [{"role": "system", "content": SYSTEM_PROMPT}]
-            
-            history = self.get_history(user_id)
-            messages.extend(history)
-            
-            if context:
-                messages.append({"role": "user", "content": f"Context: {context}\n\nQuestion: {prompt}"})
-            else:
-                messages.append({"role": "user", "content": prompt})
-            
-            self.add_to_history(user_id, "user", prompt)
-            
-            response = client.chat.completions.create(
-                model=self.current_model,
-                messages=messages,
-                max_tokens=max_tokens
-            )
-            
-            reply = response.choices[0].message.content
-            self.add_to_history(user_id, "assistant", reply)
-            
+            async for delta in source:
+                started = True
+                yield delta
+        except UpstreamBusy as e:
+            if not started:
+                raise
+            yield "\n\n" + self._error_text(e)
+        except Exception as e:
+            prefix = "\n\n" if started else ""
+            yield prefix + self._error_text(e)
+    
+    async def chat(self, prompt: str, user_id: str = "default", context: str = None, max_tokens: int = 4096, model: str = None) -> str:
+        try:
+            return await self._complete(prompt, user_id, context, max_tokens, model)
+        except UpstreamBusy:
+            raise
+        except Exception as e:
+            return self._error_text(e)
+    
+    def chat_stream(self, prompt: str, user_id: str = "default", context: str = None, max_tokens: int = 4096, model: str = None):
+        """
+        Streaming variant of `chat`: yields text deltas as they arrive from
+        Groq. The assistant reply is added to the history once the stream
+        completes. Errors are yielded as a single "Error: ..." chunk, except
+        UpstreamBusy before anything was sent, which is raised.
+        """
+        return self._guard_stream(self._stream(prompt, user_id, context, max_tokens, model))
+    
+    def _cache_key(self, endpoint: str, cache_text: str, prompt: str, user_id: str, model: str):
+        if not self.cache.enabled:
+            return None
+        history = self.get_history(user_id, self.history_budget(model, prompt, 4096))
+        return self.cache.key(model, endpoint, cache_text, history)
+    
+    def _record_cached(self, user_id: str, prompt: str, reply: str):
+        self.add_to_history(user_id, "user", prompt)
+        self.add_to_history(user_id, "assistant", reply)
+    
+    async def _cached_chat(self, endpoint: str, cache_text: str, prompt: str, user_id: str, model: str = None) -> str:
+        """
+        `chat` through the response cache, keyed on the model, the endpoint,
+        `cache_text` (the normalized user input) and the history that would
+        be sent along. Only successful completions are stored.
+        """
+        try:
+            model = self.resolve_model(user_id, model)
+            key = self._cache_key(endpoint, cache_text, prompt, user_id, model)
+            if key:
+                cached = self.cache.get(key)
+                if cached is not None:
+                    self._record_cached(user_id, prompt, cached)
+                    return cached
+            reply = await self._complete(prompt, user_id, model=model)
+            if key:
+                self.cache.put(key, reply)
             return reply
+        except UpstreamBusy:
+            raise
         except Exception as e:
-            return f"Error: {str(e)}"
+            return self._error_text(e)
     
-    async def analyze_code(self, code: str, language: str = "auto", user_id: str = "default") -> str:
-        prompt = f"""Analyze this code and provide:
+    async def _cached_stream(self, endpoint: str, cache_text: str, prompt: str, user_id: str, model: str = None):
+        model = self.resolve_model(user_id, model)
+        key = self._cache_key(endpoint, cache_text, prompt, user_id, model)
+        if key:
+            cached = self.cache.get(key)
+            if cached is not None:
+                self._record_cached(user_id, prompt, cached)
+                yield cached
+                return
+        parts = []
+        async for delta in self._stream(prompt, user_id, model=model):
+            parts.append(delta)
+            yield delta
+        if key:
+            self.cache.put(key, "".join(parts))
+    
+    def analyze_prompt(self, code: str, language: str = "auto") -> str:
+        return f"""Analyze this code and provide:
 1. A summary of what it does
 2. Any bugs or issues found
 3. Security vulnerabilities
@@ -104,10 +433,9 @@ Language: {language}
 ```
 {code}
 ```"""
-        return await self.chat(prompt, user_id=user_id)
     
-    async def generate_code(self, description: str, language: str, user_id: str = "default") -> str:
-        prompt = f"""Generate complete, working {language} code for the following:
+    def generate_prompt(self, description: str, language: str) -> str:
+        return f"""Generate complete, working {language} code for the following:
 
 {description}
 
@@ -116,10 +444,9 @@ Requirements:
 - Include comments explaining key parts
 - Follow best practices for {language}
 - Handle errors appropriately"""
-        return await self.chat(prompt, user_id=user_id)
     
-    async def research(self, topic: str, user_id: str = "default") -> str:
-        prompt = f"""Perform deep research on: {topic}
+    def research_prompt(self, topic: str) -> str:
+        return f"""Perform deep research on: {topic}
 
 Provide:
 1. Comprehensive overview
@@ -128,10 +455,9 @@ Provide:
 4. Common pitfalls to avoid
 5. Useful resources and next steps
 6. Code examples if applicable"""
-        return await self.chat(prompt, user_id=user_id)
     
-    async def create_website(self, description: str, user_id: str = "default") -> str:
-        prompt = f"""Create a complete website based on this description:
+    def website_prompt(self, description: str) -> str:
+        return f"""Create a complete website based on this description:
 
 {description}
 
@@ -141,6 +467,31 @@ Provide:
 3. Interactive elements
 4. Clean, professional styling
 5. The code should be ready to run directly"""
-        return await self.chat(prompt, user_id=user_id)
+    
+    async def analyze_code(self, code: str, language: str = "auto", user_id: str = "default", model: str = None) -> str:
+        return await self._cached_chat("analyze", f"{language}\n{code}", self.analyze_prompt(code, language), user_id, model)
+    
+    async def generate_code(self, description: str, language: str, user_id: str = "default", model: str = None) -> str:
+        cache_text = normalize_prompt(f"{language}: {description}")
+        return await self._cached_chat("generate", cache_text, self.generate_prompt(description, language), user_id, model)
+    
+    async def research(self, topic: str, user_id: str = "default", model: str = None) -> str:
+        return await self._cached_chat("research", normalize_prompt(topic), self.research_prompt(topic), user_id, model)
+    
+    async def create_website(self, description: str, user_id: str = "default", model: str = None) -> str:
+        return await self._cached_chat("website", normalize_prompt(description), self.website_prompt(description), user_id, model)
+    
+    def analyze_code_stream(self, code: str, language: str = "auto", user_id: str = "default", model: str = None):
+        return self._guard_stream(self._cached_stream("analyze", f"{language}\n{code}", self.analyze_prompt(code, language), user_id, model))
+    
+    def generate_code_stream(self, description: str, language: str, user_id: str = "default", model: str = None):
+        cache_text = normalize_prompt(f"{language}: {description}")
+        return self._guard_stream(self._cached_stream("generate", cache_text, self.generate_prompt(description, language), user_id, model))
+    
+    def research_stream(self, topic: str, user_id: str = "default", model: str = None):
+        return self._guard_stream(self._cached_stream("research", normalize_prompt(topic), self.research_prompt(topic), user_id, model))
+    
+    def create_website_stream(self, description: str, user_id: str = "default", model: str = None):
+        return self._guard_stream(self._cached_stream("website", normalize_prompt(description), self.website_prompt(description), user_id, model))
 
 ai_client = AIClient()
@@ -1,15 +1,42 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
+import math
 import os
+import secrets
+import time
 import uvicorn
 
-from ai_client import ai_client
+from ai_client import ai_client, AI_ERRORS
+from upstream import UpstreamBusy
+from jobs import job_queue, JobQueueFull
+from metrics import REGISTRY, CONTENT_TYPE, SERIALIZE_SECONDS, MetricsMiddleware, gauge
+from serving import STATIC_MAX_AGE, CompressionMiddleware, StaticAssets, dumps
 
-app = FastAPI(title="TradePackage AI", description="Powerful AI Coding Assistant")
+HISTORY_SIZE = gauge("history_store_size", "Conversation history held, by unit.", ("unit",))
+UPSTREAM_IN_FLIGHT = gauge("upstream_in_flight", "Upstream completions running.", ("lane",))
+UPSTREAM_QUEUED = gauge("upstream_queued", "Requests waiting for an upstream slot.", ("lane",))
+JOBS = gauge("jobs", "Background jobs by status.", ("status",))
+RESPONSE_CACHE_BYTES = gauge("response_cache_bytes", "Response cache size.", ("tier",))
+TELEGRAM_UPDATES = gauge("telegram_updates", "Telegram updates being handled or waiting, by state.", ("state",))
+TELEGRAM_CHATS_ACTIVE = gauge("telegram_chats_active", "Telegram chats with an update being handled or waiting.")
+
+class TimedJSONResponse(JSONResponse):
+    def render(self, content) -> bytes:
+        start = time.perf_counter()
+        body = dumps(content)
+        SERIALIZE_SECONDS.observe(time.perf_counter() - start, "json")
+        return body
+
+app = FastAPI(title="TradePackage AI", description="Powerful AI Coding Assistant", default_response_class=TimedJSONResponse)
+
+# The Telegram bot when main.py runs it in this process (telegram_bot.InProcessBot).
+app.state.telegram = None
+
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,83 +51,256 @@ class ChatRequest(BaseModel):
     user_id: Optional[str] = "default"
     context: Optional[str] = None
     max_tokens: Optional[int] = 4096
+    model: Optional[str] = None
 
 class CodeRequest(BaseModel):
     code: str
     language: Optional[str] = "auto"
     user_id: Optional[str] = "default"
+    model: Optional[str] = None
 
 class GenerateRequest(BaseModel):
     description: str
     language: str
     user_id: Optional[str] = "default"
+    model: Optional[str] = None
 
 class ResearchRequest(BaseModel):
     topic: str
     user_id: Optional[str] = "default"
+    model: Optional[str] = None
 
 class WebsiteRequest(BaseModel):
     description: str
     user_id: Optional[str] = "default"
+    model: Optional[str] = None
 
 class ClearHistoryRequest(BaseModel):
     user_id: str
 
 class ModelRequest(BaseModel):
     model_id: str
+    user_id: Optional[str] = None
+
+@app.exception_handler(UpstreamBusy)
+async def upstream_busy(request: Request, exc: UpstreamBusy):
+    # Shed or rate-limited by the upstream gate: tell the client when to come back.
+    AI_ERRORS.inc(type(exc).__name__)
+    retry_after = max(1, math.ceil(exc.retry_after or 1))
+    return JSONResponse(
+        status_code=429,
+        content={"detail": str(exc), "retry_after": retry_after},
+        headers={"Retry-After": str(retry_after)},
+    )
+
+async def sse_response(chunks) -> StreamingResponse:
+    """
+    Wrap an async iterator of text deltas as a Server-Sent Events stream:
+    one `data: {"delta": ...}` event per chunk, then a final `done` event.
+    The first delta is awaited before responding, so a request the upstream
+    gate turns away gets a 429 instead of a stream.
+    """
+    first = await anext(chunks, None)
+    
+    async def deltas():
+        if first is not None:
+            yield first
+        async for chunk in chunks:
+            yield chunk
+    
+    async def events():
+        encoding = 0.0
+        try:
+            async for chunk in deltas():
+                start = time.perf_counter()
+                event = f"data: {dumps({'delta': chunk}).decode()}\n\n"
+                encoding += time.perf_counter() - start
+                yield event
+            yield "event: done\ndata: {}\n\n"
+        finally:
+            SERIALIZE_SECONDS.observe(encoding, "sse")
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/api/health")
 async def health():
     return {"status": "healthy", "service": "TradePackage AI"}
 
+@app.get("/api/stats")
+async def stats():
+    stats = {
+        "upstream": ai_client.gate.stats(),
+        "history": ai_client.history.stats(),
+        "compaction": ai_client.compactor.stats(),
+        "cache": ai_client.cache.stats(),
+        "coalescing": ai_client.flights.stats(),
+        "routing": ai_client.router.stats(),
+        "jobs": job_queue.stats(),
+    }
+    if app.state.telegram:
+        stats["telegram"] = app.state.telegram.stats()
+    return stats
+
+@app.get("/api/metrics")
+async def metrics():
+    """Prometheus text format. Gauges are read from the components' stats at scrape time."""
+    history = ai_client.history.stats()
+    for unit in ("users", "messages", "tokens"):
+        HISTORY_SIZE.set(history[unit], unit)
+    HISTORY_SIZE.set(history["approx_bytes"], "bytes")
+    for lane, stats in ai_client.gate.stats()["lanes"].items():
+        UPSTREAM_IN_FLIGHT.set(stats["in_flight"], lane)
+        UPSTREAM_QUEUED.set(stats["queue_depth"], lane)
+    jobs = job_queue.stats()
+    for status in ("queued", "running"):
+        JOBS.set(jobs[status], status)
+    cache = ai_client.cache.stats()
+    RESPONSE_CACHE_BYTES.set(cache["memory_bytes"], "memory")
+    RESPONSE_CACHE_BYTES.set(cache["disk_bytes"], "disk")
+    if app.state.telegram:
+        bot = app.state.telegram.stats()
+        for state in ("running", "waiting_for_slot", "queued_behind_chat"):
+            TELEGRAM_UPDATES.set(bot[state], state)
+        TELEGRAM_CHATS_ACTIVE.set(bot["chats_active"])
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+@app.post("/api/cache/clear")
+async def clear_cache():
+    ai_client.cache.clear()
+    return {"status": "cleared"}
+
 @app.post("/api/chat")
 async def chat(req: ChatRequest):
-    response = await ai_client.chat(req.text, req.user_id, req.context, req.max_tokens)
+    response = await ai_client.chat(req.text, req.user_id, req.context, req.max_tokens, req.model)
     return {"response": response}
 
 @app.post("/api/analyze")
 async def analyze_code(req: CodeRequest):
-    response = await ai_client.analyze_code(req.code, req.language, req.user_id)
+    response = await ai_client.analyze_code(req.code, req.language, req.user_id, req.model)
     return {"analysis": response}
 
 @app.post("/api/generate")
 async def generate_code(req: GenerateRequest):
-    response = await ai_client.generate_code(req.description, req.language, req.user_id)
+    response = await ai_client.generate_code(req.description, req.language, req.user_id, req.model)
     return {"code": response}
 
 @app.post("/api/research")
 async def research(req: ResearchRequest):
-    response = await ai_client.research(req.topic, req.user_id)
+    response = await ai_client.research(req.topic, req.user_id, req.model)
     return {"research": response}
 
 @app.post("/api/website")
 async def create_website(req: WebsiteRequest):
-    response = await ai_client.create_website(req.description, req.user_id)
+    response = await ai_client.create_website(req.description, req.user_id, req.model)
     return {"website": response}
 
+@app.post("/api/chat/stream")
+async def chat_stream(req: ChatRequest):
+    return await sse_response(ai_client.chat_stream(req.text, req.user_id, req.context, req.max_tokens, req.model))
+
+@app.post("/api/analyze/stream")
+async def analyze_code_stream(req: CodeRequest):
+    return await sse_response(ai_client.analyze_code_stream(req.code, req.language, req.user_id, req.model))
+
+@app.post("/api/generate/stream")
+async def generate_code_stream(req: GenerateRequest):
+    return await sse_response(ai_client.generate_code_stream(req.description, req.language, req.user_id, req.model))
+
+@app.post("/api/research/stream")
+async def research_stream(req: ResearchRequest):
+    return await sse_response(ai_client.research_stream(req.topic, req.user_id, req.model))
+
+@app.post("/api/website/stream")
+async def create_website_stream(req: WebsiteRequest):
+    return await sse_response(ai_client.create_website_stream(req.description, req.user_id, req.model))
+
+def submit_job(endpoint: str, user_id: str, fn) -> dict:
+    try:
+        job = job_queue.submit(endpoint, user_id, fn)
+    except JobQueueFull as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    return {"job_id": job.id, "status": job.status}
+
+@app.post("/api/chat/jobs", status_code=202)
+async def chat_job(req: ChatRequest):
+    return submit_job("chat", req.user_id, lambda: ai_client.chat(req.text, req.user_id, req.context, req.max_tokens, req.model))
+
+@app.post("/api/analyze/jobs", status_code=202)
+async def analyze_code_job(req: CodeRequest):
+    return submit_job("analyze", req.user_id, lambda: ai_client.analyze_code(req.code, req.language, req.user_id, req.model))
+
+@app.post("/api/generate/jobs", status_code=202)
+async def generate_code_job(req: GenerateRequest):
+    return submit_job("generate", req.user_id, lambda: ai_client.generate_code(req.description, req.language, req.user_id, req.model))
+
+@app.post("/api/research/jobs", status_code=202)
+async def research_job(req: ResearchRequest):
+    return submit_job("research", req.user_id, lambda: ai_client.research(req.topic, req.user_id, req.model))
+
+@app.post("/api/website/jobs", status_code=202)
+async def create_website_job(req: WebsiteRequest):
+    return submit_job("website", req.user_id, lambda: ai_client.create_website(req.description, req.user_id, req.model))
+
+@app.get("/api/jobs/{job_id}")
+async def get_job(job_id: str, wait: float = 0):
+    """Job status and, once done, its result. `wait` blocks up to that many seconds for it to finish."""
+    job = await job_queue.wait(job_id, wait)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Unknown or expired job")
+    return job.to_dict()
+
+@app.post("/api/telegram/webhook")
+async def telegram_webhook(request: Request):
+    bot = app.state.telegram
+    if bot is None or not bot.secret:
+        raise HTTPException(status_code=404, detail="Not Found")
+    token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+    if not secrets.compare_digest(token, bot.secret):
+        raise HTTPException(status_code=403, detail="Forbidden")
+    if not bot.receive(await request.json()):
+        # Telegram retries until the bot is up.
+        raise HTTPException(status_code=503, detail="Bot not running")
+    return {"ok": True}
+
 @app.post("/api/clear-history")
 async def clear_history(req: ClearHistoryRequest):
     ai_client.clear_history(req.user_id)
     return {"status": "cleared"}
 
 @app.get("/api/models")
-async def get_models():
+async def get_models(user_id: Optional[str] = None):
     return {
         "models": ai_client.get_available_models(),
-        "current": ai_client.current_model
+        "current": ai_client.get_model(user_id)
     }
 
 @app.post("/api/set-model")
 async def set_model(req: ModelRequest):
-    if ai_client.set_model(req.model_id):
+    if ai_client.set_model(req.model_id, req.user_id):
         return {"status": "success", "model": req.model_id}
     return {"status": "error", "message": "Invalid model"}
 
-app.mount("/static", StaticFiles(directory="static"), name="static")
+static_assets = StaticAssets("static")
+
+def static_response(request: Request, path: str, cache_control: str) -> Response:
+    found = static_assets.response(path, request.headers, cache_control)
+    if found is None:
+        raise HTTPException(status_code=404, detail="Not Found")
+    status, headers, body = found
+    return Response(body, status_code=status, headers=headers)
+
+@app.get("/static/{path:path}")
+async def serve_static(request: Request, path: str):
+    return static_response(request, path, f"public, max-age={STATIC_MAX_AGE}")
 
 @app.get("/")
-async def serve_frontend():
-    return FileResponse("static/index.html")
+async def serve_frontend(request: Request):
+    # Revalidated on every load (a 304 while unchanged), so a deploy shows up at once.
+    return static_response(request, "index.html", "no-cache")
 
 if __name__ == "__main__":
     uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=True)
@@ -0,0 +1,177 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+RESPONSE_CACHE = os.environ.get("RESPONSE_CACHE", "").lower() in ("1", "true", "yes", "on")
+RESPONSE_CACHE_TTL = float(os.environ.get("RESPONSE_CACHE_TTL", "86400"))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+RESPONSE_CACHE_DB = os.environ.get("RESPONSE_CACHE_DB", "")
+RESPONSE_CACHE_DISK_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+
+
+def normalize_prompt(text: str) -> str:
+    # Whitespace and case differences don't change what a research topic or
+    # a website description asks for. Code is keyed verbatim by the caller.
+    return " ".join(text.split()).casefold()
+
+
+class ResponseCache:
+    """
+    Two-tier completion cache. The memory tier is an LRU bounded by
+    `max_bytes`; the optional disk tier is an SQLite file bounded by
+    `disk_max_bytes`, evicting least recently read entries first. Entries
+    expire `ttl` seconds after they were stored. Disabled caches miss on
+    every lookup and store nothing.
+    """
+
+    def __init__(self, enabled: bool = RESPONSE_CACHE, ttl: float = RESPONSE_CACHE_TTL,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, disk_path: str = RESPONSE_CACHE_DB,
+                 disk_max_bytes: int = RESPONSE_CACHE_DISK_MAX_BYTES):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.disk_max_bytes = disk_max_bytes
+        self._memory = OrderedDict()
+        self.memory_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.disk_evictions = 0
+        self.expired = 0
+
+        self._lock = threading.Lock()
+        self._db = None
+        self.disk_bytes = 0
+        if enabled and disk_path:
+            self._db = sqlite3.connect(disk_path, timeout=10, check_same_thread=False, isolation_level=None)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS responses (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    expires REAL NOT NULL,
+                    accessed REAL NOT NULL
+                )
+            """)
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+            self._db.execute("DELETE FROM responses WHERE expires < ?", (time.time(),))
+            self.disk_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    @staticmethod
+    def key(model: str, endpoint: str, prompt: str, history: list) -> str:
+        history_hash = hashlib.sha256(json.dumps(history, sort_keys=True).encode("utf-8")).hexdigest()
+        raw = json.dumps([model, endpoint, prompt, history_hash])
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires, size = entry
+                if expires > now:
+                    self._memory.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._remove_memory(key)
+                self.expired += 1
+
+            if self._db is not None:
+                row = self._db.execute("SELECT value, expires FROM responses WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    value, expires = row
+                    if expires > now:
+                        self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+                        self._put_memory(key, value, expires)
+                        self.hits += 1
+                        self.disk_hits += 1
+                        return value
+                    self._remove_disk(key)
+                    self.expired += 1
+
+            self.misses += 1
+            return None
+
+    def put(self, key: str, value: str):
+        if not self.enabled:
+            return
+        now = time.time()
+        expires = now + self.ttl
+        with self._lock:
+            self.stores += 1
+            self._put_memory(key, value, expires)
+            if self._db is not None:
+                self._remove_disk(key)
+                size = len(value.encode("utf-8"))
+                self._db.execute(
+                    "INSERT INTO responses (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, size, expires, now),
+                )
+                self.disk_bytes += size
+                while self.disk_bytes > self.disk_max_bytes:
+                    row = self._db.execute("SELECT key FROM responses ORDER BY accessed LIMIT 1").fetchone()
+                    if row is None:
+                        break
+                    self._remove_disk(row[0])
+                    self.disk_evictions += 1
+
+    def _put_memory(self, key: str, value: str, expires: float):
+        if key in self._memory:
+            self._remove_memory(key)
+        size = sys.getsizeof(value)
+        if size > self.max_bytes:
+            return
+        self._memory[key] = (value, expires, size)
+        self.memory_bytes += size
+        while self.memory_bytes > self.max_bytes:
+            oldest = next(iter(self._memory))
+            self._remove_memory(oldest)
+            self.evictions += 1
+
+    def _remove_memory(self, key: str):
+        _, _, size = self._memory.pop(key)
+        self.memory_bytes -= size
+
+    def _remove_disk(self, key: str):
+        row = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.disk_bytes -= row[0]
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            self.memory_bytes = 0
+            if self._db is not None:
+                self._db.execute("DELETE FROM responses")
+                self.disk_bytes = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._memory),
+            "memory_bytes": self.memory_bytes,
+            "max_bytes": self.max_bytes,
+            "disk_enabled": self._db is not None,
+            "disk_bytes": self.disk_bytes,
+            "ttl_s": self.ttl,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "disk_evictions": self.disk_evictions,
+            "expired": self.expired,
+        }
@@ -0,0 +1,123 @@
+import os
+import time
+import asyncio
+import logging
+
+from history import HISTORY_TOKEN_BUDGET, estimate_tokens
+from metrics import counter, histogram
+
+logger = logging.getLogger(__name__)
+
+HISTORY_COMPACTION = os.environ.get("HISTORY_COMPACTION", "").lower() in ("1", "true", "yes", "on")
+# A conversation is compacted once it holds this many estimated tokens. Below
+# the history budget, so older turns are summarized before trimming drops them.
+HISTORY_COMPACT_AT_TOKENS = int(os.environ.get("HISTORY_COMPACT_AT_TOKENS", str(HISTORY_TOKEN_BUDGET * 3 // 4)))
+# The newest turns, worth about this many tokens, are always kept verbatim.
+HISTORY_COMPACT_KEEP_TOKENS = int(os.environ.get("HISTORY_COMPACT_KEEP_TOKENS", str(HISTORY_TOKEN_BUDGET // 4)))
+HISTORY_COMPACT_MODEL = os.environ.get("HISTORY_COMPACT_MODEL", "llama-3.1-8b-instant")
+HISTORY_SUMMARY_MAX_TOKENS = int(os.environ.get("HISTORY_SUMMARY_MAX_TOKENS", "512"))
+
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+COMPACTIONS = counter("history_compactions_total", "Background history compactions, by outcome.", ("outcome",))
+COMPACTION_SECONDS = histogram("history_compaction_seconds", "Time to summarize and replace older turns.")
+COMPACTION_TOKENS_SAVED = counter("history_compaction_tokens_saved_total", "Estimated history tokens removed by compaction.")
+
+
+class Compactor:
+    """
+    Summarizes the older turns of long conversations in the background and
+    puts the summary in their place, so history stays within budget without
+    losing what was said early on. `summarize(user_id, messages)` is awaited
+    off the request path; at most one compaction per user runs at a time.
+    """
+
+    def __init__(self, history, summarize, enabled: bool = HISTORY_COMPACTION,
+                 at_tokens: int = HISTORY_COMPACT_AT_TOKENS, keep_tokens: int = HISTORY_COMPACT_KEEP_TOKENS):
+        self.history = history
+        self.summarize = summarize
+        self.enabled = enabled
+        self.at_tokens = at_tokens
+        self.keep_tokens = keep_tokens
+        self._running = set()
+        self._tasks = set()
+        self.compactions = 0
+        self.discarded = 0
+        self.failed = 0
+        self.messages_compacted = 0
+        self.tokens_before = 0
+        self.tokens_after = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def maybe_compact(self, user_id: str):
+        """Start compacting `user_id`'s conversation if it has grown past `at_tokens`."""
+        if not self.enabled or user_id in self._running:
+            return
+        if self.history.tokens(user_id) < self.at_tokens:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        self._running.add(user_id)
+        task = loop.create_task(self._compact(user_id))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _compact(self, user_id: str):
+        try:
+            found = self.history.compaction_prefix(user_id, self.keep_tokens)
+            if found is None:
+                return
+            messages, marker = found
+            started = time.monotonic()
+            try:
+                summary = await self.summarize(user_id, messages)
+            except Exception as e:
+                self.failed += 1
+                COMPACTIONS.inc("error")
+                logger.warning("History compaction for %s failed: %s: %s", user_id, type(e).__name__, e)
+                return
+            if not summary or not summary.strip():
+                self.failed += 1
+                COMPACTIONS.inc("error")
+                return
+            content = SUMMARY_HEADER + summary.strip()
+            # The conversation may have been trimmed or cleared meanwhile.
+            if not self.history.replace_prefix(user_id, marker, content):
+                self.discarded += 1
+                COMPACTIONS.inc("discarded")
+                return
+            elapsed = time.monotonic() - started
+            before = sum(estimate_tokens(m["content"]) for m in messages)
+            after = estimate_tokens(content)
+            self.compactions += 1
+            self.messages_compacted += len(messages)
+            self.tokens_before += before
+            self.tokens_after += after
+            self.total_seconds += elapsed
+            self.max_seconds = max(self.max_seconds, elapsed)
+            COMPACTIONS.inc("ok")
+            COMPACTION_SECONDS.observe(elapsed)
+            COMPACTION_TOKENS_SAVED.inc(amount=max(0, before - after))
+        finally:
+            self._running.discard(user_id)
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "at_tokens": self.at_tokens,
+            "keep_tokens": self.keep_tokens,
+            "model": HISTORY_COMPACT_MODEL,
+            "in_progress": len(self._running),
+            "compactions": self.compactions,
+            "discarded": self.discarded,
+            "failed": self.failed,
+            "messages_compacted": self.messages_compacted,
+            "tokens_compacted": self.tokens_before,
+            "summary_tokens": self.tokens_after,
+            "tokens_saved": self.tokens_before - self.tokens_after,
+            "avg_latency_ms": round(self.total_seconds / self.compactions * 1000, 1) if self.compactions else 0.0,
+            "max_latency_ms": round(self.max_seconds * 1000, 1),
+        }
@@ -0,0 +1,501 @@
+import os
+import sys
+import time
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict, deque
+
+HISTORY_TOKEN_BUDGET = int(os.environ.get("HISTORY_TOKEN_BUDGET", "8000"))
+HISTORY_MAX_MESSAGES = int(os.environ.get("HISTORY_MAX_MESSAGES", "200"))
+HISTORY_MAX_TOTAL_TOKENS = int(os.environ.get("HISTORY_MAX_TOTAL_TOKENS", "20000000"))
+HISTORY_IDLE_TTL = float(os.environ.get("HISTORY_IDLE_TTL", "86400"))
+
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "memory")
+HISTORY_DB_PATH = os.environ.get("HISTORY_DB_PATH", "history.db")
+HISTORY_FLUSH_INTERVAL = float(os.environ.get("HISTORY_FLUSH_INTERVAL", "0.25"))
+HISTORY_FLUSH_BATCH = int(os.environ.get("HISTORY_FLUSH_BATCH", "64"))
+HISTORY_MAINTENANCE_INTERVAL = float(os.environ.get("HISTORY_MAINTENANCE_INTERVAL", "60"))
+
+# Fixed per-message cost on top of the text itself (role, separators).
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token holds well enough for English prose and code
+    # with the LLaMA/Mixtral tokenizers; exact counts aren't needed here.
+    return len(text) // 4 + MESSAGE_OVERHEAD_TOKENS
+
+
+def compaction_split(entries: list, keep_tokens: int) -> int:
+    """
+    Where to cut a conversation, given as (role, tokens) pairs oldest first,
+    for compaction: the index of the first message kept verbatim. The kept
+    tail holds the newest messages worth `keep_tokens` (at least the newest
+    one) and is widened back to start at a user message.
+    """
+    split = len(entries)
+    kept = 0
+    while split > 0 and (split == len(entries) or kept + entries[split - 1][1] <= keep_tokens):
+        split -= 1
+        kept += entries[split][1]
+    while split > 0 and entries[split][0] != "user":
+        split -= 1
+    return split
+
+
+class Conversation:
+    __slots__ = ("messages", "tokens", "size", "last_used")
+
+    def __init__(self):
+        # (message, tokens, bytes) triples, oldest first
+        self.messages = deque()
+        self.tokens = 0
+        self.size = 0
+        self.last_used = time.monotonic()
+
+
+class HistoryStore:
+    """
+    In-memory conversation history. Each conversation is trimmed from the
+    oldest end to `token_budget` estimated tokens (and `max_messages`), so
+    trimming is O(1) per dropped message. Conversations are kept in LRU
+    order: ones idle for longer than `idle_ttl` seconds are dropped, and the
+    least recently used go first whenever the total across all users
+    exceeds `max_total_tokens`.
+    """
+
+    def __init__(self, token_budget: int = HISTORY_TOKEN_BUDGET, max_messages: int = HISTORY_MAX_MESSAGES,
+                 max_total_tokens: int = HISTORY_MAX_TOTAL_TOKENS, idle_ttl: float = HISTORY_IDLE_TTL):
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.max_total_tokens = max_total_tokens
+        self.idle_ttl = idle_ttl
+        self._conversations = OrderedDict()
+        self.total_tokens = 0
+        self.total_messages = 0
+        self.total_bytes = 0
+        self.trimmed_messages = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+    def _touch(self, user_id: str, create: bool = False):
+        conv = self._conversations.get(user_id)
+        if conv is None:
+            if not create:
+                return None
+            conv = self._conversations[user_id] = Conversation()
+        else:
+            self._conversations.move_to_end(user_id)
+        conv.last_used = time.monotonic()
+        return conv
+
+    def _pop_oldest(self, conv: Conversation):
+        _, tokens, size = conv.messages.popleft()
+        conv.tokens -= tokens
+        conv.size -= size
+        self.total_tokens -= tokens
+        self.total_bytes -= size
+        self.total_messages -= 1
+
+    def _drop(self, user_id: str):
+        conv = self._conversations.pop(user_id)
+        self.total_tokens -= conv.tokens
+        self.total_bytes -= conv.size
+        self.total_messages -= len(conv.messages)
+
+    def _evict(self, keep: str = None):
+        cutoff = time.monotonic() - self.idle_ttl
+        while self._conversations:
+            user_id, conv = next(iter(self._conversations.items()))
+            if conv.last_used >= cutoff or user_id == keep:
+                break
+            self._drop(user_id)
+            self.evicted_idle += 1
+        while self.total_tokens > self.max_total_tokens and len(self._conversations) > 1:
+            user_id = next(iter(self._conversations))
+            if user_id == keep:
+                self._conversations.move_to_end(user_id)
+                continue
+            self._drop(user_id)
+            self.evicted_lru += 1
+
+    def append(self, user_id: str, role: str, content: str):
+        conv = self._touch(user_id, create=True)
+        message = {"role": role, "content": content}
+        tokens = estimate_tokens(content)
+        size = sys.getsizeof(content) + sys.getsizeof(message)
+        conv.messages.append((message, tokens, size))
+        conv.tokens += tokens
+        conv.size += size
+        self.total_tokens += tokens
+        self.total_bytes += size
+        self.total_messages += 1
+
+        # Always keep the newest message, even if it alone is over budget,
+        # and never start a conversation with an orphaned assistant reply.
+        while len(conv.messages) > 1 and (conv.tokens > self.token_budget or len(conv.messages) > self.max_messages):
+            self._pop_oldest(conv)
+            self.trimmed_messages += 1
+        while len(conv.messages) > 1 and conv.messages[0][0]["role"] == "assistant":
+            self._pop_oldest(conv)
+            self.trimmed_messages += 1
+
+        self._evict(keep=user_id)
+
+    def get(self, user_id: str, token_budget: int = None) -> list:
+        """
+        Most recent messages of the conversation, oldest first, that fit in
+        `token_budget` estimated tokens (the store's budget by default).
+        """
+        conv = self._touch(user_id)
+        if conv is None:
+            return []
+        budget = self.token_budget if token_budget is None else token_budget
+        if conv.tokens <= budget:
+            return [m for m, _, _ in conv.messages]
+        picked = []
+        used = 0
+        for message, tokens, _ in reversed(conv.messages):
+            if used + tokens > budget:
+                break
+            picked.append(message)
+            used += tokens
+        while picked and picked[-1]["role"] == "assistant":
+            picked.pop()
+        picked.reverse()
+        return picked
+
+    def clear(self, user_id: str):
+        if user_id in self._conversations:
+            self._drop(user_id)
+
+    def tokens(self, user_id: str) -> int:
+        conv = self._conversations.get(user_id)
+        return conv.tokens if conv is not None else 0
+
+    def compaction_prefix(self, user_id: str, keep_tokens: int):
+        """
+        The messages to summarize: all but the tail compaction_split keeps.
+        Returns (messages, marker) for replace_prefix, or None when there
+        isn't at least an exchange to fold in.
+        """
+        conv = self._conversations.get(user_id)
+        if conv is None:
+            return None
+        split = compaction_split([(m["role"], tokens) for m, tokens, _ in conv.messages], keep_tokens)
+        if split < 2:
+            return None
+        prefix = [m for m, _, _ in list(conv.messages)[:split]]
+        return prefix, prefix
+
+    def replace_prefix(self, user_id: str, marker: list, summary: str) -> bool:
+        """
+        Swap the messages compaction_prefix returned for one summary
+        message, unless the conversation no longer starts with them
+        (trimmed or cleared meanwhile). Returns whether it did.
+        """
+        conv = self._conversations.get(user_id)
+        if conv is None or len(conv.messages) < len(marker):
+            return False
+        if any(entry[0] is not message for entry, message in zip(conv.messages, marker)):
+            return False
+        for _ in marker:
+            self._pop_oldest(conv)
+        message = {"role": "system", "content": summary}
+        tokens = estimate_tokens(summary)
+        size = sys.getsizeof(summary) + sys.getsizeof(message)
+        conv.messages.appendleft((message, tokens, size))
+        conv.tokens += tokens
+        conv.size += size
+        self.total_tokens += tokens
+        self.total_bytes += size
+        self.total_messages += 1
+        return True
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+    def stats(self) -> dict:
+        self._evict()
+        return {
+            "backend": "memory",
+            "users": len(self._conversations),
+            "messages": self.total_messages,
+            "tokens": self.total_tokens,
+            "approx_bytes": self.total_bytes,
+            "token_budget": self.token_budget,
+            "max_total_tokens": self.max_total_tokens,
+            "idle_ttl_s": self.idle_ttl,
+            "trimmed_messages": self.trimmed_messages,
+            "evicted_idle": self.evicted_idle,
+            "evicted_lru": self.evicted_lru,
+        }
+
+
+class SQLiteHistoryStore:
+    """
+    Conversation history in an SQLite database in WAL mode, so several
+    uvicorn workers (and restarts) share the same memory. Appends are
+    buffered and written in one transaction by the flush thread, woken
+    early once `flush_batch` messages are pending, so callers on the event
+    loop never wait on the database for a write; reads merge this
+    process's pending messages with the indexed rows. Per-conversation
+    trimming follows the same token budget as HistoryStore, while idle and
+    global-cap eviction run from the flush thread every
+    `maintenance_interval` seconds.
+    """
+
+    def __init__(self, path: str = HISTORY_DB_PATH, token_budget: int = HISTORY_TOKEN_BUDGET,
+                 max_messages: int = HISTORY_MAX_MESSAGES, max_total_tokens: int = HISTORY_MAX_TOTAL_TOKENS,
+                 idle_ttl: float = HISTORY_IDLE_TTL, flush_interval: float = HISTORY_FLUSH_INTERVAL,
+                 flush_batch: int = HISTORY_FLUSH_BATCH, maintenance_interval: float = HISTORY_MAINTENANCE_INTERVAL):
+        self.path = path
+        self.token_budget = token_budget
+        self.max_messages = max_messages
+        self.max_total_tokens = max_total_tokens
+        self.idle_ttl = idle_ttl
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.maintenance_interval = maintenance_interval
+        self.flushes = 0
+        self.flushed_messages = 0
+        self.trimmed_messages = 0
+        self.evicted_idle = 0
+        self.evicted_lru = 0
+
+        self._lock = threading.Lock()  # the connection, and flushes as a whole
+        # Only guards the pending list, so append() never waits for a write
+        # in progress. Rows are removed from it only under both locks.
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._db = sqlite3.connect(path, timeout=10, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                role TEXT NOT NULL,
+                content TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                created REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS messages_user ON messages (user_id, id);
+        """)
+
+        self._closed = threading.Event()
+        self._wake = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name="history-flush", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def _flush_loop(self):
+        last_maintenance = time.monotonic()
+        while not self._closed.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+                if time.monotonic() - last_maintenance >= self.maintenance_interval:
+                    last_maintenance = time.monotonic()
+                    self.evict()
+            except sqlite3.Error:
+                # A locked or busy database is retried on the next tick.
+                pass
+
+    def append(self, user_id: str, role: str, content: str):
+        with self._pending_lock:
+            self._pending.append((user_id, role, content, estimate_tokens(content), time.time()))
+            full = len(self._pending) >= self.flush_batch
+        if full:
+            self._wake.set()
+
+    def flush(self):
+        with self._lock:
+            # The batch stays pending until it's committed, so a locked
+            # database (BEGIN failing) or a failed insert loses nothing.
+            with self._pending_lock:
+                batch = list(self._pending)
+            if not batch:
+                return
+            users = {row[0] for row in batch}
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(
+                    "INSERT INTO messages (user_id, role, content, tokens, created) VALUES (?, ?, ?, ?, ?)", batch
+                )
+                for user_id in users:
+                    self._trim(user_id)
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+            with self._pending_lock:
+                # Appends made meanwhile went to the end.
+                del self._pending[:len(batch)]
+            self.flushes += 1
+            self.flushed_messages += len(batch)
+
+    def _trim(self, user_id: str):
+        # Newest messages are kept while they fit the budget; the newest one
+        # always survives, and an assistant reply never leads a conversation.
+        rows = self._db.execute(
+            "SELECT id, role, tokens FROM messages WHERE user_id = ? ORDER BY id DESC", (user_id,)
+        ).fetchall()
+        used = 0
+        keep = 0
+        for n, (_, _, tokens) in enumerate(rows):
+            if n and (used + tokens > self.token_budget or n >= self.max_messages):
+                break
+            used += tokens
+            keep = n + 1
+        while keep > 1 and rows[keep - 1][1] == "assistant":
+            keep -= 1
+        if keep < len(rows):
+            cur = self._db.execute("DELETE FROM messages WHERE user_id = ? AND id < ?", (user_id, rows[keep - 1][0]))
+            self.trimmed_messages += cur.rowcount
+
+    def evict(self):
+        with self._lock:
+            cutoff = time.time() - self.idle_ttl
+            cur = self._db.execute(
+                "DELETE FROM messages WHERE user_id IN "
+                "(SELECT user_id FROM messages GROUP BY user_id HAVING MAX(created) < ?)", (cutoff,)
+            )
+            self.evicted_idle += cur.rowcount
+            total = self._db.execute("SELECT COALESCE(SUM(tokens), 0) FROM messages").fetchone()[0]
+            if total <= self.max_total_tokens:
+                return
+            users = self._db.execute(
+                "SELECT user_id, SUM(tokens) FROM messages GROUP BY user_id ORDER BY MAX(created)"
+            ).fetchall()
+            for user_id, tokens in users[:-1]:
+                if total <= self.max_total_tokens:
+                    break
+                self._db.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+                total -= tokens
+                self.evicted_lru += 1
+
+    def get(self, user_id: str, token_budget: int = None) -> list:
+        budget = self.token_budget if token_budget is None else token_budget
+        with self._lock:
+            with self._pending_lock:
+                pending = list(self._pending)
+            newest_first = [(role, content, tokens) for uid, role, content, tokens, _ in reversed(pending) if uid == user_id]
+            rows = self._db.execute(
+                "SELECT role, content, tokens FROM messages WHERE user_id = ? ORDER BY id DESC LIMIT ?",
+                (user_id, self.max_messages),
+            ).fetchall()
+        picked = []
+        used = 0
+        for role, content, tokens in newest_first + rows:
+            if used + tokens > budget or len(picked) >= self.max_messages:
+                break
+            picked.append({"role": role, "content": content})
+            used += tokens
+        while picked and picked[-1]["role"] == "assistant":
+            picked.pop()
+        picked.reverse()
+        return picked
+
+    def clear(self, user_id: str):
+        with self._lock:
+            with self._pending_lock:
+                self._pending = [row for row in self._pending if row[0] != user_id]
+            self._db.execute("DELETE FROM messages WHERE user_id = ?", (user_id,))
+
+    def tokens(self, user_id: str) -> int:
+        with self._lock:
+            with self._pending_lock:
+                pending = sum(row[3] for row in self._pending if row[0] == user_id)
+            stored = self._db.execute(
+                "SELECT COALESCE(SUM(tokens), 0) FROM messages WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+        return pending + stored
+
+    def compaction_prefix(self, user_id: str, keep_tokens: int):
+        """See HistoryStore.compaction_prefix; the marker is (first id, last id, count)."""
+        self.flush()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, role, content, tokens FROM messages WHERE user_id = ? ORDER BY id", (user_id,)
+            ).fetchall()
+        split = compaction_split([(role, tokens) for _, role, _, tokens in rows], keep_tokens)
+        if split < 2:
+            return None
+        prefix = rows[:split]
+        return [{"role": role, "content": content} for _, role, content, _ in prefix], (prefix[0][0], prefix[-1][0], split)
+
+    def replace_prefix(self, user_id: str, marker: tuple, summary: str) -> bool:
+        """
+        See HistoryStore.replace_prefix. The summary takes the last replaced
+        message's id, so it stays ahead of everything kept; another worker
+        compacting the same conversation first makes this one a no-op.
+        """
+        first, last, count = marker
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                found, lowest = self._db.execute(
+                    "SELECT COUNT(*), MIN(id) FROM messages WHERE user_id = ? AND id <= ?", (user_id, last)
+                ).fetchone()
+                if found != count or lowest != first:
+                    self._db.execute("ROLLBACK")
+                    return False
+                self._db.execute("DELETE FROM messages WHERE user_id = ? AND id <= ?", (user_id, last))
+                self._db.execute(
+                    "INSERT INTO messages (id, user_id, role, content, tokens, created) VALUES (?, ?, ?, ?, ?, ?)",
+                    (last, user_id, "system", summary, estimate_tokens(summary), time.time()),
+                )
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        return True
+
+    def close(self):
+        if self._closed.is_set():
+            return
+        self._closed.set()
+        self._wake.set()
+        self._thread.join(timeout=5)
+        self.flush()
+        self._db.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            users, messages, tokens, size = self._db.execute(
+                "SELECT COUNT(DISTINCT user_id), COUNT(*), COALESCE(SUM(tokens), 0), COALESCE(SUM(LENGTH(content)), 0) FROM messages"
+            ).fetchone()
+            with self._pending_lock:
+                pending = len(self._pending)
+        return {
+            "backend": "sqlite",
+            "path": self.path,
+            "users": users,
+            "messages": messages,
+            "pending": pending,
+            "tokens": tokens,
+            "approx_bytes": size,
+            "db_bytes": sum(os.path.getsize(p) for p in (self.path, self.path + "-wal") if os.path.exists(p)),
+            "token_budget": self.token_budget,
+            "max_total_tokens": self.max_total_tokens,
+            "idle_ttl_s": self.idle_ttl,
+            "flushes": self.flushes,
+            "flushed_messages": self.flushed_messages,
+            "trimmed_messages": self.trimmed_messages,
+            "evicted_idle": self.evicted_idle,
+            "evicted_lru": self.evicted_lru,
+        }
+
+
+def make_history_store(backend: str = HISTORY_BACKEND):
+    if backend == "sqlite":
+        return SQLiteHistoryStore()
+    if backend == "memory":
+        return HistoryStore()
+    raise ValueError(f"Unknown HISTORY_BACKEND: {backend}")
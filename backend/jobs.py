@@ -0,0 +1,175 @@
+import os
+import time
+import uuid
+import asyncio
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+JOB_QUEUE_LIMIT = int(os.environ.get("JOB_QUEUE_LIMIT", "500"))
+JOB_RESULT_TTL = float(os.environ.get("JOB_RESULT_TTL", "3600"))
+# Longest a single status request may block waiting for a job to finish.
+JOB_MAX_WAIT = float(os.environ.get("JOB_MAX_WAIT", "60"))
+# Times a job turned away with a retry_after (upstream busy or the user over
+# its rate limit) goes back in the queue before it fails.
+JOB_MAX_RETRIES = int(os.environ.get("JOB_MAX_RETRIES", "5"))
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, endpoint: str, user_id: str, fn):
+        self.id = uuid.uuid4().hex
+        self.endpoint = endpoint
+        self.user_id = user_id
+        self.fn = fn
+        self.status = QUEUED
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.retries = 0
+        self.done = asyncio.Event()
+
+    def to_dict(self) -> dict:
+        now = time.time()
+        return {
+            "id": self.id,
+            "endpoint": self.endpoint,
+            "status": self.status,
+            "result": self.result,
+            "error": self.error,
+            "queued_s": round((self.started or now) - self.created, 2),
+            "run_s": round((self.finished or now) - self.started, 2) if self.started else None,
+            "retries": self.retries,
+        }
+
+
+class JobQueue:
+    """
+    Runs long generations in the background: submit() returns a Job at
+    once, `workers` tasks work through the queue in order, and finished
+    jobs (with their results) stay retrievable for `ttl` seconds. Workers
+    start on the first submit, on the loop it is called from.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, queue_limit: int = JOB_QUEUE_LIMIT, ttl: float = JOB_RESULT_TTL):
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.ttl = ttl
+        self.jobs = OrderedDict()
+        self._queue = None
+        self._tasks = []
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.expired = 0
+        self.rejected = 0
+        self.retried = 0
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            self._tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    def submit(self, endpoint: str, user_id: str, fn) -> Job:
+        """Queue `fn`, a no-argument coroutine function whose result is the job's result."""
+        self._start()
+        self._purge()
+        if self._queue.qsize() >= self.queue_limit:
+            self.rejected += 1
+            raise JobQueueFull(f"job queue is full ({self.queue_limit} waiting)")
+        job = Job(endpoint, user_id, fn)
+        self.jobs[job.id] = job
+        self._queue.put_nowait(job)
+        self.submitted += 1
+        return job
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            job.status = RUNNING
+            job.started = time.time()
+            deferred = False
+            try:
+                job.result = await job.fn()
+                job.status = DONE
+                self.completed += 1
+            except Exception as e:
+                deferred = self._defer(job, e)
+                if not deferred:
+                    logger.exception("job %s (%s) failed", job.id, job.endpoint)
+                    job.error = str(e)
+                    job.status = FAILED
+                    self.failed += 1
+            finally:
+                if not deferred:
+                    job.fn = None
+                    job.finished = time.time()
+                    job.done.set()
+
+    def _defer(self, job: Job, e: Exception) -> bool:
+        """Queue `job` again after the retry_after `e` carries, if it has one and retries are left."""
+        retry_after = getattr(e, "retry_after", None)
+        if not retry_after or job.retries >= JOB_MAX_RETRIES:
+            return False
+        # The worker moves on instead of holding its place while the job waits.
+        job.retries += 1
+        self.retried += 1
+        job.status = QUEUED
+        job.started = None
+        logger.info("job %s (%s) deferred %.0fs: %s", job.id, job.endpoint, retry_after, e)
+        asyncio.get_running_loop().call_later(retry_after, self._queue.put_nowait, job)
+        return True
+
+    def _purge(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [j.id for j in self.jobs.values() if j.finished and j.finished < cutoff]:
+            del self.jobs[job_id]
+            self.expired += 1
+
+    def get(self, job_id: str):
+        self._purge()
+        return self.jobs.get(job_id)
+
+    async def wait(self, job_id: str, timeout: float = 0):
+        """The job, after waiting up to `timeout` (capped at JOB_MAX_WAIT) for it to finish."""
+        job = self.get(job_id)
+        if job is not None and timeout > 0 and not job.done.is_set():
+            try:
+                await asyncio.wait_for(job.done.wait(), min(timeout, JOB_MAX_WAIT))
+            except asyncio.TimeoutError:
+                pass
+        return job
+
+    def stats(self) -> dict:
+        counts = {QUEUED: 0, RUNNING: 0, DONE: 0, FAILED: 0}
+        for job in self.jobs.values():
+            counts[job.status] += 1
+        return {
+            "workers": self.workers,
+            "queued": counts[QUEUED],
+            "running": counts[RUNNING],
+            "retained_done": counts[DONE],
+            "retained_failed": counts[FAILED],
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "rejected": self.rejected,
+            "retried": self.retried,
+            "expired": self.expired,
+            "result_ttl_s": self.ttl,
+        }
+
+
+job_queue = JobQueue()
@@ -0,0 +1,187 @@
+import os
+import time
+from collections import deque
+
+import groq
+
+MODEL_FALLBACKS = [m.strip() for m in os.environ.get(
+    "MODEL_FALLBACKS", "llama-3.3-70b-versatile,mixtral-8x7b-32768,llama-3.1-8b-instant"
+).split(",") if m.strip()]
+ROUTER_WINDOW = int(os.environ.get("ROUTER_WINDOW", "50"))
+CIRCUIT_ERROR_RATE = float(os.environ.get("CIRCUIT_ERROR_RATE", "0.5"))
+CIRCUIT_MIN_SAMPLES = int(os.environ.get("CIRCUIT_MIN_SAMPLES", "5"))
+CIRCUIT_COOLDOWN = float(os.environ.get("CIRCUIT_COOLDOWN", "30"))
+CIRCUIT_MAX_COOLDOWN = float(os.environ.get("CIRCUIT_MAX_COOLDOWN", "300"))
+
+AUTO_MODEL = "auto"
+
+# Rough completion latency in seconds, used by "auto" until a model has
+# enough samples of its own.
+LATENCY_PRIORS = {
+    "llama-3.1-8b-instant": 1.0,
+    "gemma2-9b-it": 1.5,
+    "mixtral-8x7b-32768": 2.0,
+    "llama-3.3-70b-versatile": 4.0,
+}
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+def _retry_after(error: Exception):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+class ModelHealth:
+    """Rolling latency/error window and circuit breaker state for one model."""
+
+    def __init__(self, window: int):
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)
+        self.state = CLOSED
+        self.open_until = 0.0
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.probing = False
+        self.requests = 0
+        self.failures = 0
+        self.rate_limited = 0
+        self.circuit_opens = 0
+        self.last_error = None
+
+    def percentile(self, p: float):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(p * len(ordered)))]
+
+    def error_rate(self) -> float:
+        if not self.outcomes:
+            return 0.0
+        return self.outcomes.count(False) / len(self.outcomes)
+
+    def available(self, now: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN and now >= self.open_until:
+            self.state = HALF_OPEN
+            self.probing = False
+        # Half-open lets exactly one probe request through at a time.
+        return self.state == HALF_OPEN and not self.probing
+
+    def open(self, now: float, cooldown: float):
+        self.state = OPEN
+        self.open_until = now + cooldown
+        self.probing = False
+        self.circuit_opens += 1
+
+
+class ModelRouter:
+    """
+    Tracks per-model latency and error rate and decides which models a
+    request may try, in order. A model's circuit opens on a rate limit (for
+    the upstream's retry-after, if given) or when its rolling error rate
+    reaches CIRCUIT_ERROR_RATE; after the cooldown one probe is let through,
+    and each failed probe doubles the cooldown up to CIRCUIT_MAX_COOLDOWN.
+    Requests for a model fall back along MODEL_FALLBACKS. The "auto" model
+    tries the healthy models that fit the prompt, fastest p50 first.
+    """
+
+    def __init__(self, context_windows: dict, fallbacks: list = MODEL_FALLBACKS, window: int = ROUTER_WINDOW):
+        self.context_windows = context_windows
+        self.fallbacks = [m for m in fallbacks if m in context_windows]
+        self.window = window
+        self.health = {model: ModelHealth(window) for model in context_windows}
+        self.fallbacks_used = 0
+
+    def _latency(self, model: str) -> float:
+        health = self.health[model]
+        if len(health.latencies) >= 3:
+            return health.percentile(0.5)
+        return LATENCY_PRIORS.get(model, 5.0)
+
+    def candidates(self, model: str, needed_tokens: int) -> list:
+        """Models to try for a request needing `needed_tokens` of context, in order."""
+        now = time.monotonic()
+        if model == AUTO_MODEL:
+            ordered = sorted(self.context_windows, key=self._latency)
+        else:
+            rest = self.fallbacks[self.fallbacks.index(model) + 1:] if model in self.fallbacks else self.fallbacks
+            ordered = [model] + [m for m in rest if m != model]
+        fits = [m for m in ordered if self.context_windows.get(m, 0) >= needed_tokens] or ordered[:1]
+        healthy = [m for m in fits if self.health[m].available(now)]
+        if not healthy:
+            # Every circuit is open: try the first choice anyway rather than
+            # failing without asking upstream.
+            return fits[:1]
+        return healthy
+
+    def started(self, model: str, first_choice: str):
+        health = self.health[model]
+        health.requests += 1
+        if health.state == HALF_OPEN:
+            health.probing = True
+        if model != first_choice:
+            self.fallbacks_used += 1
+
+    def abandoned(self, model: str):
+        """
+        A request on `model` ended without an outcome (it was cancelled, e.g.
+        the client went away). If it was the half-open probe, let another
+        one through rather than leaving the model out for good.
+        """
+        health = self.health[model]
+        if health.state == HALF_OPEN:
+            health.probing = False
+
+    def record_success(self, model: str, latency: float):
+        health = self.health[model]
+        health.latencies.append(latency)
+        health.outcomes.append(True)
+        if health.state != CLOSED:
+            health.state = CLOSED
+            health.cooldown = CIRCUIT_COOLDOWN
+            health.probing = False
+            health.outcomes.clear()
+
+    def record_failure(self, model: str, error: Exception):
+        health = self.health[model]
+        now = time.monotonic()
+        health.failures += 1
+        health.outcomes.append(False)
+        health.last_error = f"{type(error).__name__}: {error}"[:200]
+
+        if health.state == HALF_OPEN:
+            health.cooldown = min(health.cooldown * 2, CIRCUIT_MAX_COOLDOWN)
+            health.open(now, health.cooldown)
+        elif isinstance(error, groq.RateLimitError):
+            health.rate_limited += 1
+            health.open(now, _retry_after(error) or health.cooldown)
+        elif len(health.outcomes) >= CIRCUIT_MIN_SAMPLES and health.error_rate() >= CIRCUIT_ERROR_RATE:
+            health.open(now, health.cooldown)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        models = {}
+        for model, health in self.health.items():
+            p50 = health.percentile(0.5)
+            p95 = health.percentile(0.95)
+            models[model] = {
+                "circuit": health.state,
+                "open_for_s": round(max(0.0, health.open_until - now), 1) if health.state == OPEN else 0.0,
+                "requests": health.requests,
+                "failures": health.failures,
+                "rate_limited": health.rate_limited,
+                "circuit_opens": health.circuit_opens,
+                "error_rate": round(health.error_rate(), 3),
+                "p50_ms": round(p50 * 1000) if p50 is not None else None,
+                "p95_ms": round(p95 * 1000) if p95 is not None else None,
+                "last_error": health.last_error,
+            }
+        return {"fallbacks": self.fallbacks, "fallbacks_used": self.fallbacks_used, "models": models}
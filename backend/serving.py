@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+
+from metrics import counter
+
+try:
+    import orjson
+except ImportError:  # optional, several times faster on large payloads
+    orjson = None
+
+try:
+    import brotli
+except ImportError:  # optional; gzip is used alone without it
+    brotli = None
+
+# API responses at least this big are compressed when the client accepts it.
+COMPRESS_MIN_BYTES = int(os.environ.get("COMPRESS_MIN_BYTES", "1024"))
+COMPRESS_GZIP_LEVEL = int(os.environ.get("COMPRESS_GZIP_LEVEL", "6"))
+COMPRESS_BROTLI_QUALITY = int(os.environ.get("COMPRESS_BROTLI_QUALITY", "5"))
+# How long browsers may reuse /static assets without asking again.
+STATIC_MAX_AGE = int(os.environ.get("STATIC_MAX_AGE", "3600"))
+
+COMPRESSIBLE_TYPES = ("application/json", "text/", "application/javascript", "image/svg+xml")
+
+COMPRESSED_BYTES = counter(
+    "http_compressed_bytes_total", "Bytes of API responses compressed on the fly, before and after.", ("coding", "stage")
+)
+
+
+def dumps(content) -> bytes:
+    """Compact JSON, as JSONResponse renders it, with orjson when it's installed."""
+    if orjson is not None:
+        try:
+            return orjson.dumps(content)
+        except TypeError:
+            pass  # e.g. non-string keys, which the json module converts
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+
+def accepted_encodings(header: str) -> set:
+    """Codings the client accepts, from an Accept-Encoding header."""
+    accepted = set()
+    for item in header.split(","):
+        coding, _, params = item.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q=") and q[2:].strip() in ("0", "0.0", "0.00", "0.000"):
+            continue
+        if coding:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+def negotiate(header: str, available) -> str:
+    """The coding to answer with: br, then gzip, among those `available`; None for identity."""
+    accepted = accepted_encodings(header)
+    for coding in ("br", "gzip"):
+        if coding in available and (coding in accepted or "*" in accepted):
+            return coding
+    return None
+
+
+def compress(body: bytes, coding: str, static: bool = False) -> bytes:
+    # Static assets are compressed once, at startup, so they get the best ratio.
+    if coding == "br":
+        return brotli.compress(body, quality=11 if static else COMPRESS_BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=9 if static else COMPRESS_GZIP_LEVEL, mtime=0)
+
+
+def etag_matches(header: str, etag: str) -> bool:
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+class StaticAsset:
+    __slots__ = ("body", "media_type", "etag", "encoded")
+
+    def __init__(self, body: bytes, media_type: str):
+        self.body = body
+        self.media_type = media_type
+        self.etag = '"' + hashlib.blake2b(body, digest_size=12).hexdigest() + '"'
+        self.encoded = {}
+        if media_type.startswith(COMPRESSIBLE_TYPES):
+            for coding in ("br", "gzip") if brotli is not None else ("gzip",):
+                data = compress(body, coding, static=True)
+                if len(data) < len(body):
+                    self.encoded[coding] = data
+
+
+class StaticAssets:
+    """
+    The dashboard's files, read and compressed (gzip, and brotli when
+    installed) once at startup and served from memory. Responses carry an
+    ETag, so a browser revalidating an unchanged file gets an empty 304.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.assets = {}
+        for root, _, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+                if media_type.startswith("text/") or media_type in ("application/javascript", "image/svg+xml"):
+                    media_type += "; charset=utf-8"
+                with open(path, "rb") as f:
+                    self.assets[os.path.relpath(path, directory).replace(os.sep, "/")] = StaticAsset(f.read(), media_type)
+
+    def response(self, path: str, headers, cache_control: str):
+        """(status, headers, body) for GET `path` with the request's `headers`, or None if there's no such file."""
+        asset = self.assets.get(path)
+        if asset is None:
+            return None
+        out = {"ETag": asset.etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+        if etag_matches(headers.get("if-none-match", ""), asset.etag):
+            return 304, out, b""
+        out["Content-Type"] = asset.media_type
+        coding = negotiate(headers.get("accept-encoding", ""), asset.encoded)
+        if coding is None:
+            return 200, out, asset.body
+        out["Content-Encoding"] = coding
+        return 200, out, asset.encoded[coding]
+
+    def stats(self) -> dict:
+        return {
+            "files": len(self.assets),
+            "bytes": sum(len(a.body) for a in self.assets.values()),
+            "gzip_bytes": sum(len(a.encoded.get("gzip", a.body)) for a in self.assets.values()),
+            "brotli_bytes": sum(len(a.encoded.get("br", a.body)) for a in self.assets.values()) if brotli else None,
+        }
+
+
+class CompressionMiddleware:
+    """
+    ASGI middleware compressing complete responses (JSON and text) of at
+    least `min_bytes` with the best coding the client accepts. Streamed
+    responses (SSE, NDJSON) pass through untouched: compressing them would
+    hold deltas back in the compressor's buffer.
+    """
+
+    def __init__(self, app, min_bytes: int = COMPRESS_MIN_BYTES):
+        self.app = app
+        self.min_bytes = min_bytes
+        self.codings = ("br", "gzip") if brotli is not None else ("gzip",)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        accept = ""
+        for name, value in scope["headers"]:
+            if name == b"accept-encoding":
+                accept = value.decode("latin-1")
+                break
+        coding = negotiate(accept, self.codings)
+        if coding is None:
+            await self.app(scope, receive, send)
+            return
+
+        start = None
+
+        async def send_compressed(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is None:
+                await send(message)
+                return
+            held, start = start, None
+            body = message.get("body", b"")
+            headers = {k.lower(): v for k, v in held.get("headers", [])}
+            media_type = headers.get(b"content-type", b"").decode("latin-1")
+            if (message.get("more_body") or len(body) < self.min_bytes or b"content-encoding" in headers
+                    or not media_type.startswith(COMPRESSIBLE_TYPES)):
+                await send(held)
+                await send(message)
+                return
+            data = compress(body, coding)
+            COMPRESSED_BYTES.inc(coding, "in", amount=len(body))
+            COMPRESSED_BYTES.inc(coding, "out", amount=len(data))
+            vary = headers.get(b"vary")
+            out = [(k, v) for k, v in held.get("headers", []) if k.lower() not in (b"content-length", b"vary")]
+            out += [
+                (b"content-encoding", coding.encode()),
+                (b"content-length", str(len(data)).encode()),
+                (b"vary", vary + b", Accept-Encoding" if vary else b"Accept-Encoding"),
+            ]
+            await send(dict(held, headers=out))
+            await send({"type": "http.response.body", "body": data})
+
+        await self.app(scope, receive, send_compressed)
@@ -0,0 +1,135 @@
+import json
+import asyncio
+import hashlib
+
+
+def flight_key(model: str, messages: list, max_tokens: int) -> str:
+    raw = json.dumps([model, messages, max_tokens], sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class _Broadcast:
+    """
+    Replays a stream's chunks to any number of subscribers, late ones
+    included. The upstream stream is cancelled once every subscriber has
+    gone away before it finished; `abandon` is called first, so no new
+    subscriber can attach to a stream that is being cancelled.
+    """
+
+    def __init__(self, source, abandon):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.subscribers = 0
+        self._abandon = abandon
+        self._changed = asyncio.Event()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except BaseException as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def subscribe(self):
+        # Counted from now, not from the first read, so the stream isn't
+        # cancelled under a subscriber that hasn't started reading yet.
+        self.subscribers += 1
+        return self._follow()
+
+    async def _follow(self):
+        try:
+            i = 0
+            while True:
+                if i < len(self.chunks):
+                    yield self.chunks[i]
+                    i += 1
+                elif self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self._abandon(self)
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical upstream calls: while a call for a key is
+    in flight, further callers with the same key attach to it instead of
+    starting their own. The upstream call runs as its own task, so one
+    caller going away doesn't cancel it for the others. `on_join` is
+    called for each caller that attaches instead of starting a call, so
+    it can be charged for what it gets.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._streams = {}
+        self.calls = 0
+        self.coalesced = 0
+        self.stream_calls = 0
+        self.stream_coalesced = 0
+
+    async def do(self, key: str, fn, on_join=None):
+        task = self._calls.get(key)
+        if task is not None:
+            self.coalesced += 1
+            if on_join is not None:
+                on_join()
+        else:
+            self.calls += 1
+            task = asyncio.ensure_future(fn())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(self._calls, key, task, t))
+        return await asyncio.shield(task)
+
+    def stream(self, key: str, fn, on_join=None):
+        broadcast = self._streams.get(key)
+        if broadcast is not None:
+            self.stream_coalesced += 1
+            if on_join is not None:
+                on_join()
+        else:
+            self.stream_calls += 1
+            broadcast = _Broadcast(fn(), lambda b: self._drop(self._streams, key, b))
+            self._streams[key] = broadcast
+            broadcast.task.add_done_callback(lambda t: self._forget(self._streams, key, broadcast, t))
+        return broadcast.subscribe()
+
+    @staticmethod
+    def _drop(calls: dict, key: str, call):
+        # Only if it's still this call: a new one may have taken the key.
+        if calls.get(key) is call:
+            del calls[key]
+
+    def _forget(self, calls: dict, key: str, call, task: asyncio.Future):
+        self._drop(calls, key, call)
+        # Mark the exception as retrieved even if every caller went away.
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict:
+        requests = self.calls + self.coalesced + self.stream_calls + self.stream_coalesced
+        saved = self.coalesced + self.stream_coalesced
+        return {
+            "in_flight": len(self._calls) + len(self._streams),
+            "upstream_calls": self.calls,
+            "coalesced": self.coalesced,
+            "stream_upstream_calls": self.stream_calls,
+            "stream_coalesced": self.stream_coalesced,
+            "upstream_calls_saved_pct": round(saved / requests * 100, 1) if requests else 0.0,
+        }
@@ -0,0 +1,316 @@
+import asyncio
+import heapq
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+
+GROQ_MAX_IN_FLIGHT = int(os.environ.get("GROQ_MAX_IN_FLIGHT", "8"))
+GROQ_MAX_QUEUE = int(os.environ.get("GROQ_MAX_QUEUE", "200"))
+GROQ_QUEUE_TIMEOUT = float(os.environ.get("GROQ_QUEUE_TIMEOUT", "30"))
+
+# Request cost is measured in units of roughly 1000 tokens on the largest
+# model (see AIClient.request_cost). Each user may spend GROQ_USER_RATE units
+# a second, with bursts of up to GROQ_USER_BURST; 0 (the default) turns the
+# limit off, leaving fair queuing alone to share the upstream between users.
+GROQ_USER_RATE = float(os.environ.get("GROQ_USER_RATE", "0"))
+GROQ_USER_BURST = float(os.environ.get("GROQ_USER_BURST", "20"))
+# Share of the upstream a user gets relative to others, e.g. "alice:2,bot:0.5".
+GROQ_USER_WEIGHTS = os.environ.get("GROQ_USER_WEIGHTS", "")
+# Requests costing at most this go in the fast lane, which is served first
+# and has GROQ_FAST_LANE_RESERVED slots the slow lane can't take.
+GROQ_FAST_LANE_COST = float(os.environ.get("GROQ_FAST_LANE_COST", "1.0"))
+GROQ_FAST_LANE_RESERVED = int(os.environ.get("GROQ_FAST_LANE_RESERVED", "2"))
+# New requests are turned away at once when this many are already queued
+# ahead of them, or when their expected wait is longer than GROQ_SHED_WAIT.
+GROQ_SHED_QUEUE = int(os.environ.get("GROQ_SHED_QUEUE", str(GROQ_MAX_QUEUE // 2)))
+GROQ_SHED_WAIT = float(os.environ.get("GROQ_SHED_WAIT", str(GROQ_QUEUE_TIMEOUT)))
+
+FAST = "fast"
+SLOW = "slow"
+LANES = (FAST, SLOW)
+
+# Above this many tracked users, idle ones are forgotten.
+USER_STATE_LIMIT = 4096
+
+
+class UpstreamBusy(Exception):
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class RateLimited(UpstreamBusy):
+    pass
+
+
+def parse_weights(spec: str) -> dict:
+    weights = {}
+    for item in spec.split(","):
+        user_id, _, weight = item.strip().rpartition(":")
+        if user_id and weight:
+            weights[user_id] = float(weight)
+    return weights
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, amount: float) -> float:
+        """Take `amount` and return 0, or take nothing and return the seconds until `amount` is there."""
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def give_back(self, amount: float):
+        """Return `amount` taken earlier; a negative amount takes more, possibly into debt."""
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + amount)
+
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.burst
+
+
+class UpstreamGate:
+    """
+    Caps the number of upstream completions running at once and decides
+    who goes next when they are all taken.
+
+    Callers queue in one of two lanes by cost: the fast lane is always
+    served first. Within a lane, users are served by start-time fair
+    queuing, so each gets a share of the upstream in proportion to its
+    weight however many requests it sends; a user's own requests stay in
+    order. admit() is the cheap check in front of all that: it sheds load
+    when the queue is already too deep to be worth joining and applies the
+    per-user token bucket, raising UpstreamBusy (with a retry_after) at once
+    instead of letting requests time out in the queue.
+    """
+
+    def __init__(self, max_in_flight: int = GROQ_MAX_IN_FLIGHT, max_queue: int = GROQ_MAX_QUEUE,
+                 queue_timeout: float = GROQ_QUEUE_TIMEOUT, user_rate: float = GROQ_USER_RATE,
+                 user_burst: float = GROQ_USER_BURST, user_weights: dict = None,
+                 fast_lane_cost: float = GROQ_FAST_LANE_COST, fast_lane_reserved: int = GROQ_FAST_LANE_RESERVED,
+                 shed_queue: int = GROQ_SHED_QUEUE, shed_wait: float = GROQ_SHED_WAIT):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.user_weights = parse_weights(GROQ_USER_WEIGHTS) if user_weights is None else user_weights
+        self.fast_lane_cost = fast_lane_cost
+        self.slow_slots = max(1, max_in_flight - fast_lane_reserved)
+        self.shed_queue = shed_queue
+        self.shed_wait = shed_wait
+        self._queues = {lane: [] for lane in LANES}
+        self._seq = 0
+        self._vtime = 0.0
+        self._finish = {}
+        self._buckets = {}
+        self._service = {lane: None for lane in LANES}
+        self.in_flight = 0
+        self.lane_in_flight = {lane: 0 for lane in LANES}
+        self.waiting = 0
+        self.lane_waiting = {lane: 0 for lane in LANES}
+        self.peak_waiting = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.shed = 0
+        self.rate_limited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self._recent_waits = deque(maxlen=512)
+
+    def lane(self, cost: float) -> str:
+        return FAST if cost <= self.fast_lane_cost else SLOW
+
+    def _can_run(self, lane: str) -> bool:
+        if self.in_flight >= self.max_in_flight:
+            return False
+        return lane == FAST or self.lane_in_flight[SLOW] < self.slow_slots
+
+    def _ahead(self, lane: str) -> int:
+        """Callers that would be served before a new one in `lane`."""
+        return self.lane_waiting[FAST] if lane == FAST else self.waiting
+
+    def expected_wait(self, lane: str) -> float:
+        fast = self.lane_waiting[FAST] * (self._service[FAST] or 0.0)
+        if lane == FAST:
+            return fast / self.max_in_flight
+        slow = self.lane_waiting[SLOW] * (self._service[SLOW] or 0.0)
+        return (fast + slow) / self.slow_slots
+
+    def admit(self, user_id: str = "default", cost: float = 1.0, charge: float = None) -> float:
+        """
+        Check a request once, before it queues for a slot. Raises
+        UpstreamBusy when the backlog ahead of it is too deep, or
+        RateLimited when `user_id` has spent its budget. The budget is
+        charged `charge` (`cost` by default), which is returned for
+        settle(); 0 when there is no per-user limit.
+        """
+        lane = self.lane(cost)
+        ahead = self._ahead(lane)
+        if ahead:
+            expected = self.expected_wait(lane)
+            if ahead >= self.shed_queue or expected > self.shed_wait:
+                self.shed += 1
+                raise UpstreamBusy(f"{ahead} requests queued, about {expected:.0f}s wait", retry_after=max(1.0, expected))
+
+        if self.user_rate <= 0:
+            return 0.0
+        if len(self._buckets) > USER_STATE_LIMIT:
+            self._forget_idle_users()
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.user_rate, self.user_burst)
+        # A request bigger than the whole burst still gets through once the bucket is full.
+        charge = min(cost if charge is None else charge, self.user_burst)
+        wait = bucket.take(charge)
+        if wait:
+            self.rate_limited += 1
+            raise RateLimited(f"too many requests from this user, retry in {wait:.0f}s", retry_after=wait)
+        return charge
+
+    def settle(self, user_id: str, charged: float, actual: float):
+        """Correct what admit() `charged` `user_id` to the request's `actual` cost, once it is known."""
+        bucket = self._buckets.get(user_id)
+        if bucket is None or not charged:
+            return
+        bucket.give_back(charged - min(actual, self.user_burst))
+
+    def _forget_idle_users(self):
+        for user_id in [u for u, b in self._buckets.items() if b.full()]:
+            del self._buckets[user_id]
+        for user_id in [u for u, f in self._finish.items() if f <= self._vtime]:
+            del self._finish[user_id]
+
+    def _start_tag(self, user_id: str, cost: float) -> float:
+        # A user's next request starts where its last one finished in virtual
+        # time, or now if it has been idle; heavier users get less time per cost.
+        start = max(self._vtime, self._finish.get(user_id, 0.0))
+        self._finish[user_id] = start + cost / self.user_weights.get(user_id, 1.0)
+        return start
+
+    def share(self, user_id: str, cost: float):
+        """
+        Count `cost` against `user_id`'s fair share without taking a slot,
+        for a call it shares with another user's (see SingleFlight), so the
+        user's next requests queue as if it had made the call itself.
+        """
+        self._start_tag(user_id, cost)
+
+    def _grant(self, lane: str, tag: float):
+        self.in_flight += 1
+        self.lane_in_flight[lane] += 1
+        self._vtime = max(self._vtime, tag)
+
+    def _release(self, lane: str, held: float = None):
+        self.in_flight -= 1
+        self.lane_in_flight[lane] -= 1
+        if held is not None:
+            self.completed += 1
+            previous = self._service[lane]
+            self._service[lane] = held if previous is None else 0.8 * previous + 0.2 * held
+        self._dispatch()
+
+    def _dispatch(self):
+        for lane in LANES:
+            queue = self._queues[lane]
+            while queue and self._can_run(lane):
+                tag, _, future = heapq.heappop(queue)
+                if future.done():
+                    continue  # gave up waiting
+                self._grant(lane, tag)
+                future.set_result(None)
+
+    @asynccontextmanager
+    async def slot(self, user_id: str = "default", cost: float = 1.0):
+        start = time.monotonic()
+        lane = self.lane(cost)
+        tag = self._start_tag(user_id, cost)
+        if self._can_run(lane) and not self._ahead(lane):
+            self._grant(lane, tag)
+        else:
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise UpstreamBusy(f"upstream queue is full ({self.waiting} waiting)",
+                                   retry_after=max(1.0, self.expected_wait(lane)))
+            future = asyncio.get_running_loop().create_future()
+            self._seq += 1
+            heapq.heappush(self._queues[lane], (tag, self._seq, future))
+            self.waiting += 1
+            self.lane_waiting[lane] += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                await asyncio.wait_for(future, self.queue_timeout)
+            except BaseException as e:
+                if future.done() and not future.cancelled():
+                    self._release(lane)  # granted just as we gave up
+                if isinstance(e, asyncio.TimeoutError):
+                    self.timed_out += 1
+                    raise UpstreamBusy(f"timed out after {self.queue_timeout:.0f}s waiting for an upstream slot",
+                                       retry_after=max(1.0, self.expected_wait(lane)))
+                raise
+            finally:
+                self.waiting -= 1
+                self.lane_waiting[lane] -= 1
+
+        waited = time.monotonic() - start
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self._recent_waits.append(waited)
+        try:
+            yield waited
+        finally:
+            self._release(lane, time.monotonic() - start - waited)
+
+    def stats(self) -> dict:
+        recent = sorted(self._recent_waits)
+        admitted = self.completed + self.in_flight
+
+        def pct(p):
+            if not recent:
+                return 0.0
+            return round(recent[min(len(recent) - 1, int(p * len(recent)))] * 1000, 1)
+
+        return {
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "queue_timeout_s": self.queue_timeout,
+            "in_flight": self.in_flight,
+            "queue_depth": self.waiting,
+            "peak_queue_depth": self.peak_waiting,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "timed_out": self.timed_out,
+            "shed": self.shed,
+            "rate_limited": self.rate_limited,
+            "avg_wait_ms": round(self.total_wait / admitted * 1000, 1) if admitted else 0.0,
+            "p50_wait_ms": pct(0.50),
+            "p95_wait_ms": pct(0.95),
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+            "lanes": {
+                lane: {
+                    "in_flight": self.lane_in_flight[lane],
+                    "queue_depth": self.lane_waiting[lane],
+                    "avg_service_ms": round((self._service[lane] or 0.0) * 1000, 1),
+                    "expected_wait_ms": round(self.expected_wait(lane) * 1000, 1),
+                }
+                for lane in LANES
+            },
+            "users_tracked": len(self._buckets),
+            "user_rate": self.user_rate,
+            "user_burst": self.user_burst,
+        }
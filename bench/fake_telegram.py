@@ -0,0 +1,94 @@
+"""
+Just enough of python-telegram-bot's Update, Context, Message and Bot to
+run telegram_bot's handlers without Telegram. A message sent or edited
+with a reply keyboard ends an exchange: that is how the bot posts its
+final answer (finish_reply) or an error, while the "Thinking..."
+placeholder and streaming previews go out without one.
+"""
+import asyncio
+import itertools
+from types import SimpleNamespace
+
+
+class FakeBot:
+    def __init__(self):
+        self._message_ids = itertools.count(1)
+        self._waiting = {}  # chat_id -> Future for the final text
+        self.sent = 0
+        self.edited = 0
+
+    def expect_reply(self, chat_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[chat_id] = future
+        return future
+
+    def _final(self, chat_id: int, text: str):
+        future = self._waiting.pop(chat_id, None)
+        if future is not None and not future.done():
+            future.set_result(text)
+
+    def new_message(self, chat_id: int, text: str, reply_markup=None):
+        self.sent += 1
+        if reply_markup is not None:
+            self._final(chat_id, text)
+        return FakeMessage(self, chat_id, next(self._message_ids), text)
+
+    async def send_message(self, chat_id: int, text: str, reply_markup=None, **kwargs):
+        return self.new_message(chat_id, text, reply_markup)
+
+    async def send_document(self, chat_id: int, document, filename: str = None, caption: str = None, reply_markup=None, **kwargs):
+        return self.new_message(chat_id, caption or filename or "", reply_markup)
+
+    async def edit_message_text(self, text: str, chat_id: int, message_id: int, reply_markup=None, **kwargs):
+        self.edited += 1
+        if reply_markup is not None:
+            self._final(chat_id, text)
+
+    async def delete_message(self, chat_id: int, message_id: int):
+        pass
+
+
+class FakeChat:
+    def __init__(self, chat_id: int):
+        self.id = chat_id
+
+    async def send_action(self, action):
+        pass
+
+
+class FakeMessage:
+    def __init__(self, bot: FakeBot, chat_id: int, message_id: int, text: str):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.message_id = message_id
+        self.text = text
+        self.chat = FakeChat(chat_id)
+
+    async def reply_text(self, text: str, reply_markup=None, **kwargs):
+        return self.bot.new_message(self.chat_id, text, reply_markup)
+
+    async def edit_text(self, text: str, reply_markup=None, **kwargs):
+        await self.bot.edit_message_text(text, self.chat_id, self.message_id, reply_markup=reply_markup)
+
+    async def delete(self):
+        pass
+
+
+class FakeApplication:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.bot_data = {}
+        self._tasks = set()
+
+    def create_task(self, coro):
+        task = asyncio.ensure_future(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    def incoming(self, user_id: int, chat_id: int, text: str, user_data: dict):
+        """An (update, context) pair for a text message from `user_id` in `chat_id`."""
+        message = FakeMessage(self.bot, chat_id, next(self.bot._message_ids), text)
+        update = SimpleNamespace(effective_user=SimpleNamespace(id=user_id), effective_chat=message.chat, message=message)
+        context = SimpleNamespace(user_data=user_data, bot=self.bot, application=self, bot_data=self.bot_data)
+        return update, context
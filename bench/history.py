@@ -0,0 +1,66 @@
+"""
+Append/read throughput of the conversation history backends.
+
+    python -m bench.history [--users 1000] [--messages 20000] [--reads 20000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from history import HistoryStore, SQLiteHistoryStore
+
+SAMPLE_MESSAGES = [
+    "thanks!",
+    "Can you write a FastAPI CRUD endpoint for a Todo model with SQLAlchemy?",
+    "def handler(event, context):\n    return {'statusCode': 200, 'body': 'ok'}\n" * 20,
+    "Explain the difference between JWT access and refresh tokens. " * 10,
+]
+
+
+def run(store, users: int, messages: int, reads: int) -> dict:
+    rng = random.Random(42)
+    user_ids = [f"user-{i}" for i in range(users)]
+
+    start = time.perf_counter()
+    for i in range(messages):
+        store.append(rng.choice(user_ids), "user" if i % 2 == 0 else "assistant", rng.choice(SAMPLE_MESSAGES))
+    store.flush()
+    append_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(reads):
+        store.get(rng.choice(user_ids))
+    read_s = time.perf_counter() - start
+
+    return {
+        "appends_per_s": round(messages / append_s),
+        "reads_per_s": round(reads / read_s),
+        "stats": store.stats(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--reads", type=int, default=20000)
+    args = parser.parse_args()
+
+    results = {"memory": run(HistoryStore(), args.users, args.messages, args.reads)}
+    with tempfile.TemporaryDirectory() as tmp:
+        store = SQLiteHistoryStore(path=os.path.join(tmp, "history.db"))
+        try:
+            results["sqlite"] = run(store, args.users, args.messages, args.reads)
+        finally:
+            store.close()
+
+    print(f"{'backend':<8} {'appends/s':>12} {'reads/s':>12} {'messages':>10} {'tokens':>10}")
+    for name, r in results.items():
+        print(f"{name:<8} {r['appends_per_s']:>12,} {r['reads_per_s']:>12,} "
+              f"{r['stats']['messages']:>10,} {r['stats']['tokens']:>10,}")
+
+
+if __name__ == "__main__":
+    main()
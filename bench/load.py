@@ -0,0 +1,549 @@
+"""
+Load test the API, the local backend or the Telegram bot against mock upstreams.
+
+    python -m bench.load main|local|bot [--concurrency 16] [--requests 400 | --duration 60]
+        [--users 50] [--env KEY=VALUE ...] [--json results.json]
+        [--save-baseline] [--compare] [--tolerance 0.2]
+        [mock options: --ttft 0.25 --tokens-per-s 300 --reply-tokens 400 --error-rate 0 ...]
+
+`main` drives backend/app.py and `local` drives AI/backend/app.py, each
+started under uvicorn in a subprocess; `bot` runs telegram_bot's
+handle_message in this process with the backend in-process behind it, as
+main.py does. All of them talk to bench.mock_upstream instead of Groq or
+Ollama. Requests follow a weighted mix of chat, code, research and website
+traffic from `--users` distinct users; prompts are unique, so caches and
+request coalescing don't flatter the numbers.
+
+Reports throughput, latency and time-to-first-token percentiles (overall
+and per kind of request), errors, and the resident memory of the process
+under test. --save-baseline stores the results in bench/baselines/; a later
+run with --compare flags metrics that got worse by more than --tolerance
+and exits with status 1.
+"""
+import argparse
+import asyncio
+import contextvars
+import itertools
+import json
+import logging
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+from bench.mock_upstream import add_arguments as add_mock_arguments
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE_DIR = os.path.join(ROOT, "bench", "baselines")
+STARTUP_TIMEOUT = 30
+# A request taking longer than this counts as failed.
+REQUEST_TIMEOUT = 600
+
+PROMPTS = {
+    "chat": [
+        "What's the difference between a process and a thread?",
+        "How do I undo the last git commit but keep the changes?",
+        "Explain Python's GIL in two paragraphs.",
+        "Which HTTP status should an API return for a duplicate resource?",
+    ],
+    "code": [
+        "A FastAPI endpoint that uploads a file to S3 and returns its URL",
+        "A function that merges overlapping intervals",
+        "A retry decorator with exponential backoff and jitter",
+        "A React hook that debounces a value",
+    ],
+    "analyze": [
+        "def get(d, k):\n    try:\n        return d[k]\n    except:\n        return None\n",
+        "for i in range(len(items)):\n    if items[i] == target:\n        found = True\n",
+        "async def fetch(urls):\n    return [await session.get(u) for u in urls]\n",
+    ],
+    "research": [
+        "Trade-offs between event sourcing and CRUD for an order system",
+        "How vector databases index embeddings",
+        "Current approaches to rate limiting in distributed APIs",
+    ],
+    "website": [
+        "A landing page for a coffee roastery with a menu and contact form",
+        "A portfolio site for a photographer with a filterable gallery",
+        "A pricing page for a SaaS product with three tiers",
+    ],
+}
+
+# (kind, weight): mostly interactive chat and code, some long generations.
+MAIN_MIX = [
+    ("chat/stream", 40), ("chat", 10), ("generate/stream", 20), ("analyze", 10),
+    ("research/stream", 10), ("website/stream", 10),
+]
+LOCAL_MIX = [("chat/stream", 40), ("chat", 30), ("analyze_file", 20), ("analyze_file/stream", 10)]
+BOT_MIX = [("chat", 50), ("code", 20), ("analyze", 10), ("research", 10), ("website", 10)]
+
+# Where each metric compared against a baseline is found, and whether
+# bigger is better.
+BASELINE_METRICS = [
+    ("throughput_rps", ("throughput_rps",), True),
+    ("latency p50 ms", ("latency_ms", "p50"), False),
+    ("latency p95 ms", ("latency_ms", "p95"), False),
+    ("latency p99 ms", ("latency_ms", "p99"), False),
+    ("ttft p50 ms", ("ttft_ms", "p50"), False),
+    ("ttft p95 ms", ("ttft_ms", "p95"), False),
+    ("rss peak MB", ("rss_mb", "peak"), False),
+]
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def rss_bytes(pid: int):
+    """Resident set size of `pid` from /proc, or None where that isn't available."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentiles(values: list) -> dict:
+    if not values:
+        return {"p50": None, "p95": None, "p99": None}
+    ordered = sorted(values)
+
+    def pct(p):
+        return round(ordered[min(len(ordered) - 1, int(p * len(ordered)))] * 1000, 1)
+
+    return {"p50": pct(0.50), "p95": pct(0.95), "p99": pct(0.99)}
+
+
+class RssSampler:
+    def __init__(self, pid: int, interval: float = 0.25):
+        self.pid = pid
+        self.interval = interval
+        self.samples = []
+        self._task = None
+
+    def start(self):
+        self._sample()
+        self._task = asyncio.ensure_future(self._run())
+
+    def _sample(self):
+        rss = rss_bytes(self.pid)
+        if rss is not None:
+            self.samples.append(rss)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self._sample()
+
+    async def stop(self) -> dict:
+        if self._task is not None:
+            self._task.cancel()
+        self._sample()
+        if not self.samples:
+            return {"start": None, "peak": None, "end": None}
+        mb = lambda b: round(b / (1024 * 1024), 1)
+        return {"start": mb(self.samples[0]), "peak": mb(max(self.samples)), "end": mb(self.samples[-1])}
+
+
+class Results:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.ttfts = defaultdict(list)
+        self.errors = defaultdict(Counter)
+
+    def record(self, kind: str, latency: float, ttft: float = None, error: str = None):
+        if error:
+            self.errors[kind][error] += 1
+            return
+        self.latencies[kind].append(latency)
+        if ttft is not None:
+            self.ttfts[kind].append(ttft)
+
+    def summary(self, elapsed: float, rss: dict) -> dict:
+        kinds = sorted(set(self.latencies) | set(self.errors))
+        ok = sum(len(v) for v in self.latencies.values())
+        failed = sum(sum(c.values()) for c in self.errors.values())
+        errors = Counter()
+        for counts in self.errors.values():
+            errors.update(counts)
+        return {
+            "requests": ok + failed,
+            "ok": ok,
+            "errors": dict(errors),
+            "error_rate": round(failed / (ok + failed), 4) if ok + failed else 0.0,
+            "elapsed_s": round(elapsed, 2),
+            "throughput_rps": round(ok / elapsed, 2) if elapsed else 0.0,
+            "latency_ms": percentiles([v for vs in self.latencies.values() for v in vs]),
+            "ttft_ms": percentiles([v for vs in self.ttfts.values() for v in vs]),
+            "rss_mb": rss,
+            "by_kind": {
+                kind: {
+                    "ok": len(self.latencies[kind]),
+                    "errors": sum(self.errors[kind].values()),
+                    "latency_ms": percentiles(self.latencies[kind]),
+                    "ttft_ms": percentiles(self.ttfts[kind]),
+                }
+                for kind in kinds
+            },
+        }
+
+
+async def drive(one_request, mix: list, args):
+    """Run `one_request(kind, i)` from `args.concurrency` workers until the request count or duration is reached."""
+    rng = random.Random(args.seed)
+    kinds, weights = zip(*mix)
+    numbers = itertools.count()
+    deadline = time.monotonic() + args.duration if args.duration else None
+
+    async def worker():
+        while True:
+            i = next(numbers)
+            if args.requests and i >= args.requests:
+                return
+            if deadline and time.monotonic() >= deadline:
+                return
+            await one_request(rng.choices(kinds, weights)[0], i)
+
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+
+
+def prompt(kind: str, i: int) -> str:
+    # The request number keeps prompts unique.
+    texts = PROMPTS[kind]
+    return f"{texts[i % len(texts)]} (request {i})"
+
+
+def is_error_text(text: str) -> bool:
+    # The backends report failures as reply text rather than HTTP errors.
+    return text.lstrip().startswith(("Error", "❌"))
+
+
+# --- HTTP targets ---------------------------------------------------------
+
+def main_request(kind: str, i: int, user_id: str):
+    """(path, body, field holding the reply) for backend/app.py."""
+    if kind.startswith("chat"):
+        return f"/api/{kind}", {"text": prompt("chat", i), "user_id": user_id, "model": "llama-3.1-8b-instant"}, "response"
+    if kind.startswith("generate"):
+        return f"/api/{kind}", {"description": prompt("code", i), "language": "python", "user_id": user_id}, "code"
+    if kind == "analyze":
+        return "/api/analyze", {"code": prompt("analyze", i), "user_id": user_id}, "analysis"
+    if kind.startswith("research"):
+        return f"/api/{kind}", {"topic": prompt("research", i), "user_id": user_id}, "research"
+    return f"/api/{kind}", {"description": prompt("website", i), "user_id": user_id}, "website"
+
+
+def write_sample_files(directory: str) -> list:
+    """Source files for /analyze_file: a few small ones and a few long enough to be chunked."""
+    unit = "def handler_{n}(event):\n    value = event.get('value')\n    if value is None:\n        return None\n    return value * {n}\n\n"
+    paths = []
+    for n, functions in enumerate((5, 10, 20, 150, 300)):
+        path = os.path.join(directory, f"sample_{n}.py")
+        with open(path, "w") as f:
+            f.write("".join(unit.format(n=k) for k in range(functions)))
+        paths.append(path)
+    return paths
+
+
+def local_request(kind: str, i: int, user_id: str, files: list):
+    if kind.startswith("chat"):
+        return f"/{kind}", {"text": prompt("chat", i), "max_tokens": 256}, "response"
+    return f"/{kind}", {"path": files[i % len(files)]}, "analysis"
+
+
+async def http_call(session, url: str, body: dict, field: str, streaming: bool, started: float):
+    """(ttft, error) for one request sent at `started`; the caller times the whole call."""
+    async with session.post(url, json=body) as resp:
+        if resp.status != 200:
+            await resp.read()
+            return None, str(resp.status)
+        if not streaming:
+            data = await resp.json()
+            return None, "error_text" if is_error_text(str(data.get(field, ""))) else None
+        ttft = None
+        error = None
+        async for raw in resp.content:
+            line = raw.decode("utf-8").strip()
+            if line.startswith("data:"):
+                line = line[5:].strip()
+            if '"delta"' not in line:
+                continue
+            delta = json.loads(line)["delta"]
+            if ttft is None:
+                ttft = time.perf_counter() - started
+                error = "error_text" if is_error_text(delta) else None
+            elif "Error" in delta and is_error_text(delta.strip()):
+                error = "error_text"
+        return ttft, error
+
+
+async def wait_for(url: str, process: subprocess.Popen):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"{url}: server exited with status {process.returncode}")
+            try:
+                async with session.get(url) as resp:
+                    if resp.status < 500:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url}: not ready after {STARTUP_TIMEOUT}s")
+
+
+async def run_http(target: str, args, env: dict, results: Results, tmp: str) -> dict:
+    port = free_port()
+    if target == "main":
+        cwd, ready, mix = os.path.join(ROOT, "backend"), "/api/health", MAIN_MIX
+        build = main_request
+    else:
+        cwd, ready, mix = os.path.join(ROOT, "AI", "backend"), "/stats", LOCAL_MIX
+        files = write_sample_files(tmp)
+        build = lambda kind, i, user_id: local_request(kind, i, user_id, files)
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+        cwd=cwd, env=env,
+    )
+    try:
+        base = f"http://127.0.0.1:{port}"
+        await wait_for(base + ready, server)
+        sampler = RssSampler(server.pid)
+        sampler.start()
+        timeout = aiohttp.ClientTimeout(total=REQUEST_TIMEOUT)
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+
+            async def one_request(kind: str, i: int):
+                path, body, field = build(kind, i, f"bench-{i % args.users}")
+                start = time.perf_counter()
+                try:
+                    ttft, error = await http_call(session, base + path, body, field, kind.endswith("/stream"), start)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    ttft, error = None, type(e).__name__
+                results.record(kind, time.perf_counter() - start, ttft, error)
+
+            started = time.perf_counter()
+            await drive(one_request, mix, args)
+            elapsed = time.perf_counter() - started
+        return results.summary(elapsed, await sampler.stop())
+    finally:
+        server.terminate()
+        try:
+            server.wait(10)
+        except subprocess.TimeoutExpired:
+            server.kill()
+
+
+# --- Telegram bot ---------------------------------------------------------
+
+_first_delta = contextvars.ContextVar("first_delta")
+
+
+async def run_bot(args, env: dict, results: Results) -> dict:
+    # The backend reads its settings at import, so they go in first.
+    os.environ.update(env)
+    import telegram_bot
+    from bot_transport import LocalTransport
+    from bench.fake_telegram import FakeApplication
+
+    transport = LocalTransport(asyncio.get_running_loop())
+    await transport.start()
+    telegram_bot.transport = transport
+    # Per-request progress lines would drown the report.
+    logging.getLogger("telegram_bot").setLevel(logging.WARNING)
+    stream = telegram_bot.api_stream
+
+    async def timed_stream(endpoint, data):
+        # Time to the first delta reaching the bot, before its edit throttling.
+        timing = _first_delta.get(None)
+        async for delta in stream(endpoint, data):
+            if timing is not None and "first" not in timing:
+                timing["first"] = time.perf_counter()
+            yield delta
+
+    telegram_bot.api_stream = timed_stream
+    application = FakeApplication()
+    users = {}
+    sampler = RssSampler(os.getpid())
+    sampler.start()
+
+    async def one_request(mode: str, i: int):
+        user_id = i % args.users
+        user_data = users.setdefault(user_id, {"model": telegram_bot.DEFAULT_MODEL})
+        user_data["mode"] = "code" if mode == "code" else mode
+        user_data["language"] = "python" if mode == "code" else None
+        update, context = application.incoming(user_id, chat_id=i, text=prompt(mode, i), user_data=user_data)
+        reply = application.bot.expect_reply(i)
+        timing = {}
+        _first_delta.set(timing)
+        start = time.perf_counter()
+        try:
+            await telegram_bot.handle_message(update, context)
+            text = await asyncio.wait_for(reply, REQUEST_TIMEOUT)
+            error = "error_text" if is_error_text(text) else None
+        except asyncio.TimeoutError:
+            error = "TimeoutError"
+        ttft = timing["first"] - start if "first" in timing else None
+        results.record(mode, time.perf_counter() - start, ttft, error)
+
+    try:
+        started = time.perf_counter()
+        await drive(one_request, BOT_MIX, args)
+        elapsed = time.perf_counter() - started
+        return results.summary(elapsed, await sampler.stop())
+    finally:
+        telegram_bot.api_stream = stream
+        await transport.close()
+
+
+# --- reporting and baselines ----------------------------------------------
+
+def _lookup(summary: dict, path: tuple):
+    value = summary
+    for key in path:
+        value = value.get(key) if isinstance(value, dict) else None
+    return value
+
+
+def print_summary(target: str, summary: dict):
+    print(f"\n{target}: {summary['requests']} requests in {summary['elapsed_s']}s, "
+          f"{summary['throughput_rps']} ok/s, error rate {summary['error_rate']:.2%}")
+    if summary["errors"]:
+        print("errors: " + ", ".join(f"{k} x{v}" for k, v in sorted(summary["errors"].items())))
+    rss = summary["rss_mb"]
+    print(f"rss MB: start {rss['start']}, peak {rss['peak']}, end {rss['end']}")
+    print(f"\n{'kind':<22} {'ok':>6} {'err':>5} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'ttft p50':>9} {'ttft p95':>9}")
+    rows = list(summary["by_kind"].items()) + [("all", {
+        "ok": summary["ok"], "errors": summary["requests"] - summary["ok"],
+        "latency_ms": summary["latency_ms"], "ttft_ms": summary["ttft_ms"],
+    })]
+    fmt = lambda v: "-" if v is None else f"{v:,.1f}"
+    for kind, r in rows:
+        lat, ttft = r["latency_ms"], r["ttft_ms"]
+        print(f"{kind:<22} {r['ok']:>6} {r['errors']:>5} {fmt(lat['p50']):>9} {fmt(lat['p95']):>9} "
+              f"{fmt(lat['p99']):>9} {fmt(ttft['p50']):>9} {fmt(ttft['p95']):>9}")
+
+
+def compare(summary: dict, baseline: dict, tolerance: float) -> bool:
+    """Print current vs baseline; True when something regressed beyond `tolerance`."""
+    regressed = False
+    print(f"\n{'metric':<16} {'baseline':>10} {'current':>10} {'change':>8}")
+    for name, path, higher_is_better in BASELINE_METRICS:
+        old, new = _lookup(baseline, path), _lookup(summary, path)
+        if old is None or new is None:
+            continue
+        change = (new - old) / old if old else 0.0
+        worse = -change if higher_is_better else change
+        flag = "  REGRESSION" if worse > tolerance else ""
+        regressed = regressed or bool(flag)
+        print(f"{name:<16} {old:>10,.1f} {new:>10,.1f} {change:>+8.1%}{flag}")
+    old_rate, new_rate = baseline.get("error_rate", 0.0), summary["error_rate"]
+    if new_rate > old_rate + 0.01:
+        print(f"{'error rate':<16} {old_rate:>10.2%} {new_rate:>10.2%}  REGRESSION")
+        regressed = True
+    return regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("target", choices=("main", "local", "bot"))
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400, help="total requests (0 to run for --duration)")
+    parser.add_argument("--duration", type=float, default=0, help="seconds to run instead of a request count")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--env", action="append", default=[], metavar="KEY=VALUE",
+                        help="setting for the code under test, e.g. GROQ_MAX_IN_FLIGHT=16")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--compare", action="store_true", help="compare against the saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="relative change counted as a regression")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    if not args.requests and not args.duration:
+        parser.error("give --requests or --duration")
+
+    mock_port = free_port()
+    mock_url = f"http://127.0.0.1:{mock_port}"
+    mock_args = [f"--ttft={args.ttft}", f"--tokens-per-s={args.tokens_per_s}", f"--reply-tokens={args.reply_tokens}",
+                 f"--error-rate={args.error_rate}", f"--rate-limit-rate={args.rate_limit_rate}",
+                 f"--retry-after={args.retry_after}", f"--ollama-endpoints={args.ollama_endpoints}"]
+    mock = subprocess.Popen([sys.executable, "-m", "bench.mock_upstream", "--port", str(mock_port)] + mock_args, cwd=ROOT)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env.update({
+            "GROQ_API_KEY": "bench",
+            "GROQ_BASE_URL": mock_url,
+            "OLLAMA_API": mock_url,
+            # Per-user limits would turn the test into a test of the limiter.
+            "GROQ_USER_RATE": "0",
+            "HISTORY_BACKEND": "memory",
+            "RESPONSE_CACHE": "0",
+            "ANALYSIS_CACHE": "off",
+            "ANALYSIS_CACHE_DB": os.path.join(tmp, "analysis_cache.db"),
+            "BOT_PERSISTENCE_FILE": "",
+        })
+        env.update(item.split("=", 1) for item in args.env)
+
+        async def run():
+            await wait_for(mock_url + "/mock/stats", mock)
+            results = Results()
+            if args.target == "bot":
+                summary = await run_bot(args, env, results)
+            else:
+                summary = await run_http(args.target, args, env, results, tmp)
+            async with aiohttp.ClientSession() as session:
+                async with session.get(mock_url + "/mock/stats") as resp:
+                    summary["upstream"] = await resp.json()
+            return summary
+
+        try:
+            summary = asyncio.run(run())
+        finally:
+            mock.terminate()
+            mock.wait(10)
+
+    params = {k: getattr(args, k) for k in ("concurrency", "requests", "duration", "users", "seed", "ttft",
+                                            "tokens_per_s", "reply_tokens", "error_rate", "rate_limit_rate")}
+    params["env"] = args.env
+    print_summary(args.target, summary)
+    print(f"\nupstream: {summary['upstream']['requests']} (peak {summary['upstream']['peak_in_flight']} at once)")
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"target": args.target, "params": params, "results": summary}, f, indent=2)
+
+    baseline_path = os.path.join(BASELINE_DIR, f"{args.target}.json")
+    regressed = False
+    if args.compare:
+        if not os.path.exists(baseline_path):
+            print(f"\nno baseline at {baseline_path}; run with --save-baseline first")
+        else:
+            with open(baseline_path) as f:
+                baseline = json.load(f)
+            if baseline["params"] != params:
+                print("\nwarning: the baseline was recorded with different parameters:", baseline["params"])
+            regressed = compare(summary, baseline["results"], args.tolerance)
+    if args.save_baseline:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        with open(baseline_path, "w") as f:
+            json.dump({"target": args.target, "params": params, "results": summary}, f, indent=2)
+        print(f"\nbaseline saved to {baseline_path}")
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,244 @@
+"""
+Local stand-in for the Groq chat-completions API and an Ollama server.
+
+    python -m bench.mock_upstream [--port 8900] [--ttft 0.25] [--tokens-per-s 300]
+        [--reply-tokens 400] [--error-rate 0] [--rate-limit-rate 0] [--retry-after 1]
+        [--ollama-endpoints /api/chat,/api/generate,...]
+
+Point the backends at it with GROQ_BASE_URL=http://127.0.0.1:8900 (any
+GROQ_API_KEY) and OLLAMA_API=http://127.0.0.1:8900. Replies are filler
+text generated at the configured token rate, streamed when asked. A share
+of requests can fail with 500 or be rate-limited with 429 and retry-after.
+GET /mock/stats counts requests by route and status.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from collections import Counter
+
+from aiohttp import web
+
+# Ollama routes model_client.py probes, in its order.
+OLLAMA_ENDPOINTS = ('/api/chat', '/api/generate', '/v1/chat/completions', '/v1/completions', '/v1/complete', '/v1/responses')
+GROQ_ROUTE = '/openai/v1/chat/completions'
+
+# Streamed replies go out in chunks at most this far apart.
+CHUNK_INTERVAL = 0.02
+
+WORDS = (
+    "the request handler returns a response with the parsed body and status code so callers "
+    "can retry on failure while the cache keeps recent results close to the model def class "
+    "import async await yield return value list dict for in if else try except"
+).split()
+
+
+class MockConfig:
+    def __init__(self, ttft: float = 0.25, tokens_per_s: float = 300, reply_tokens: int = 400,
+                 error_rate: float = 0.0, rate_limit_rate: float = 0.0, retry_after: float = 1.0,
+                 ollama_endpoints=OLLAMA_ENDPOINTS, seed: int = 1):
+        self.ttft = ttft
+        self.tokens_per_s = tokens_per_s
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.ollama_endpoints = set(ollama_endpoints)
+        self.rng = random.Random(seed)
+
+
+class MockUpstream:
+    def __init__(self, config: MockConfig):
+        self.config = config
+        self.counts = Counter()
+        self.in_flight = 0
+        self.peak_in_flight = 0
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get('/mock/stats', self.stats)
+        app.router.add_post(GROQ_ROUTE, self.groq)
+        for endpoint in OLLAMA_ENDPOINTS:
+            app.router.add_post(endpoint, self.ollama)
+        return app
+
+    async def stats(self, request):
+        return web.json_response({
+            "requests": {f"{route} {status}": n for (route, status), n in sorted(self.counts.items())},
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+        })
+
+    def _reply_tokens(self, max_tokens) -> int:
+        # Lengths vary around the configured mean; completions stop at max_tokens.
+        tokens = int(self.config.rng.expovariate(1 / self.config.reply_tokens)) + 1
+        return min(tokens, max_tokens or tokens)
+
+    def _text(self, tokens: int) -> list:
+        rng = self.config.rng
+        return [rng.choice(WORDS) + " " for _ in range(tokens)]
+
+    def _injected_failure(self, route: str, groq: bool):
+        roll = self.config.rng.random()
+        if roll < self.config.rate_limit_rate:
+            self.counts[(route, 429)] += 1
+            body = {"error": {"message": "Rate limit reached (mock)", "type": "tokens", "code": "rate_limit_exceeded"}}
+            return web.json_response(body if groq else {"error": "rate limited (mock)"}, status=429,
+                                     headers={"retry-after": f"{self.config.retry_after:g}"})
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self.counts[(route, 500)] += 1
+            body = {"error": {"message": "Internal error (mock)", "type": "internal_server_error"}}
+            return web.json_response(body if groq else {"error": "internal error (mock)"}, status=500)
+        return None
+
+    async def _generate(self, words: list):
+        """Yield lists of words at the configured token rate, after the time to first token."""
+        await asyncio.sleep(self.config.ttft)
+        per_chunk = max(1, int(self.config.tokens_per_s * CHUNK_INTERVAL))
+        for i in range(0, len(words), per_chunk):
+            chunk = words[i:i + per_chunk]
+            yield chunk
+            if i + per_chunk < len(words):
+                await asyncio.sleep(len(chunk) / self.config.tokens_per_s)
+
+    async def _tracked(self, handler, request):
+        self.in_flight += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            return await handler(request)
+        finally:
+            self.in_flight -= 1
+
+    async def groq(self, request):
+        return await self._tracked(self._groq, request)
+
+    async def ollama(self, request):
+        return await self._tracked(self._ollama, request)
+
+    async def _groq(self, request):
+        body = await request.json()
+        failure = self._injected_failure(GROQ_ROUTE, groq=True)
+        if failure is not None:
+            return failure
+        self.counts[(GROQ_ROUTE, 200)] += 1
+        model = body.get("model", "mock")
+        words = self._text(self._reply_tokens(body.get("max_tokens")))
+        usage = {
+            "prompt_tokens": sum(len(m.get("content") or "") for m in body.get("messages", [])) // 4,
+            "completion_tokens": len(words),
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+        created = int(time.time())
+
+        if not body.get("stream"):
+            async for _ in self._generate(words):
+                pass
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": created, "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(words)},
+                             "finish_reason": "stop", "logprobs": None}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        async def send(delta: dict, finish=None, extra=None):
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                     "choices": [{"index": 0, "delta": delta, "finish_reason": finish, "logprobs": None}]}
+            if extra:
+                chunk.update(extra)
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+
+        await send({"role": "assistant", "content": ""})
+        async for chunk in self._generate(words):
+            await send({"content": "".join(chunk)})
+        # Groq puts the usage on the last chunk, under x_groq.
+        await send({}, finish="stop", extra={"x_groq": {"id": completion_id, "usage": usage}})
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def _ollama(self, request):
+        route = request.path
+        if route not in self.config.ollama_endpoints:
+            self.counts[(route, 404)] += 1
+            return web.Response(status=404, text="404 page not found")
+        body = await request.json()
+        failure = self._injected_failure(route, groq=False)
+        if failure is not None:
+            return failure
+        self.counts[(route, 200)] += 1
+        options = body.get("options") or {}
+        max_tokens = options.get("num_predict") or body.get("max_tokens") or body.get("max_output_tokens")
+        words = self._text(self._reply_tokens(max_tokens))
+        prompt = body.get("prompt") or body.get("input") or "".join(m.get("content", "") for m in body.get("messages", []))
+        prompt_tokens = len(prompt) // 4
+        model = body.get("model", "mock")
+
+        if route in ('/api/chat', '/api/generate') and body.get("stream"):
+            response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+            await response.prepare(request)
+            async for chunk in self._generate(words):
+                text = "".join(chunk)
+                line = {"model": model, "message": {"role": "assistant", "content": text}} if route == '/api/chat' \
+                    else {"model": model, "response": text}
+                await response.write((json.dumps(dict(line, done=False)) + "\n").encode())
+            final = {"model": model, "done": True, "prompt_eval_count": prompt_tokens, "eval_count": len(words)}
+            final.update({"message": {"role": "assistant", "content": ""}} if route == '/api/chat' else {"response": ""})
+            await response.write((json.dumps(final) + "\n").encode())
+            return response
+
+        async for _ in self._generate(words):
+            pass
+        text = "".join(words)
+        if route == '/api/chat':
+            data = {"model": model, "message": {"role": "assistant", "content": text}, "done": True,
+                    "prompt_eval_count": prompt_tokens, "eval_count": len(words)}
+        elif route == '/api/generate':
+            data = {"model": model, "response": text, "done": True,
+                    "prompt_eval_count": prompt_tokens, "eval_count": len(words)}
+        elif route == '/v1/chat/completions':
+            data = {"choices": [{"index": 0, "message": {"role": "assistant", "content": text}}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words)}}
+        elif route == '/v1/responses':
+            data = {"output": [{"content": [{"type": "output_text", "text": text}]}],
+                    "usage": {"input_tokens": prompt_tokens, "output_tokens": len(words)}}
+        else:
+            data = {"choices": [{"index": 0, "text": text}],
+                    "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(words)}}
+        return web.json_response(data)
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--ttft", type=float, default=0.25, help="seconds before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=300)
+    parser.add_argument("--reply-tokens", type=int, default=400, help="mean reply length in tokens")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="share of requests answered with 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="share of requests answered with 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="retry-after sent with 429s, in seconds")
+    parser.add_argument("--ollama-endpoints", default=",".join(OLLAMA_ENDPOINTS),
+                        help="Ollama routes that exist; the others answer 404")
+
+
+def config_from_args(args) -> MockConfig:
+    return MockConfig(
+        ttft=args.ttft, tokens_per_s=args.tokens_per_s, reply_tokens=args.reply_tokens,
+        error_rate=args.error_rate, rate_limit_rate=args.rate_limit_rate, retry_after=args.retry_after,
+        ollama_endpoints=[e.strip() for e in args.ollama_endpoints.split(",") if e.strip()],
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+    web.run_app(MockUpstream(config_from_args(args)).app(), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
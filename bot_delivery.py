@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import re
+
+from telegram.constants import ParseMode
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+TELEGRAM_MESSAGE_LIMIT = 4000
+# Telegram allows about 30 messages a second overall and one a second per chat.
+BOT_SEND_RATE = float(os.environ.get("BOT_SEND_RATE", "25"))
+BOT_CHAT_SEND_INTERVAL = float(os.environ.get("BOT_CHAT_SEND_INTERVAL", "1.0"))
+# Calls a chat may make back to back before that spacing applies, so the
+# placeholder and a quick answer don't wait on each other.
+BOT_CHAT_SEND_BURST = int(os.environ.get("BOT_CHAT_SEND_BURST", "3"))
+# Flood waits and timeouts retried per call before giving up.
+BOT_SEND_RETRIES = int(os.environ.get("BOT_SEND_RETRIES", "5"))
+# Replies longer than this go out as one file instead of a run of messages.
+BOT_DOCUMENT_THRESHOLD = int(os.environ.get("BOT_DOCUMENT_THRESHOLD", "12000"))
+
+FENCE = re.compile(r"^\s*```")
+CODE_BLOCK = re.compile(r"^```([\w+#.-]*)[^\n]*\n(.*?)^```", re.M | re.S)
+EXTENSIONS = {
+    "html": "html", "css": "css", "js": "js", "javascript": "js", "jsx": "jsx", "ts": "ts",
+    "typescript": "ts", "tsx": "tsx", "python": "py", "py": "py", "dart": "dart", "flutter": "dart",
+    "php": "php", "laravel": "php", "go": "go", "rust": "rs", "rs": "rs", "java": "java", "kotlin": "kt",
+    "cpp": "cpp", "c++": "cpp", "c": "c", "csharp": "cs", "c#": "cs", "ruby": "rb", "swift": "swift",
+    "sql": "sql", "json": "json", "yaml": "yaml", "yml": "yaml", "bash": "sh", "sh": "sh", "shell": "sh",
+}
+
+
+def retry_seconds(error: RetryAfter) -> float:
+    # An int today, a timedelta in later python-telegram-bot releases.
+    value = error.retry_after
+    return value.total_seconds() if hasattr(value, "total_seconds") else float(value)
+
+
+def split_markdown(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> list:
+    """
+    Split `text` into messages of at most `limit` characters at line breaks.
+    A code block cut in two is closed at the end of one message and opened
+    again, with its language, at the start of the next, so each message is
+    valid markdown on its own.
+    """
+    chunks = []
+    lines = []
+    size = 0
+    fence = None  # opening line of the code block we're in
+
+    def room(line: str) -> int:
+        # Space for `line`, keeping enough to close the block it leaves open.
+        closing = 4 if (fence is not None) != bool(FENCE.match(line)) else 0
+        return limit - size - (1 if lines else 0) - closing
+
+    def add(line: str):
+        nonlocal size
+        size += len(line) + (1 if lines else 0)
+        lines.append(line)
+
+    def flush():
+        nonlocal lines, size
+        if fence is not None:
+            lines.append("```")
+        chunks.append("\n".join(lines))
+        lines, size = [], 0
+        if fence is not None:
+            add(fence)
+
+    for line in text.split("\n"):
+        while len(line) > room(line):
+            if lines and lines != [fence]:
+                flush()
+                continue
+            # Longer than a whole message: cut it.
+            cut = max(1, room(line))
+            add(line[:cut])
+            line = line[cut:]
+            flush()
+        add(line)
+        if FENCE.match(line):
+            fence = line.strip() if fence is None else None
+    if lines and lines != [fence]:
+        chunks.append("\n".join(lines))
+    return [c for c in chunks if c.strip()]
+
+
+def document_for(text: str) -> tuple:
+    """
+    (filename, content, intro) for sending `text` as a file. A reply that is
+    mostly one code block is sent as that code, with an extension for its
+    language; anything else as markdown. `intro` is the prose before the
+    first block, for the caption.
+    """
+    intro = text.split("```", 1)[0].strip()
+    blocks = CODE_BLOCK.findall(text)
+    if len(blocks) == 1 and len(blocks[0][1]) >= 0.8 * len(text):
+        language, code = blocks[0]
+        return f"reply.{EXTENSIONS.get(language.lower(), 'txt')}", code, intro
+    return "reply.md", text, intro
+
+
+class Sender:
+    """
+    Spaces out the bot's outgoing messages so it stays under Telegram's
+    global and per-chat limits, and waits out flood control (RetryAfter)
+    instead of failing. Each call first reserves its chat's next turn, then
+    the next global turn, so one busy chat doesn't slow down the others.
+    """
+
+    def __init__(self, rate: float = BOT_SEND_RATE, chat_interval: float = BOT_CHAT_SEND_INTERVAL,
+                 chat_burst: int = BOT_CHAT_SEND_BURST, retries: int = BOT_SEND_RETRIES):
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self.chat_interval = chat_interval
+        self.chat_burst = chat_burst
+        self.chat_slack = max(0, chat_burst - 1) * chat_interval
+        self.retries = retries
+        self._next = 0.0
+        self._next_chat = {}  # chat_id -> when its next call is due, ignoring the burst
+        self.calls = 0
+        self.flood_waits = 0
+        self.retried = 0
+        self.failed = 0
+        self.plain_fallbacks = 0
+        self.documents = 0
+        self.total_delay = 0.0
+        self.max_delay = 0.0
+
+    def flood_wait(self, chat_id: int, seconds: float):
+        """Hold back `chat_id` for `seconds`: Telegram said so on a call made elsewhere."""
+        loop = asyncio.get_running_loop()
+        self.flood_waits += 1
+        # Past the slack too, so not even a burst goes out before then.
+        self._next_chat[chat_id] = max(self._next_chat.get(chat_id, 0.0), loop.time() + seconds + self.chat_slack)
+
+    async def _turn(self, chat_id: int):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        if len(self._next_chat) > 1024:
+            self._next_chat = {c: t for c, t in self._next_chat.items() if t > start}
+        due = max(start, self._next_chat.get(chat_id, 0.0))
+        at = max(start, due - self.chat_slack)
+        self._next_chat[chat_id] = due + self.chat_interval
+        if at > start:
+            await asyncio.sleep(at - start)
+        now = loop.time()
+        at = max(now, self._next)
+        self._next = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+        delay = loop.time() - start
+        self.total_delay += delay
+        self.max_delay = max(self.max_delay, delay)
+
+    async def call(self, chat_id: int, method, /, *args, **kwargs):
+        """Await `method(*args, **kwargs)`, a Bot API call into `chat_id`, in turn and through flood waits."""
+        for attempt in range(self.retries + 1):
+            await self._turn(chat_id)
+            self.calls += 1
+            try:
+                return await method(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.retries:
+                    self.failed += 1
+                    raise
+                wait = retry_seconds(e)
+                logger.warning("chat %s: flood control, waiting %.0f s", chat_id, wait)
+                self.flood_wait(chat_id, wait)
+                self.retried += 1
+            except TimedOut:
+                if attempt == self.retries:
+                    self.failed += 1
+                    raise
+                self.retried += 1
+
+    async def _markdown(self, method, text: str, **kwargs):
+        # Model output isn't always valid Telegram markdown; send it as
+        # plain text rather than not at all.
+        chat_id = kwargs["chat_id"]
+        try:
+            return await self.call(chat_id, method, text=text, parse_mode=ParseMode.MARKDOWN, **kwargs)
+        except BadRequest as e:
+            if "not modified" in str(e).lower():
+                return None
+            self.plain_fallbacks += 1
+            return await self.call(chat_id, method, text=text, **kwargs)
+
+    async def send_text(self, bot, chat_id: int, text: str, reply_markup=None):
+        return await self._markdown(bot.send_message, text, chat_id=chat_id, reply_markup=reply_markup)
+
+    async def edit_text(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        return await self._markdown(bot.edit_message_text, text, chat_id=chat_id, message_id=message_id,
+                                    reply_markup=reply_markup)
+
+    async def send_document(self, bot, chat_id: int, filename: str, content: str, caption: str = None, reply_markup=None):
+        self.documents += 1
+        return await self.call(chat_id, bot.send_document, chat_id=chat_id, document=content.encode("utf-8"),
+                               filename=filename, caption=caption, reply_markup=reply_markup)
+
+    async def deliver(self, bot, chat_id: int, message_id: int, text: str, reply_markup=None):
+        """
+        Put a finished reply in place of the placeholder `message_id`: edited
+        in when it fits, as a run of messages split at line breaks when it
+        doesn't, and as a file past BOT_DOCUMENT_THRESHOLD. `reply_markup`
+        goes on the last message.
+        """
+        if len(text) <= TELEGRAM_MESSAGE_LIMIT:
+            await self.edit_text(bot, chat_id, message_id, text, reply_markup)
+            return
+        if len(text) > BOT_DOCUMENT_THRESHOLD:
+            filename, content, intro = document_for(text)
+            note = intro if 0 < len(intro) <= TELEGRAM_MESSAGE_LIMIT else "Here it is:"
+            await self.edit_text(bot, chat_id, message_id, f"📎 The reply is long, so it's attached as `{filename}`.\n\n{note}")
+            await self.send_document(bot, chat_id, filename, content, reply_markup=reply_markup)
+            return
+        chunks = split_markdown(text)
+        await self.edit_text(bot, chat_id, message_id, chunks[0])
+        for i, chunk in enumerate(chunks[1:], 2):
+            await self.send_text(bot, chat_id, chunk, reply_markup if i == len(chunks) else None)
+
+    def stats(self) -> dict:
+        return {
+            "send_rate": 1 / self.interval if self.interval else 0.0,
+            "chat_interval_s": self.chat_interval,
+            "chat_burst": self.chat_burst,
+            "calls": self.calls,
+            "documents": self.documents,
+            "flood_waits": self.flood_waits,
+            "retried": self.retried,
+            "failed": self.failed,
+            "plain_fallbacks": self.plain_fallbacks,
+            "avg_delay_ms": round(self.total_delay / self.calls * 1000, 1) if self.calls else 0.0,
+            "max_delay_ms": round(self.max_delay * 1000, 1),
+        }
+
+
+sender = Sender()
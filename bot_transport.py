@@ -0,0 +1,289 @@
+import os
+import json
+import random
+import asyncio
+import logging
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+API_BASE = os.environ.get("API_BASE", "http://localhost:5000/api")
+BOT_TRANSPORT = os.environ.get("BOT_TRANSPORT", "auto")
+
+BOT_HTTP_POOL_SIZE = int(os.environ.get("BOT_HTTP_POOL_SIZE", "100"))
+BOT_HTTP_POOL_PER_HOST = int(os.environ.get("BOT_HTTP_POOL_PER_HOST", "0"))
+BOT_HTTP_KEEPALIVE = float(os.environ.get("BOT_HTTP_KEEPALIVE", "60"))
+BOT_HTTP_RETRIES = int(os.environ.get("BOT_HTTP_RETRIES", "3"))
+BOT_HTTP_RETRY_BACKOFF = float(os.environ.get("BOT_HTTP_RETRY_BACKOFF", "0.25"))
+
+# Total request timeout in seconds per endpoint; streams use it as the
+# maximum gap between two chunks instead.
+ENDPOINT_TIMEOUTS = {
+    "clear-history": 10,
+    "set-model": 10,
+    "chat": 120,
+    "analyze": 120,
+    "generate": 180,
+    "research": 180,
+    "website": 300,
+}
+DEFAULT_TIMEOUT = 120
+# Submitting a job only queues it, so it should answer quickly.
+JOB_SUBMIT_TIMEOUT = 15
+
+
+def status_error(resp: aiohttp.ClientResponse) -> str:
+    # 429 means the backend shed the request or the user is over its rate limit.
+    retry_after = resp.headers.get("Retry-After")
+    if resp.status == 429 and retry_after:
+        return f"API error: {resp.status} (busy, retry in {retry_after}s)"
+    return f"API error: {resp.status}"
+
+
+class HttpTransport:
+    """Talks to the FastAPI backend over HTTP, for split deployments."""
+
+    def __init__(self, base_url: str = API_BASE):
+        self.base_url = base_url.rstrip("/")
+        self.session = None
+
+    async def start(self):
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=BOT_HTTP_POOL_SIZE,
+                limit_per_host=BOT_HTTP_POOL_PER_HOST,
+                keepalive_timeout=BOT_HTTP_KEEPALIVE,
+                ttl_dns_cache=300,
+            )
+            self.session = aiohttp.ClientSession(connector=connector)
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _post(self, url: str, data: dict, timeout: aiohttp.ClientTimeout) -> aiohttp.ClientResponse:
+        """
+        POST on the shared session, retrying with full-jitter exponential
+        backoff when the connection can't be made. Nothing else is retried
+        (timeouts, disconnects): once the request may have been sent, the
+        backend may have run it, and running it again would answer twice,
+        record history twice and charge the user twice.
+        """
+        await self.start()
+        for attempt in range(BOT_HTTP_RETRIES + 1):
+            try:
+                return await self.session.post(url, json=data, timeout=timeout)
+            except aiohttp.ClientConnectorError as e:
+                if attempt == BOT_HTTP_RETRIES:
+                    raise
+                delay = random.uniform(0, BOT_HTTP_RETRY_BACKOFF * 2 ** attempt)
+                logger.warning("POST %s failed (%s), retrying in %.2fs", url, e, delay)
+                await asyncio.sleep(delay)
+
+    async def request(self, endpoint: str, data: dict) -> dict:
+        try:
+            timeout = aiohttp.ClientTimeout(total=ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT))
+            async with await self._post(f"{self.base_url}/{endpoint}", data, timeout) as resp:
+                if resp.status == 200:
+                    return await resp.json()
+                return {"error": status_error(resp)}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def submit_job(self, endpoint: str, data: dict) -> dict:
+        """Queue a request as a background job: {"job_id", "status"} or {"error"}."""
+        try:
+            timeout = aiohttp.ClientTimeout(total=JOB_SUBMIT_TIMEOUT)
+            async with await self._post(f"{self.base_url}/{endpoint}/jobs", data, timeout) as resp:
+                if resp.status == 202:
+                    return await resp.json()
+                return {"error": f"API error: {resp.status}"}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def wait_job(self, job_id: str, wait: float) -> dict:
+        """
+        The job's status after waiting up to `wait` seconds for it to finish.
+        {"status": "missing"} when the backend doesn't know it (expired or
+        restarted); {"error"} when the backend couldn't be asked.
+        """
+        await self.start()
+        try:
+            timeout = aiohttp.ClientTimeout(total=wait + JOB_SUBMIT_TIMEOUT)
+            url = f"{self.base_url}/jobs/{job_id}"
+            async with self.session.get(url, params={"wait": str(wait)}, timeout=timeout) as resp:
+                if resp.status == 200:
+                    return await resp.json()
+                if resp.status == 404:
+                    return {"status": "missing"}
+                return {"error": f"API error: {resp.status}"}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def stream(self, endpoint: str, data: dict):
+        idle = ENDPOINT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUT)
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=idle)
+        async with await self._post(f"{self.base_url}/{endpoint}/stream", data, timeout) as resp:
+            if resp.status != 200:
+                raise RuntimeError(status_error(resp))
+            event = "message"
+            async for raw in resp.content:
+                line = raw.decode("utf-8").rstrip("\r\n")
+                if not line:
+                    event = "message"
+                elif line.startswith("event:"):
+                    event = line[6:].strip()
+                elif line.startswith("data:") and event == "message":
+                    yield json.loads(line[5:].strip()).get("delta", "")
+
+
+_STREAM_END = object()
+
+
+class LocalTransport:
+    """
+    Calls `ai_client` directly when the bot shares a process with the
+    backend, skipping JSON encoding, the loopback HTTP hop and request
+    validation. Responses have the same shape as the HTTP API's.
+
+    `loop` is the event loop the backend runs on. AIClient's Groq client and
+    upstream gate belong to that loop, so when the bot runs on a different
+    one (uvicorn in a thread, see main.py) calls are handed over to it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None):
+        from ai_client import ai_client
+        from jobs import job_queue
+        self.client = ai_client
+        self.jobs = job_queue
+        self.loop = loop
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+    async def _sync(self, fn, *args):
+        return fn(*args)
+
+    def _call(self, endpoint: str, d: dict):
+        c = self.client
+        user_id = d.get("user_id", "default")
+        model = d.get("model")
+        if endpoint == "chat":
+            return "response", c.chat(d["text"], user_id, d.get("context"), d.get("max_tokens", 4096), model)
+        if endpoint == "analyze":
+            return "analysis", c.analyze_code(d["code"], d.get("language", "auto"), user_id, model)
+        if endpoint == "generate":
+            return "code", c.generate_code(d["description"], d["language"], user_id, model)
+        if endpoint == "research":
+            return "research", c.research(d["topic"], user_id, model)
+        if endpoint == "website":
+            return "website", c.create_website(d["description"], user_id, model)
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+    def _stream_source(self, endpoint: str, d: dict):
+        c = self.client
+        user_id = d.get("user_id", "default")
+        model = d.get("model")
+        if endpoint == "chat":
+            return c.chat_stream(d["text"], user_id, d.get("context"), d.get("max_tokens", 4096), model)
+        if endpoint == "analyze":
+            return c.analyze_code_stream(d["code"], d.get("language", "auto"), user_id, model)
+        if endpoint == "generate":
+            return c.generate_code_stream(d["description"], d["language"], user_id, model)
+        if endpoint == "research":
+            return c.research_stream(d["topic"], user_id, model)
+        if endpoint == "website":
+            return c.create_website_stream(d["description"], user_id, model)
+        raise ValueError(f"Unknown endpoint: {endpoint}")
+
+    def _on_backend_loop(self) -> bool:
+        return self.loop is None or self.loop is asyncio.get_running_loop()
+
+    async def _run(self, coro):
+        if self._on_backend_loop():
+            return await coro
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    async def request(self, endpoint: str, data: dict) -> dict:
+        try:
+            if endpoint == "clear-history":
+                await self._run(self._sync(self.client.clear_history, data["user_id"]))
+                return {"status": "cleared"}
+            if endpoint == "set-model":
+                if await self._run(self._sync(self.client.set_model, data["model_id"], data.get("user_id"))):
+                    return {"status": "success", "model": data["model_id"]}
+                return {"status": "error", "message": "Invalid model"}
+            key, coro = self._call(endpoint, data)
+            return {key: await self._run(coro)}
+        except KeyError as e:
+            return {"error": f"Invalid request: missing {e}"}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def submit_job(self, endpoint: str, data: dict) -> dict:
+        try:
+            user_id = data.get("user_id", "default")
+            job = await self._run(self._sync(self.jobs.submit, endpoint, user_id, lambda: self._call(endpoint, data)[1]))
+            return {"job_id": job.id, "status": job.status}
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def _job_status(self, job_id: str, wait: float) -> dict:
+        job = await self.jobs.wait(job_id, wait)
+        return job.to_dict() if job is not None else {"status": "missing"}
+
+    async def wait_job(self, job_id: str, wait: float) -> dict:
+        try:
+            return await self._run(self._job_status(job_id, wait))
+        except Exception as e:
+            return {"error": str(e)}
+
+    async def stream(self, endpoint: str, data: dict):
+        source = self._stream_source(endpoint, data)
+        if self._on_backend_loop():
+            async for delta in source:
+                yield delta
+            return
+
+        # Pump the generator on the backend loop and hand the deltas back
+        # to this loop through a queue.
+        here = asyncio.get_running_loop()
+        queue = asyncio.Queue()
+
+        async def pump():
+            try:
+                async for delta in source:
+                    here.call_soon_threadsafe(queue.put_nowait, delta)
+            except Exception as e:
+                here.call_soon_threadsafe(queue.put_nowait, e)
+            finally:
+                here.call_soon_threadsafe(queue.put_nowait, _STREAM_END)
+
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                item = await queue.get()
+                if item is _STREAM_END:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+        finally:
+            future.cancel()
+
+
+def make_transport(loop: asyncio.AbstractEventLoop = None):
+    """
+    BOT_TRANSPORT=http|local forces a transport; the default ("auto") goes
+    in-process when the backend shares this process, i.e. when main.py
+    passes the backend's loop, and over HTTP otherwise.
+    """
+    if BOT_TRANSPORT == "http":
+        return HttpTransport()
+    if BOT_TRANSPORT == "local" or loop is not None:
+        return LocalTransport(loop)
+    return HttpTransport()
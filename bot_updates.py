@@ -0,0 +1,122 @@
+import asyncio
+import os
+import time
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Updates handled at once, across all chats.
+BOT_CONCURRENT_UPDATES = int(os.environ.get("BOT_CONCURRENT_UPDATES", "32"))
+# Updates accepted at once, counting those waiting behind an earlier update
+# from their chat; past this the bot stops taking new ones from Telegram.
+BOT_MAX_PENDING_UPDATES = int(os.environ.get("BOT_MAX_PENDING_UPDATES", "1024"))
+
+
+def chat_key(update: object):
+    """What an update is ordered by: its chat, else its user, else nothing."""
+    if isinstance(update, Update):
+        if update.effective_chat is not None:
+            return update.effective_chat.id
+        if update.effective_user is not None:
+            return ("user", update.effective_user.id)
+    return None
+
+
+class _ChatQueue:
+    __slots__ = ("lock", "pending")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.pending = 0
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """
+    Handles updates from different chats concurrently, up to `max_running`
+    at once, and updates from the same chat one after another in the order
+    they arrived, so a long reply in one chat holds up only that chat.
+
+    PTB's own limit (max_concurrent_updates) bounds every update accepted,
+    including the ones waiting for their chat's turn. `max_running` applies
+    only once that turn has come, so a chat with a backlog never occupies
+    slots other chats could use.
+    """
+
+    def __init__(self, max_running: int = BOT_CONCURRENT_UPDATES, max_pending: int = BOT_MAX_PENDING_UPDATES):
+        super().__init__(max(max_pending, max_running))
+        self.max_running = max_running
+        self._slots = asyncio.Semaphore(max_running)
+        self._chats = {}
+        self.running = 0
+        self.peak_running = 0
+        self.waiting = 0
+        self.processed = 0
+        self.peak_chat_depth = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_process_update(self, update: object, coroutine):
+        key = chat_key(update)
+        if key is None:
+            await self._run(coroutine, time.monotonic())
+            return
+        chat = self._chats.get(key)
+        if chat is None:
+            chat = self._chats[key] = _ChatQueue()
+        chat.pending += 1
+        self.peak_chat_depth = max(self.peak_chat_depth, chat.pending)
+        start = time.monotonic()
+        try:
+            async with chat.lock:
+                await self._run(coroutine, start)
+        except asyncio.CancelledError:
+            coroutine.close()  # cancelled before its turn (shutdown)
+            raise
+        finally:
+            chat.pending -= 1
+            if not chat.pending:
+                del self._chats[key]
+
+    async def _run(self, coroutine, start: float):
+        self.waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - start
+        self.total_wait += waited
+        self.max_wait = max(self.max_wait, waited)
+        self.running += 1
+        self.peak_running = max(self.peak_running, self.running)
+        try:
+            await coroutine
+        finally:
+            self.running -= 1
+            self.processed += 1
+            self._slots.release()
+
+    def stats(self) -> dict:
+        # Also read from the API's thread when the bot shares its process;
+        # list() copies the values without running Python code in between.
+        depths = [chat.pending for chat in list(self._chats.values())]
+        started = self.processed + self.running
+        return {
+            "max_running": self.max_running,
+            "max_pending": self.max_concurrent_updates,
+            "running": self.running,
+            "peak_running": self.peak_running,
+            "waiting_for_slot": self.waiting,
+            "processed": self.processed,
+            "chats_active": len(depths),
+            "queued_behind_chat": sum(depths) - len(depths),
+            "max_chat_depth": max(depths, default=0),
+            "peak_chat_depth": self.peak_chat_depth,
+            "avg_wait_ms": round(self.total_wait / started * 1000, 1) if started else 0.0,
+            "max_wait_ms": round(self.max_wait * 1000, 1),
+        }
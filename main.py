@@ -1,22 +1,50 @@
 import asyncio
 import threading
+import time
 import os
 import sys
 
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), 'backend'))
 
+BACKEND_STARTUP_TIMEOUT = float(os.environ.get("BACKEND_STARTUP_TIMEOUT", "30"))
+
 def run_backend():
+    """
+    Start uvicorn on its own event loop in a daemon thread and return the
+    server, the loop and the thread.
+    """
     import uvicorn
-    uvicorn.run("app:app", host="0.0.0.0", port=5000, reload=False, log_level="info")
+    config = uvicorn.Config("app:app", host="0.0.0.0", port=5000, reload=False, log_level="info")
+    server = uvicorn.Server(config)
+    loop = asyncio.new_event_loop()
+    
+    def serve():
+        asyncio.set_event_loop(loop)
+        loop.run_until_complete(server.serve())
+    
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    return server, loop, thread
 
-def run_telegram_bot():
+def wait_for_backend(server, thread, timeout: float = BACKEND_STARTUP_TIMEOUT):
+    # uvicorn sets `started` once the app's startup has run and the socket
+    # is listening, so the bot never races the server.
+    deadline = time.monotonic() + timeout
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("Backend exited during startup")
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"Backend not ready after {timeout:.0f}s")
+        time.sleep(0.02)
+
+def run_telegram_bot(backend_loop=None, api=None):
     from telegram_bot import main as bot_main
-    bot_main()
+    bot_main(backend_loop, api)
 
 if __name__ == "__main__":
-    backend_thread = threading.Thread(target=run_backend, daemon=True)
-    backend_thread.start()
-    
-    asyncio.get_event_loop().run_until_complete(asyncio.sleep(2))
+    server, backend_loop, backend_thread = run_backend()
+    wait_for_backend(server, backend_thread)
     
-    run_telegram_bot()
+    # The module uvicorn loaded, so the bot can report and take webhook updates through it.
+    from app import app as api
+    run_telegram_bot(backend_loop, api)
@@ -1,16 +1,54 @@
 import os
+import time
+import signal
 import asyncio
 import logging
+import secrets
+from urllib.parse import urlparse
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes
+from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, PicklePersistence, filters, ContextTypes
 from telegram.constants import ParseMode, ChatAction
-import aiohttp
+from telegram.error import BadRequest, RetryAfter
+
+from bot_transport import make_transport
+from bot_updates import ChatOrderedUpdateProcessor
+from bot_delivery import TELEGRAM_MESSAGE_LIMIT, retry_seconds, sender
 
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 TELEGRAM_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN")
-API_BASE = "http://localhost:5000/api"
+STREAM_EDIT_INTERVAL = float(os.environ.get("STREAM_EDIT_INTERVAL", "1.5"))
+# Where per-user settings (mode, language, model) survive restarts; empty to disable.
+BOT_PERSISTENCE_FILE = os.environ.get("BOT_PERSISTENCE_FILE", "bot_state.pickle")
+# Modes that run as backend jobs: the reply is posted when it's ready
+# instead of holding a request open for minutes.
+BOT_JOB_ENDPOINTS = {e.strip() for e in os.environ.get("BOT_JOB_ENDPOINTS", "website,research").split(",") if e.strip()}
+BOT_JOB_POLL_WAIT = float(os.environ.get("BOT_JOB_POLL_WAIT", "50"))
+# How long to keep retrying while the backend can't be reached about a job.
+BOT_JOB_DEADLINE = float(os.environ.get("BOT_JOB_DEADLINE", "3600"))
+# Public HTTPS URL Telegram posts updates to; empty to poll instead. Under
+# main.py the API takes them at /api/telegram/webhook, otherwise the bot
+# listens on BOT_WEBHOOK_LISTEN:BOT_WEBHOOK_PORT at the URL's path.
+BOT_WEBHOOK_URL = os.environ.get("BOT_WEBHOOK_URL", "")
+# Checked against Telegram's secret token header; random per start when empty.
+BOT_WEBHOOK_SECRET = os.environ.get("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_LISTEN = os.environ.get("BOT_WEBHOOK_LISTEN", "0.0.0.0")
+BOT_WEBHOOK_PORT = int(os.environ.get("BOT_WEBHOOK_PORT", "8443"))
+# Seconds between update handling stats in the log; 0 to disable.
+BOT_STATS_INTERVAL = float(os.environ.get("BOT_STATS_INTERVAL", "300"))
+
+DEFAULT_MODEL = "llama-3.3-70b-versatile"
+MODEL_NAMES = {
+    "llama-3.3-70b-versatile": "LLaMA 3.3 70B 🦙",
+    "llama-3.1-8b-instant": "LLaMA 3.1 8B ⚡",
+    "mixtral-8x7b-32768": "Mixtral 8x7B 🔮",
+    "gemma2-9b-it": "Gemma 2 9B 💎",
+    "auto": "Auto (fastest available) 🧭"
+}
+
+transport = None
+stats_task = None
 
 WELCOME_MESSAGE = """
 🤖 *Welcome to TradePackage AI!*
@@ -81,35 +119,93 @@ def get_language_keyboard():
 def get_back_keyboard():
     return InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")]])
 
-def get_model_keyboard():
+def get_model_keyboard(current: str = DEFAULT_MODEL):
+    options = [
+        ("🦙 LLaMA 3.3 70B", "llama-3.3-70b-versatile"),
+        ("⚡ LLaMA 3.1 8B (Fast)", "llama-3.1-8b-instant"),
+        ("🔮 Mixtral 8x7B", "mixtral-8x7b-32768"),
+        ("💎 Gemma 2 9B", "gemma2-9b-it"),
+        ("🧭 Auto (Fastest Available)", "auto"),
+    ]
     keyboard = [
-        [
-            InlineKeyboardButton("🦙 LLaMA 3.3 70B", callback_data="model_llama-3.3-70b-versatile")
-        ],
-        [
-            InlineKeyboardButton("⚡ LLaMA 3.1 8B (Fast)", callback_data="model_llama-3.1-8b-instant")
-        ],
-        [
-            InlineKeyboardButton("🔮 Mixtral 8x7B", callback_data="model_mixtral-8x7b-32768")
-        ],
-        [
-            InlineKeyboardButton("💎 Gemma 2 9B", callback_data="model_gemma2-9b-it")
-        ],
-        [
-            InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")
-        ]
+        [InlineKeyboardButton(f"✅ {label}" if model_id == current else label, callback_data=f"model_{model_id}")]
+        for label, model_id in options
     ]
+    keyboard.append([InlineKeyboardButton("🔙 Back to Menu", callback_data="menu")])
     return InlineKeyboardMarkup(keyboard)
 
 async def api_request(endpoint: str, data: dict) -> dict:
+    return await transport.request(endpoint, data)
+
+def api_stream(endpoint: str, data: dict):
+    return transport.stream(endpoint, data)
+
+def build_request(mode: str, language: str, message: str, user_id: str, model: str):
+    if mode == 'code' and language:
+        return "generate", {"description": message, "language": language, "user_id": user_id, "model": model}
+    if mode == 'analyze':
+        return "analyze", {"code": message, "user_id": user_id, "model": model}
+    if mode == 'website':
+        return "website", {"description": message, "user_id": user_id, "model": model}
+    if mode == 'research':
+        return "research", {"topic": message, "user_id": user_id, "model": model}
+    return "chat", {"text": message, "user_id": user_id, "model": model}
+
+def render_preview(text: str) -> str:
+    # Partial markdown usually doesn't parse, so previews go out as plain text
+    # and only show the tail once the reply outgrows a single message.
+    preview = text + " ▌"
+    if len(preview) > TELEGRAM_MESSAGE_LIMIT:
+        preview = "…" + preview[-(TELEGRAM_MESSAGE_LIMIT - 1):]
+    return preview
+
+async def finish_reply(bot, chat_id: int, message_id: int, response: str):
+    """Replace the placeholder message with the final answer (see Sender.deliver)."""
+    await sender.deliver(bot, chat_id, message_id, response, get_back_keyboard())
+
+def track_job(application: Application, job_id: str, endpoint: str, chat_id: int, message_id: int):
+    # Kept in bot_data, which is persisted, so a restarted bot still delivers.
+    application.bot_data.setdefault("pending_jobs", {})[job_id] = {
+        "endpoint": endpoint, "chat_id": chat_id, "message_id": message_id, "submitted": time.time()
+    }
+    application.create_task(deliver_job(application, job_id))
+
+async def deliver_job(application: Application, job_id: str):
+    """Wait for a backend job and post its result in place of the placeholder."""
+    pending = application.bot_data.setdefault("pending_jobs", {})
+    info = pending.get(job_id)
+    if info is None:
+        return
+    delay = 1
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(f"{API_BASE}/{endpoint}", json=data, timeout=aiohttp.ClientTimeout(total=120)) as resp:
-                if resp.status == 200:
-                    return await resp.json()
-                return {"error": f"API error: {resp.status}"}
+        while True:
+            job = await transport.wait_job(job_id, BOT_JOB_POLL_WAIT)
+            status = job.get("status")
+            if status in ("done", "failed", "missing"):
+                break
+            if "error" in job:
+                # The backend is unreachable; the job itself keeps running there.
+                if time.time() - info["submitted"] > BOT_JOB_DEADLINE:
+                    status = "failed"
+                    break
+                logger.warning("job %s: status check failed (%s), retrying in %ds", job_id, job["error"], delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 30)
+            else:
+                delay = 1
+        
+        if status == "done":
+            response = job.get("result") or "Error processing request"
+        elif status == "missing":
+            response = "❌ The result expired or the server restarted before it was ready.\n\nPlease try again."
+        else:
+            response = f"❌ Error: {job.get('error')}\n\nPlease try again."
+        logger.info("job %s (%s): %s after %.0f s", job_id, info["endpoint"], status, time.time() - info["submitted"])
+        await finish_reply(application.bot, info["chat_id"], info["message_id"], response)
     except Exception as e:
-        return {"error": str(e)}
+        logger.error("job %s: delivery failed: %s", job_id, e)
+    finally:
+        pending.pop(job_id, None)
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['mode'] = 'chat'
@@ -222,12 +318,13 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(help_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard())
     
     elif data == "settings":
-        settings_text = """*⚙️ Settings*
+        model_name = MODEL_NAMES.get(context.user_data.get('model', DEFAULT_MODEL), DEFAULT_MODEL)
+        settings_text = f"""*⚙️ Settings*
 
 Current configuration:
-• Model: LLaMA 3.3 70B (Free)
+• Model: {model_name} (Free)
 • Max Response: 4096 tokens
-• Memory: Last 20 messages
+• Memory: Recent conversation (token-budgeted)
 
 _Tap "Change AI Model" to switch models!_"""
         await query.edit_message_text(settings_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard())
@@ -240,19 +337,21 @@ Choose from these FREE open-source models:
 🦙 *LLaMA 3.3 70B* - Best quality, most capable
 ⚡ *LLaMA 3.1 8B* - Fast responses
 🔮 *Mixtral 8x7B* - Great balance
-💎 *Gemma 2 9B* - Efficient & smart"""
-        await query.edit_message_text(models_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_model_keyboard())
+💎 *Gemma 2 9B* - Efficient & smart
+🧭 *Auto* - Fastest healthy model for each request"""
+        current = context.user_data.get('model', DEFAULT_MODEL)
+        await query.edit_message_text(models_text, parse_mode=ParseMode.MARKDOWN, reply_markup=get_model_keyboard(current))
     
     elif data.startswith("model_"):
         model_id = data.replace("model_", "")
-        model_names = {
-            "llama-3.3-70b-versatile": "LLaMA 3.3 70B 🦙",
-            "llama-3.1-8b-instant": "LLaMA 3.1 8B ⚡",
-            "mixtral-8x7b-32768": "Mixtral 8x7B 🔮",
-            "gemma2-9b-it": "Gemma 2 9B 💎"
-        }
-        await api_request("set-model", {"model_id": model_id})
-        await query.edit_message_text(f"✅ *Model Changed!*\n\nNow using: *{model_names.get(model_id, model_id)}*\n\nThis model is completely FREE!", parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_keyboard())
+        if model_id not in MODEL_NAMES:
+            return
+        # The choice only applies to this user; it is sent with every request
+        # and also remembered server-side for this user_id.
+        context.user_data['model'] = model_id
+        user_id = str(update.effective_user.id)
+        await api_request("set-model", {"model_id": model_id, "user_id": user_id})
+        await query.edit_message_text(f"✅ *Model Changed!*\n\nNow using: *{MODEL_NAMES[model_id]}*\n\nThis model is completely FREE!", parse_mode=ParseMode.MARKDOWN, reply_markup=get_main_keyboard())
 
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = str(update.effective_user.id)
@@ -262,40 +361,54 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await update.message.chat.send_action(ChatAction.TYPING)
     
-    thinking_msg = await update.message.reply_text("🤔 *Thinking...*", parse_mode=ParseMode.MARKDOWN)
+    chat_id = update.effective_chat.id
+    thinking_msg = await sender.call(chat_id, update.message.reply_text, "🤔 *Thinking...*", parse_mode=ParseMode.MARKDOWN)
+    
+    model = context.user_data.get('model', DEFAULT_MODEL)
+    endpoint, payload = build_request(mode, language, message, user_id, model)
+    
+    if endpoint in BOT_JOB_ENDPOINTS:
+        job = await transport.submit_job(endpoint, payload)
+        if "job_id" in job:
+            await sender.call(chat_id, thinking_msg.edit_text, "⏳ *Working on it...*\n\nThis one takes a while. I'll post the result right here when it's ready.", parse_mode=ParseMode.MARKDOWN)
+            track_job(context.application, job["job_id"], endpoint, thinking_msg.chat_id, thinking_msg.message_id)
+            return
+        logger.warning("%s: job submit failed (%s), streaming instead", endpoint, job.get("error"))
     
     try:
-        if mode == 'code' and language:
-            result = await api_request("generate", {"description": message, "language": language, "user_id": user_id})
-            response = result.get("code", result.get("error", "Error generating code"))
-        elif mode == 'analyze':
-            result = await api_request("analyze", {"code": message, "user_id": user_id})
-            response = result.get("analysis", result.get("error", "Error analyzing code"))
-        elif mode == 'website':
-            result = await api_request("website", {"description": message, "user_id": user_id})
-            response = result.get("website", result.get("error", "Error creating website"))
-        elif mode == 'research':
-            result = await api_request("research", {"topic": message, "user_id": user_id})
-            response = result.get("research", result.get("error", "Error researching topic"))
-        else:
-            result = await api_request("chat", {"text": message, "user_id": user_id})
-            response = result.get("response", result.get("error", "Error processing request"))
+        started = time.monotonic()
+        parts = []
+        shown = ""
+        next_edit = started + STREAM_EDIT_INTERVAL
+        async for delta in api_stream(endpoint, payload):
+            if not parts:
+                logger.info("%s: first token after %.0f ms", endpoint, (time.monotonic() - started) * 1000)
+            parts.append(delta)
+            now = time.monotonic()
+            if now < next_edit:
+                continue
+            next_edit = now + STREAM_EDIT_INTERVAL
+            preview = render_preview("".join(parts))
+            if preview == shown:
+                continue
+            try:
+                await thinking_msg.edit_text(preview)
+                shown = preview
+            except RetryAfter as e:
+                # Previews are skipped, not queued, but the final reply must wait too.
+                next_edit = now + retry_seconds(e)
+                sender.flood_wait(chat_id, retry_seconds(e))
+            except BadRequest:
+                pass
         
-        await thinking_msg.delete()
+        response = "".join(parts) or "Error processing request"
+        logger.info("%s: completed in %.0f ms (%d chars)", endpoint, (time.monotonic() - started) * 1000, len(response))
         
-        if len(response) > 4000:
-            chunks = [response[i:i+4000] for i in range(0, len(response), 4000)]
-            for i, chunk in enumerate(chunks):
-                if i == len(chunks) - 1:
-                    await update.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard())
-                else:
-                    await update.message.reply_text(chunk, parse_mode=ParseMode.MARKDOWN)
-        else:
-            await update.message.reply_text(response, parse_mode=ParseMode.MARKDOWN, reply_markup=get_back_keyboard())
+        await finish_reply(context.bot, thinking_msg.chat_id, thinking_msg.message_id, response)
     
     except Exception as e:
         await thinking_msg.delete()
-        await update.message.reply_text(f"❌ Error: {str(e)}\n\nPlease try again.", reply_markup=get_main_keyboard())
+        await sender.call(chat_id, update.message.reply_text, f"❌ Error: {str(e)}\n\nPlease try again.", reply_markup=get_main_keyboard())
 
 async def set_commands(application: Application):
     commands = [
@@ -306,8 +419,102 @@ async def set_commands(application: Application):
     ]
     await application.bot.set_my_commands(commands)
 
-def main():
-    application = Application.builder().token(TELEGRAM_TOKEN).build()
+async def log_update_stats(application: Application):
+    last = None
+    while True:
+        await asyncio.sleep(BOT_STATS_INTERVAL)
+        stats = application.update_processor.stats()
+        if stats["processed"] == last and not stats["running"]:
+            continue
+        last = stats["processed"]
+        logger.info(
+            "updates: %d handled, %d running (peak %d), %d waiting for a slot, %d queued behind their chat across %d chats (deepest %d)",
+            stats["processed"], stats["running"], stats["peak_running"], stats["waiting_for_slot"],
+            stats["queued_behind_chat"], stats["chats_active"], stats["max_chat_depth"],
+        )
+
+async def post_init(application: Application):
+    global stats_task
+    await transport.start()
+    await set_commands(application)
+    # Pick up deliveries that were pending when the bot last stopped.
+    for job_id in list(application.bot_data.get("pending_jobs", {})):
+        application.create_task(deliver_job(application, job_id))
+    if BOT_STATS_INTERVAL > 0:
+        stats_task = asyncio.create_task(log_update_stats(application))
+
+async def post_shutdown(application: Application):
+    if stats_task is not None:
+        stats_task.cancel()
+    await transport.close()
+
+class InProcessBot:
+    """
+    What the API sees of the bot when main.py runs both in one process:
+    update handling stats for /api/stats, and in webhook mode a way to hand
+    over the updates posted to /api/telegram/webhook. The route runs on the
+    API's event loop; updates are queued on the bot's.
+    """
+    
+    def __init__(self, application: Application, secret: str = None):
+        self.application = application
+        self.secret = secret  # None when polling
+        self.loop = None
+        self.received = 0
+    
+    def receive(self, data: dict) -> bool:
+        loop = self.loop
+        if loop is None:
+            return False  # not started yet, or stopping
+        update = Update.de_json(data, self.application.bot)
+        loop.call_soon_threadsafe(self.application.update_queue.put_nowait, update)
+        self.received += 1
+        return True
+    
+    def stats(self) -> dict:
+        stats = {"mode": "webhook" if self.secret else "polling"}
+        if self.secret:
+            stats["webhook_updates"] = self.received
+        stats.update(self.application.update_processor.stats())
+        stats["delivery"] = sender.stats()
+        return stats
+
+async def serve_webhook(application: Application, bot: InProcessBot):
+    """Handle the updates the API's webhook route hands over, until SIGINT or SIGTERM."""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    
+    async with application:
+        await application.post_init(application)
+        await application.start()
+        await application.bot.set_webhook(BOT_WEBHOOK_URL, allowed_updates=Update.ALL_TYPES, secret_token=bot.secret)
+        bot.loop = loop
+        try:
+            await stop.wait()
+        finally:
+            bot.loop = None
+            await application.stop()
+            await application.post_shutdown(application)
+
+def main(backend_loop=None, api=None):
+    """
+    Run the bot. `backend_loop` is the event loop of a backend running in
+    this process (see main.py); when given, requests skip HTTP and call the
+    AI client directly. `api` is that backend's FastAPI app: the bot reports
+    its stats there and, in webhook mode, receives its updates through it.
+    """
+    global transport
+    transport = make_transport(backend_loop)
+    
+    # Chats are handled in parallel, each chat's updates in order.
+    builder = Application.builder().token(TELEGRAM_TOKEN).concurrent_updates(ChatOrderedUpdateProcessor())
+    if BOT_PERSISTENCE_FILE:
+        builder = builder.persistence(PicklePersistence(filepath=BOT_PERSISTENCE_FILE))
+    if BOT_WEBHOOK_URL and api is not None:
+        builder = builder.updater(None)
+    application = builder.build()
     
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
@@ -316,10 +523,31 @@ def main():
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     
-    application.post_init = set_commands
+    application.post_init = post_init
+    application.post_shutdown = post_shutdown
+    
+    secret = BOT_WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    bot = None
+    if api is not None:
+        bot = InProcessBot(application, secret if BOT_WEBHOOK_URL else None)
+        api.state.telegram = bot
     
-    logger.info("Starting TradePackage AI Telegram Bot...")
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    logger.info("Starting TradePackage AI Telegram Bot (%s, %s)...", type(transport).__name__,
+                "webhook" if BOT_WEBHOOK_URL else "polling")
+    if not BOT_WEBHOOK_URL:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
+    elif bot is None:
+        # Needs python-telegram-bot[webhooks] for the listener.
+        application.run_webhook(
+            listen=BOT_WEBHOOK_LISTEN,
+            port=BOT_WEBHOOK_PORT,
+            url_path=urlparse(BOT_WEBHOOK_URL).path.lstrip("/"),
+            webhook_url=BOT_WEBHOOK_URL,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES,
+        )
+    else:
+        asyncio.run(serve_webhook(application, bot))
 
 if __name__ == "__main__":
     main()
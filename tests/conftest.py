@@ -0,0 +1,8 @@
+import os
+import sys
+
+# The backend's modules import each other as top-level modules, as they do
+# when main.py or uvicorn runs them.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "backend"))
+sys.path.insert(0, ROOT)
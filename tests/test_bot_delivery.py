@@ -0,0 +1,241 @@
+import asyncio
+import random
+
+import pytest
+from telegram.error import BadRequest, RetryAfter, TimedOut
+
+import bot_delivery
+from bot_delivery import FENCE, Sender, document_for, split_markdown
+
+# RetryAfter.retry_after warns that it will become a timedelta; retry_seconds takes either.
+pytestmark = pytest.mark.filterwarnings("ignore::telegram.warnings.PTBDeprecationWarning")
+
+
+def balanced(chunk: str) -> bool:
+    return sum(1 for line in chunk.split("\n") if FENCE.match(line)) % 2 == 0
+
+
+def test_short_text_is_one_chunk():
+    assert split_markdown("hello\nworld", 100) == ["hello\nworld"]
+
+
+def test_splits_at_line_breaks_within_the_limit():
+    text = "\n".join(f"line {n:03}" for n in range(100))
+    chunks = split_markdown(text, 100)
+    assert all(len(c) <= 100 for c in chunks)
+    assert "\n".join(chunks) == text
+
+
+def test_code_block_is_closed_and_reopened_with_its_language():
+    code = "\n".join(f"print({n})" for n in range(40))
+    text = f"Here:\n```python\n{code}\n```\nDone."
+    chunks = split_markdown(text, 120)
+    assert len(chunks) > 2
+    for chunk in chunks:
+        assert len(chunk) <= 120
+        assert balanced(chunk)
+    for chunk in chunks[1:-1]:
+        assert chunk.startswith("```python\n") and chunk.endswith("\n```")
+    # Nothing is lost: without the added fences, the code reads as before.
+    body = [line for c in chunks for line in c.split("\n") if not FENCE.match(line)]
+    assert body == [line for line in text.split("\n") if not FENCE.match(line)]
+
+
+def test_line_longer_than_the_limit_is_cut():
+    text = "short\n" + "x" * 250 + "\nend"
+    chunks = split_markdown(text, 100)
+    assert all(len(c) <= 100 for c in chunks)
+    assert "".join(chunks).replace("\n", "") == text.replace("\n", "")
+
+
+def test_long_line_inside_a_code_block_keeps_the_block_valid():
+    text = "```js\n" + "a" * 300 + "\n```"
+    chunks = split_markdown(text, 100)
+    for chunk in chunks:
+        assert len(chunk) <= 100
+        assert balanced(chunk)
+    assert "".join(c.replace("```js\n", "").replace("\n```", "") for c in chunks).replace("\n", "") == "a" * 300
+
+
+def test_random_documents_stay_within_the_limit_and_balanced():
+    rng = random.Random(7)
+    for _ in range(300):
+        lines = []
+        for _ in range(rng.randint(1, 60)):
+            kind = rng.random()
+            if kind < 0.1:
+                lines.append("```" + rng.choice(["", "python", "js"]))
+            else:
+                lines.append("y" * rng.choice([0, 5, 40, 90, 250]))
+        if sum(1 for line in lines if FENCE.match(line)) % 2:
+            lines.append("```")
+        limit = rng.choice([60, 100, 200])
+        for chunk in split_markdown("\n".join(lines), limit):
+            assert len(chunk) <= limit
+            assert balanced(chunk)
+
+
+def test_document_for_mostly_code():
+    code = "def f():\n    return 1\n" * 50
+    filename, content, intro = document_for(f"Here is the module:\n```python\n{code}```\n")
+    assert filename == "reply.py" and content == code and intro == "Here is the module:"
+
+
+def test_document_for_prose():
+    filename, content, _ = document_for("# Title\n" + "words " * 500)
+    assert filename == "reply.md" and content.startswith("# Title")
+
+
+def fast_sender(**kwargs):
+    settings = {"rate": 1000, "chat_interval": 0.05, "chat_burst": 2, "retries": 2}
+    settings.update(kwargs)
+    return Sender(**settings)
+
+
+def test_per_chat_burst_then_spacing():
+    async def run():
+        sender = fast_sender()
+        loop = asyncio.get_running_loop()
+        times = []
+
+        async def call():
+            times.append(loop.time())
+
+        start = loop.time()
+        for _ in range(4):
+            await sender.call(1, call)
+        # Another chat isn't held up by chat 1's backlog.
+        other = loop.time()
+        await sender.call(2, call)
+        return [t - start for t in times], loop.time() - other
+
+    times, other = asyncio.run(run())
+    assert times[1] < 0.02
+    assert times[2] == pytest.approx(0.05, abs=0.03)
+    assert times[3] == pytest.approx(0.10, abs=0.03)
+    assert other < 0.02
+
+
+def test_global_rate_spaces_calls_across_chats():
+    async def run():
+        sender = fast_sender(rate=50)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        for chat_id in range(5):
+            await sender.call(chat_id, asyncio.sleep, 0)
+        return loop.time() - start
+
+    assert asyncio.run(run()) == pytest.approx(0.08, abs=0.04)
+
+
+def test_flood_control_is_waited_out_and_retried():
+    attempts = []
+
+    async def flaky():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise RetryAfter(0)
+        if len(attempts) == 2:
+            raise TimedOut()
+        return "sent"
+
+    async def run():
+        sender = fast_sender()
+        return sender, await sender.call(1, flaky)
+
+    sender, result = asyncio.run(run())
+    assert result == "sent"
+    assert sender.flood_waits == 1 and sender.retried == 2 and sender.failed == 0
+
+
+def test_gives_up_after_the_retries():
+    async def always_flooded():
+        raise RetryAfter(0)
+
+    async def run():
+        sender = fast_sender(retries=1)
+        with pytest.raises(RetryAfter):
+            await sender.call(1, always_flooded)
+        return sender
+
+    assert asyncio.run(run()).failed == 1
+
+
+class FakeBot:
+    def __init__(self, reject_markdown: bool = False):
+        self.reject_markdown = reject_markdown
+        self.calls = []
+
+    async def send_message(self, **kwargs):
+        return self._record("send_message", kwargs)
+
+    async def edit_message_text(self, **kwargs):
+        return self._record("edit_message_text", kwargs)
+
+    async def send_document(self, **kwargs):
+        return self._record("send_document", kwargs)
+
+    def _record(self, method, kwargs):
+        if self.reject_markdown and kwargs.get("parse_mode"):
+            raise BadRequest("Can't parse entities")
+        self.calls.append((method, kwargs))
+        return True
+
+
+def test_invalid_markdown_is_sent_as_plain_text():
+    async def run():
+        sender = fast_sender(chat_interval=0)
+        bot = FakeBot(reject_markdown=True)
+        await sender.send_text(bot, 1, "a *broken")
+        return sender, bot
+
+    sender, bot = asyncio.run(run())
+    assert sender.plain_fallbacks == 1
+    assert bot.calls == [("send_message", {"text": "a *broken", "chat_id": 1, "reply_markup": None})]
+
+
+def test_unchanged_edit_is_ignored():
+    async def edit(**kwargs):
+        raise BadRequest("Message is not modified")
+
+    async def run():
+        sender = fast_sender(chat_interval=0)
+        bot = FakeBot()
+        bot.edit_message_text = edit
+        return await sender.edit_text(bot, 1, 10, "same"), sender
+
+    result, sender = asyncio.run(run())
+    assert result is None and sender.plain_fallbacks == 0
+
+
+def deliver(text: str):
+    async def run():
+        bot = FakeBot()
+        await fast_sender(chat_interval=0).deliver(bot, 1, 10, text, reply_markup="keyboard")
+        return bot.calls
+
+    return asyncio.run(run())
+
+
+def test_deliver_short_reply_edits_the_placeholder():
+    calls = deliver("done")
+    assert [(m, k["text"], k["reply_markup"]) for m, k in calls] == [("edit_message_text", "done", "keyboard")]
+
+
+def test_deliver_long_reply_as_a_run_of_messages():
+    text = "\n".join("z" * 80 for _ in range(120))
+    calls = deliver(text)
+    assert calls[0][0] == "edit_message_text" and calls[0][1]["reply_markup"] is None
+    assert all(m == "send_message" for m, _ in calls[1:])
+    assert [k["reply_markup"] for _, k in calls[1:]] == [None] * (len(calls) - 2) + ["keyboard"]
+    assert "\n".join(k["text"] for _, k in calls) == text
+
+
+def test_deliver_very_long_reply_as_a_document(monkeypatch):
+    monkeypatch.setattr(bot_delivery, "BOT_DOCUMENT_THRESHOLD", 5000)
+    code = "x = 1\n" * 2000
+    calls = deliver(f"Intro\n```python\n{code}```")
+    assert [m for m, _ in calls] == ["edit_message_text", "send_document"]
+    assert calls[1][1]["filename"] == "reply.py"
+    assert calls[1][1]["document"] == code.encode("utf-8")
+    assert calls[1][1]["reply_markup"] == "keyboard"
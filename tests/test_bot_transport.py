@@ -0,0 +1,67 @@
+import asyncio
+import socket
+
+import bot_transport
+from bot_transport import HttpTransport
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def counting(transport: HttpTransport) -> list:
+    calls = []
+    post = transport.session.post
+
+    def counted(*args, **kwargs):
+        calls.append(args[0])
+        return post(*args, **kwargs)
+
+    transport.session.post = counted
+    return calls
+
+
+def test_connection_refused_is_retried(monkeypatch):
+    monkeypatch.setattr(bot_transport, "BOT_HTTP_RETRIES", 2)
+    monkeypatch.setattr(bot_transport, "BOT_HTTP_RETRY_BACKOFF", 0.0)
+
+    async def run():
+        transport = HttpTransport(f"http://127.0.0.1:{free_port()}/api")
+        await transport.start()
+        calls = counting(transport)
+        result = await transport.request("chat", {"text": "hi"})
+        await transport.close()
+        return result, calls
+
+    result, calls = asyncio.run(run())
+    assert "error" in result
+    assert len(calls) == 3
+
+
+def test_disconnect_after_sending_is_not_retried(monkeypatch):
+    monkeypatch.setattr(bot_transport, "BOT_HTTP_RETRIES", 2)
+    monkeypatch.setattr(bot_transport, "BOT_HTTP_RETRY_BACKOFF", 0.0)
+    received = []
+
+    async def handle(reader, writer):
+        # Read the whole request, as if the backend ran it, then hang up.
+        head = await reader.readuntil(b"\r\n\r\n")
+        length = next(int(line.split(b":")[1]) for line in head.split(b"\r\n") if line.lower().startswith(b"content-length"))
+        received.append(await reader.readexactly(length))
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(handle, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        transport = HttpTransport(f"http://127.0.0.1:{port}/api")
+        result = await transport.request("chat", {"text": "hi"})
+        await transport.close()
+        server.close()
+        await server.wait_closed()
+        return result
+
+    result = asyncio.run(run())
+    assert "error" in result
+    assert len(received) == 1
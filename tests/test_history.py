@@ -0,0 +1,77 @@
+import sqlite3
+import time
+
+import pytest
+
+from history import SQLiteHistoryStore
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"), flush_interval=60, flush_batch=1000)
+    store._db.execute("PRAGMA busy_timeout = 50")
+    yield store
+    store.close()
+
+
+def lock(store):
+    other = sqlite3.connect(store.path, isolation_level=None)
+    other.execute("BEGIN IMMEDIATE")
+    return other
+
+
+def stored(store):
+    return store._db.execute("SELECT role, content FROM messages ORDER BY id").fetchall()
+
+
+def test_flush_on_a_locked_database_keeps_the_batch(store):
+    store.append("u", "user", "hello")
+    store.append("u", "assistant", "hi")
+    other = lock(store)
+    with pytest.raises(sqlite3.OperationalError):
+        store.flush()
+    assert store.stats()["pending"] == 2
+    assert [m["content"] for m in store.get("u")] == ["hello", "hi"]
+
+    other.execute("ROLLBACK")
+    other.close()
+    store.flush()
+    assert store.stats()["pending"] == 0
+    assert stored(store) == [("user", "hello"), ("assistant", "hi")]
+
+
+def test_append_never_writes_inline(tmp_path):
+    store = SQLiteHistoryStore(str(tmp_path / "history.db"), flush_interval=60, flush_batch=1)
+    store._db.execute("PRAGMA busy_timeout = 2000")
+    other = lock(store)
+    try:
+        started = time.monotonic()
+        store.append("u", "user", "hello")
+        assert time.monotonic() - started < 0.5
+    finally:
+        other.execute("ROLLBACK")
+        other.close()
+    store.close()
+    check = sqlite3.connect(str(tmp_path / "history.db"))
+    assert check.execute("SELECT content FROM messages").fetchall() == [("hello",)]
+    check.close()
+
+
+def test_full_batch_wakes_the_writer(store):
+    store.flush_batch = 2
+    store.append("u", "user", "one")
+    store.append("u", "assistant", "two")
+    deadline = time.monotonic() + 5
+    while store.stats()["pending"] and time.monotonic() < deadline:
+        time.sleep(0.02)
+    assert stored(store) == [("user", "one"), ("assistant", "two")]
+
+
+def test_reads_merge_pending_and_stored_messages(store):
+    store.append("u", "user", "first")
+    store.append("u", "assistant", "reply")
+    store.flush()
+    store.append("u", "user", "second")
+    assert [m["content"] for m in store.get("u")] == ["first", "reply", "second"]
+    store.clear("u")
+    assert store.get("u") == [] and store.stats()["pending"] == 0
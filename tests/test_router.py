@@ -0,0 +1,191 @@
+import asyncio
+
+import router
+from router import ModelRouter, CLOSED, OPEN, HALF_OPEN
+
+WINDOWS = {"big": 131072, "small": 8192}
+
+
+def make_router():
+    return ModelRouter(WINDOWS, fallbacks=["big", "small"])
+
+
+def trip(r: ModelRouter, model: str):
+    for _ in range(router.CIRCUIT_MIN_SAMPLES):
+        r.record_failure(model, RuntimeError("boom"))
+    assert r.health[model].state == OPEN
+
+
+def cool_down(r: ModelRouter, model: str):
+    r.health[model].open_until = 0.0
+
+
+def test_cancelled_probe_releases_half_open_model():
+    r = make_router()
+    trip(r, "big")
+    cool_down(r, "big")
+    assert r.candidates("big", 100) == ["big", "small"]
+    assert r.health["big"].state == HALF_OPEN
+
+    r.started("big", "big")
+    assert r.candidates("big", 100) == ["small"]
+
+    r.abandoned("big")
+    assert r.candidates("big", 100) == ["big", "small"]
+    assert r.health["big"].state == HALF_OPEN
+
+
+def test_cancelled_upstream_call_releases_probe():
+    import ai_client
+
+    class Hanging:
+        async def create(self, **kwargs):
+            await asyncio.Event().wait()
+
+    class Groq:
+        chat = type("Chat", (), {"completions": Hanging()})()
+
+    async def run():
+        client = ai_client.AIClient()
+        client.router = make_router()
+        trip(client.router, "big")
+        cool_down(client.router, "big")
+        messages = [{"role": "user", "content": "hi"}]
+        task = asyncio.ensure_future(client._upstream(Groq(), "big", messages, 16, "u", 0.1))
+        await asyncio.sleep(0.01)
+        assert client.router.health["big"].probing
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        return client.router
+
+    r = asyncio.run(run())
+    assert not r.health["big"].probing
+    assert "big" in r.candidates("big", 100)
+
+
+def test_cancelled_upstream_stream_releases_probe():
+    import ai_client
+
+    class Chunk:
+        def __init__(self, text):
+            self.choices = [type("Choice", (), {"delta": type("Delta", (), {"content": text})()})()]
+
+    class Slow:
+        async def create(self, **kwargs):
+            async def chunks():
+                yield Chunk("hello")
+                await asyncio.Event().wait()
+            return chunks()
+
+    class Groq:
+        chat = type("Chat", (), {"completions": Slow()})()
+
+    async def run():
+        client = ai_client.AIClient()
+        client.router = make_router()
+        trip(client.router, "big")
+        cool_down(client.router, "big")
+        messages = [{"role": "user", "content": "hi"}]
+        stream = client._upstream_stream(Groq(), "big", messages, 16, "u", 0.1)
+        assert await stream.__anext__() == "hello"
+        assert client.router.health["big"].probing
+        await stream.aclose()
+        return client.router
+
+    r = asyncio.run(run())
+    assert not r.health["big"].probing
+
+
+def test_successful_probe_closes_circuit():
+    r = make_router()
+    trip(r, "big")
+    cool_down(r, "big")
+    r.candidates("big", 100)
+    r.started("big", "big")
+    r.record_success("big", 0.5)
+    assert r.health["big"].state == CLOSED
+    assert not r.health["big"].probing
+
+
+def rate_limit_error(retry_after: str = None):
+    import groq
+    import httpx
+
+    headers = {"retry-after": retry_after} if retry_after else {}
+    response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.groq.com"))
+    return groq.RateLimitError("rate limited", response=response, body=None)
+
+
+def test_fallback_order_follows_the_requested_model():
+    r = ModelRouter({"a": 1000, "b": 1000, "c": 1000}, fallbacks=["a", "b", "c"])
+    assert r.candidates("a", 10) == ["a", "b", "c"]
+    assert r.candidates("b", 10) == ["b", "c"]
+    assert r.candidates("c", 10) == ["c"]
+
+
+def test_models_too_small_for_the_prompt_are_skipped():
+    r = ModelRouter(WINDOWS, fallbacks=["small", "big"])
+    assert r.candidates("small", 1000) == ["small", "big"]
+    assert r.candidates("small", 50000) == ["big"]
+    # Nothing fits: try the requested model rather than nothing.
+    assert r.candidates("small", 500000) == ["small"]
+
+
+def test_auto_prefers_the_fastest_model():
+    r = ModelRouter({"slow": 1000, "quick": 1000}, fallbacks=["slow", "quick"])
+    for _ in range(3):
+        r.record_success("slow", 3.0)
+        r.record_success("quick", 0.2)
+    assert r.candidates(router.AUTO_MODEL, 10) == ["quick", "slow"]
+
+
+def test_rate_limit_opens_the_circuit_for_retry_after():
+    r = make_router()
+    r.record_failure("big", rate_limit_error("7"))
+    health = r.health["big"]
+    assert health.state == OPEN and health.rate_limited == 1
+    assert 6 < health.open_until - router.time.monotonic() <= 7
+    assert r.candidates("big", 100) == ["small"]
+
+
+def test_error_rate_opens_the_circuit_only_after_enough_samples():
+    r = make_router()
+    for _ in range(router.CIRCUIT_MIN_SAMPLES - 1):
+        r.record_failure("big", RuntimeError("boom"))
+    assert r.health["big"].state == CLOSED
+    r.record_failure("big", RuntimeError("boom"))
+    assert r.health["big"].state == OPEN
+
+
+def test_failed_probe_doubles_the_cooldown():
+    r = make_router()
+    trip(r, "big")
+    cool_down(r, "big")
+    r.candidates("big", 100)
+    r.started("big", "big")
+    r.record_failure("big", RuntimeError("still down"))
+    health = r.health["big"]
+    assert health.state == OPEN
+    assert health.cooldown == min(router.CIRCUIT_COOLDOWN * 2, router.CIRCUIT_MAX_COOLDOWN)
+    assert not health.probing
+
+
+def test_every_circuit_open_still_tries_the_first_choice():
+    r = make_router()
+    trip(r, "big")
+    trip(r, "small")
+    assert r.candidates("big", 100) == ["big"]
+
+
+def test_stats_report_fallbacks_and_circuits():
+    r = make_router()
+    r.started("small", "big")
+    r.record_success("small", 0.25)
+    trip(r, "big")
+    stats = r.stats()
+    assert stats["fallbacks_used"] == 1
+    assert stats["models"]["big"]["circuit"] == OPEN
+    assert stats["models"]["small"]["p50_ms"] == 250
@@ -0,0 +1,120 @@
+import asyncio
+
+import ai_client
+from singleflight import SingleFlight
+from upstream import UpstreamGate
+
+
+def test_concurrent_calls_share_one_upstream_call():
+    calls = []
+    joined = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "reply"
+
+    async def run():
+        flights = SingleFlight()
+        replies = await asyncio.gather(*(flights.do("k", fetch, lambda: joined.append(1)) for _ in range(3)))
+        return flights, replies
+
+    flights, replies = asyncio.run(run())
+    assert replies == ["reply"] * 3
+    assert len(calls) == 1 and len(joined) == 2
+    assert flights.stats()["in_flight"] == 0
+
+
+def test_stream_subscribers_each_get_every_chunk():
+    joined = []
+
+    async def source():
+        for chunk in ("a", "b", "c"):
+            await asyncio.sleep(0.005)
+            yield chunk
+
+    async def read(stream):
+        return [chunk async for chunk in stream]
+
+    async def run():
+        flights = SingleFlight()
+        first = flights.stream("k", source, lambda: joined.append(1))
+        second = flights.stream("k", source, lambda: joined.append(1))
+        return await asyncio.gather(read(first), read(second))
+
+    assert asyncio.run(run()) == [["a", "b", "c"], ["a", "b", "c"]]
+    assert joined == [1]
+
+
+def test_caller_after_abandoned_stream_starts_a_new_flight():
+    started = []
+
+    async def source():
+        started.append(1)
+        yield "first"
+        await asyncio.sleep(0.05)
+        yield "second"
+
+    async def run():
+        flights = SingleFlight()
+        stream = flights.stream("k", source)
+        assert await stream.__anext__() == "first"
+        # The only subscriber leaves: the upstream stream is cancelled, and
+        # a caller arriving right after must not attach to it.
+        await stream.aclose()
+        late = flights.stream("k", source)
+        return [chunk async for chunk in late]
+
+    assert asyncio.run(run()) == ["first", "second"]
+    assert len(started) == 2
+
+
+def test_subscriber_that_has_not_started_reading_keeps_the_stream():
+    async def source():
+        yield "first"
+        await asyncio.sleep(0.01)
+        yield "second"
+
+    async def run():
+        flights = SingleFlight()
+        first = flights.stream("k", source)
+        second = flights.stream("k", source)
+        assert await first.__anext__() == "first"
+        await first.aclose()
+        return [chunk async for chunk in second]
+
+    assert asyncio.run(run()) == ["first", "second"]
+
+
+def test_coalesced_callers_are_charged_their_own_share(monkeypatch):
+    class Chunk:
+        def __init__(self, text):
+            self.choices = [type("Choice", (), {"delta": type("Delta", (), {"content": text})()})()]
+
+    class Completions:
+        async def create(self, **kwargs):
+            async def chunks():
+                await asyncio.sleep(0.01)
+                yield Chunk("hello")
+            return chunks()
+
+    class Groq:
+        chat = type("Chat", (), {"completions": Completions()})()
+
+    monkeypatch.setattr(ai_client, "client", Groq())
+
+    async def read(client, user_id):
+        return "".join([d async for d in client.chat_stream("same question", user_id, max_tokens=256)])
+
+    async def run():
+        client = ai_client.AIClient()
+        client.gate = UpstreamGate(user_rate=0)
+        replies = await asyncio.gather(read(client, "alice"), read(client, "bob"))
+        return client, replies
+
+    client, replies = asyncio.run(run())
+    assert replies == ["hello", "hello"]
+    assert client.flights.stats()["stream_coalesced"] == 1
+    # Both users' next requests queue behind what they already got.
+    assert client.gate._finish["alice"] > 0
+    assert client.gate._finish["alice"] == client.gate._finish["bob"]
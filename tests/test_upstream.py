@@ -0,0 +1,234 @@
+import asyncio
+
+import pytest
+
+import ai_client
+from upstream import UpstreamGate, UpstreamBusy, RateLimited
+
+
+class Message:
+    def __init__(self, content):
+        self.content = content
+
+
+class Response:
+    def __init__(self, content):
+        self.choices = [type("Choice", (), {"message": Message(content)})()]
+        self.usage = None
+
+
+class Completions:
+    async def create(self, model, messages, max_tokens, stream=False):
+        return Response("Sure, here you go.")
+
+
+class Groq:
+    chat = type("Chat", (), {"completions": Completions()})()
+
+
+def test_admit_charges_estimate_and_settle_corrects_it():
+    gate = UpstreamGate(user_rate=0.001, user_burst=10)
+    charged = gate.admit("u", cost=8.0, charge=2.0)
+    assert charged == 2.0
+    assert gate._buckets["u"].tokens == pytest.approx(8.0, abs=0.01)
+    gate.settle("u", charged, 0.5)
+    assert gate._buckets["u"].tokens == pytest.approx(9.5, abs=0.01)
+    # Costing more than estimated puts the user in debt for the next one.
+    charged = gate.admit("u", cost=8.0, charge=2.0)
+    gate.settle("u", charged, 9.0)
+    assert gate._buckets["u"].tokens == pytest.approx(0.5, abs=0.01)
+    with pytest.raises(RateLimited):
+        gate.admit("u", cost=1.0)
+
+
+def test_no_user_limit_charges_nothing():
+    gate = UpstreamGate(user_rate=0)
+    assert gate.admit("u", cost=100.0) == 0.0
+    gate.settle("u", 0.0, 5.0)
+    assert not gate._buckets
+
+
+def test_short_chats_are_not_charged_for_max_tokens(monkeypatch):
+    monkeypatch.setattr(ai_client, "client", Groq())
+
+    async def run():
+        client = ai_client.AIClient()
+        client.gate = UpstreamGate(user_rate=0.25, user_burst=20)
+        # Each call reserves 4096 completion tokens on the 70B model; charged
+        # for all of them, the fifth quick message would be refused.
+        for i in range(12):
+            reply = await client.chat(f"question {i}", "alice", max_tokens=4096)
+            assert reply == "Sure, here you go."
+
+    asyncio.run(run())
+
+
+async def hold(gate, user_id, cost, order, release):
+    async with gate.slot(user_id, cost):
+        order.append(user_id)
+        await release.wait()
+
+
+async def queue_behind(gate, requests, cost=1.0):
+    """Start `requests` (user ids) behind one held slot; return (order, release, tasks)."""
+    order = []
+    release = asyncio.Event()
+    blocker = asyncio.ensure_future(hold(gate, "holder", cost, [], release))
+    await asyncio.sleep(0)
+    tasks = []
+    for user_id in requests:
+        tasks.append(asyncio.ensure_future(hold(gate, user_id, cost, order, release)))
+        await asyncio.sleep(0)
+    return order, release, [blocker] + tasks
+
+
+def test_users_take_turns_within_a_lane():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_reserved=0, user_rate=0)
+        order, release, tasks = await queue_behind(gate, ["alice", "alice", "alice", "bob"])
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["alice", "bob", "alice", "alice"]
+
+
+def test_heavier_weight_gets_more_turns():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_reserved=0, user_rate=0, user_weights={"vip": 2.0})
+        order, release, tasks = await queue_behind(gate, ["vip"] * 4 + ["bob"] * 2)
+        release.set()
+        await asyncio.gather(*tasks)
+        return order
+
+    assert asyncio.run(run()) == ["vip", "bob", "vip", "vip", "bob", "vip"]
+
+
+def test_fast_lane_is_served_first():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_cost=1.0, fast_lane_reserved=0, user_rate=0)
+        order = []
+        release = asyncio.Event()
+        blocker = asyncio.ensure_future(hold(gate, "holder", 0.5, [], release))
+        await asyncio.sleep(0)
+        slow = asyncio.ensure_future(hold(gate, "slow", 5.0, order, release))
+        await asyncio.sleep(0)
+        fast = asyncio.ensure_future(hold(gate, "fast", 0.5, order, release))
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(blocker, slow, fast)
+        return order
+
+    assert asyncio.run(run()) == ["fast", "slow"]
+
+
+def test_slow_lane_cannot_take_reserved_slots():
+    async def run():
+        gate = UpstreamGate(max_in_flight=2, fast_lane_cost=1.0, fast_lane_reserved=1, user_rate=0)
+        order = []
+        release = asyncio.Event()
+        first = asyncio.ensure_future(hold(gate, "slow1", 5.0, order, release))
+        second = asyncio.ensure_future(hold(gate, "slow2", 5.0, order, release))
+        await asyncio.sleep(0.01)
+        assert order == ["slow1"] and gate.waiting == 1
+        fast = asyncio.ensure_future(hold(gate, "fast", 0.5, order, release))
+        await asyncio.sleep(0.01)
+        assert order == ["slow1", "fast"]
+        release.set()
+        await asyncio.gather(first, second, fast)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.in_flight == 0 and gate.completed == 3
+
+
+def test_admit_sheds_when_the_backlog_is_too_deep():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_reserved=0, user_rate=0, shed_queue=2)
+        _, release, tasks = await queue_behind(gate, ["a", "b"])
+        with pytest.raises(UpstreamBusy) as busy:
+            gate.admit("c", 1.0)
+        assert busy.value.retry_after >= 1.0
+        release.set()
+        await asyncio.gather(*tasks)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.shed == 1
+    gate.admit("c", 1.0)
+
+
+def test_admit_sheds_on_expected_wait():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_reserved=0, user_rate=0, shed_queue=100, shed_wait=5)
+        gate._service["fast"] = 10.0  # each request has been taking 10 s
+        _, release, tasks = await queue_behind(gate, ["a"])
+        with pytest.raises(UpstreamBusy):
+            gate.admit("b", 1.0)
+        release.set()
+        await asyncio.gather(*tasks)
+
+    asyncio.run(run())
+
+
+def test_full_queue_rejects():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, max_queue=1, fast_lane_reserved=0, user_rate=0)
+        _, release, tasks = await queue_behind(gate, ["a"])
+        with pytest.raises(UpstreamBusy, match="queue is full"):
+            async with gate.slot("b", 1.0):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+        return gate
+
+    assert asyncio.run(run()).rejected == 1
+
+
+def test_queue_timeout():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, queue_timeout=0.01, fast_lane_reserved=0, user_rate=0)
+        _, release, tasks = await queue_behind(gate, [])
+        with pytest.raises(UpstreamBusy, match="timed out"):
+            async with gate.slot("b", 1.0):
+                pass
+        release.set()
+        await asyncio.gather(*tasks)
+        return gate
+
+    gate = asyncio.run(run())
+    assert gate.timed_out == 1
+    assert gate.waiting == 0 and gate.in_flight == 0
+
+
+def test_cancelled_waiter_gives_up_its_place():
+    async def run():
+        gate = UpstreamGate(max_in_flight=1, fast_lane_reserved=0, user_rate=0)
+        order, release, tasks = await queue_behind(gate, ["a", "b"])
+        tasks[1].cancel()
+        await asyncio.sleep(0)
+        release.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        return gate, order
+
+    gate, order = asyncio.run(run())
+    assert order == ["b"]
+    assert gate.in_flight == 0 and gate.waiting == 0
+
+
+def test_user_bucket_refuses_with_retry_after():
+    gate = UpstreamGate(user_rate=1.0, user_burst=2.0)
+    gate.admit("u", 2.0)
+    with pytest.raises(RateLimited) as limited:
+        gate.admit("u", 1.0)
+    assert limited.value.retry_after == pytest.approx(1.0, abs=0.05)
+    # Other users have buckets of their own.
+    gate.admit("v", 2.0)
+    assert gate.rate_limited == 1
+
+
+def test_request_bigger_than_the_burst_passes_on_a_full_bucket():
+    gate = UpstreamGate(user_rate=1.0, user_burst=2.0)
+    assert gate.admit("u", 50.0) == 2.0
+    with pytest.raises(RateLimited):
+        gate.admit("u", 50.0)